@@ -8,9 +8,14 @@ ks_name = config.get("cassandra", "session_keyspace")
 sync_type(ks_name, UserOrderExecutionModel)
 sync_type(ks_name, CurrentPriceModel)
 sync_type(ks_name, PriceChangeModel)
+# data_record2已经存在的时候会增加intervals字段
 sync_type(ks_name, DataRecordModel)
 sync_type(ks_name, BargainerModel)
 sync_table(AccountModel)
 sync_table(TimeSeriesModel)
+# time_series_data2已经存在的时候会增加data_bin列
 sync_table(TimeSeriesDataModel)
+# 按照交易时段分区的时序数据以及迁移进度，cassandra.layout=session时使用
+sync_table(TimeSeriesSessionDataModel)
+sync_table(TimeSeriesDataMigrationModel)
 sync_table(UserOrderModel)
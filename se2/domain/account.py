@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import heapq
 import uuid
 
 from se2.domain.common import *
@@ -653,30 +654,113 @@ class OrderRepo(metaclass=ABCMeta):
         pass
 
 
+class OrderBook(object):
+    """
+    回测账户中按照code组织的未成交订单。限价单和止损单按照触发价格放在堆中，堆顶是最先被触发的订单，
+    撮合一个bar的时候只需要取出触发价格在bar的[low, high]范围内的订单；市价单等其他订单每个bar都参与撮合。
+    堆中的元素为(排序键, 下单序号, 订单)，下单序号用于保持原来按照下单顺序撮合的结果
+    """
+
+    # 堆的类型 -> 排序键是否为触发价格的相反数。买入限价单和卖出止损单在价格下跌到触发价格的时候触发，价格越高越先触发
+    HEAP_KINDS = {'buy_limit': True, 'sell_limit': False, 'buy_stop': False, 'sell_stop': True}
+
+    def __init__(self):
+        self.seq = 0
+        self.heaps: Dict[str, Dict[str, List[Tuple[float, int, Order]]]] = {}
+        self.others: Dict[str, List[Tuple[float, int, Order]]] = {}
+        self.locations: Dict[int, Tuple[str, Optional[str]]] = {}
+
+    @classmethod
+    def heap_kind(cls, order: Order) -> Optional[Tuple[str, float]]:
+        if isinstance(order, LimitOrder) and order.limit_price:
+            if order.direction == OrderDirection.BUY:
+                return 'buy_limit', -order.limit_price
+            return 'sell_limit', order.limit_price
+        elif isinstance(order, StopOrder):
+            if order.direction == OrderDirection.BUY:
+                return 'buy_stop', order.stop_price
+            return 'sell_stop', -order.stop_price
+        return None
+
+    def add(self, order: Order, seq: int = None):
+        if seq is None:
+            seq = self.seq
+            self.seq += 1
+        kind = self.heap_kind(order)
+        if kind:
+            heap = self.heaps.setdefault(order.code, {}).setdefault(kind[0], [])
+            heapq.heappush(heap, (kind[1], seq, order))
+            self.locations[id(order)] = (order.code, kind[0])
+        else:
+            self.others.setdefault(order.code, []).append((0, seq, order))
+            self.locations[id(order)] = (order.code, None)
+
+    def remove(self, order: Order):
+        if id(order) not in self.locations:
+            return
+        code, kind = self.locations.pop(id(order))
+        entries = self.heaps[code][kind] if kind else self.others[code]
+        entries[:] = [entry for entry in entries if entry[2] is not order]
+        if kind:
+            heapq.heapify(entries)
+
+    def pop_triggered(self, bar: Bar) -> List[Tuple[int, Order]]:
+        """
+        取出该bar能触发的订单，按照下单顺序返回
+        """
+        res = [(seq, order) for _, seq, order in self.others.pop(bar.code, [])]
+        for kind, heap in self.heaps.get(bar.code, {}).items():
+            bound = -bar.low if self.HEAP_KINDS[kind] else bar.high
+            while len(heap) > 0 and heap[0][0] <= bound:
+                _, seq, order = heapq.heappop(heap)
+                res.append((seq, order))
+        for _, order in res:
+            self.locations.pop(id(order), None)
+        return sorted(res, key=lambda t: t[0])
+
+    def pop_all(self, code: str) -> List[Tuple[int, Order]]:
+        res = [(seq, order) for _, seq, order in self.others.pop(code, [])]
+        for heap in self.heaps.pop(code, {}).values():
+            res.extend([(seq, order) for _, seq, order in heap])
+        for _, order in res:
+            self.locations.pop(id(order), None)
+        return sorted(res, key=lambda t: t[0])
+
+
 class BacktestAccount(AbstractAccount):
 
     def __init__(self, name: str, initial_cash: float, data_portal: DataPortal):
 
         super().__init__(name, initial_cash)
         self.data_portal = data_portal
+        self.order_book = OrderBook()
 
     def match(self, data):
         # 有时在一个bar的周期内，同时有多个订单成交，这多个订单之间可能存在一些约束关系，比如若其中一个订单成交就取消另一个
         # 对这种情况，由于回测环境下这多个订单的成交事件都是在bar结束的时候才发出的，没有了先后关系
         # 针对括号单的情况，如果止赢和止损都撮合成功的情况，会先成交止损单，后成交止盈单
+        # 只撮合订单簿中该code的可能被触发的订单，已经成交或者取消的订单不在订单簿中
 
+        if isinstance(data, Bar):
+            candidates = self.order_book.pop_triggered(data)
+        elif isinstance(data, CurrentPrice):
+            candidates = self.order_book.pop_all(data.code)
+        else:
+            raise RuntimeError("非法的撮合数据")
         match_result: List[Tuple[Order, Execution]] = []
-        for order in self.get_new_placed_orders():
+        for seq, order in candidates:
             if order.status not in [OrderStatus.SUBMITTED, OrderStatus.PARTIAL_FILLED]:
+                if order.status == OrderStatus.CREATED:
+                    self.order_book.add(order, seq)
                 continue
             if isinstance(data, Bar):
                 execution = order.bar_match(data)
-            elif isinstance(data, CurrentPrice):
-                execution = order.current_price_match(data)
             else:
-                raise RuntimeError("非法的撮合数据")
+                execution = order.current_price_match(data)
             if execution:
                 match_result.append((order, execution))
+            else:
+                self.order_book.add(order, seq)
 
         if len(match_result) > 1:
             logging.warning("一个时间周期内同时成交了多笔订单，data:{}".format(data.__dict__))
@@ -696,9 +780,11 @@ class BacktestAccount(AbstractAccount):
         execution = order.current_price_match(cp)
         if execution:
             self.order_filled(order, [execution])
+        else:
+            self.order_book.add(order)
 
     def do_cancel_order(self, order: Order):
-        pass
+        self.order_book.remove(order)
 
     def do_update_order_price(self, order, new_price):
         raise NotImplementedError
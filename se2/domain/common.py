@@ -44,6 +44,13 @@ class BeanContainer(object):
     def getBean(cls, the_type: type):
         return cls.beans[the_type]
 
+    @classmethod
+    def findBean(cls, the_type: type):
+        """
+        没有注册的时候返回None，用于可选的组件
+        """
+        return cls.beans.get(the_type)
+
     @classmethod
     def register(cls, the_type: type, bean: object):
         cls.beans[the_type] = bean
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import time
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
+import numpy as np
 import trading_calendars
 
 from se2.domain.account import *
@@ -28,6 +30,38 @@ class Rule(metaclass=ABCMeta):
     def next_time(self, calendar: TradingCalendar, current_time: Timestamp) -> Timestamp:
         pass
 
+    def anchors(self, calendar: TradingCalendar) -> Optional[pd.DatetimeIndex]:
+        """
+        规则所依赖的交易日历中的时间点(UTC)，比如每个交易时段的开盘时间，触发时间为anchors + offset。
+        返回None的时候回测中逐分钟调用is_match来生成触发时间
+        """
+        return None
+
+    def offset(self) -> Timedelta:
+        return Timedelta(minutes=self.minute_offset) + Timedelta(seconds=self.second_offset)
+
+    def fire_times(self, calendar: TradingCalendar, start: Timestamp, end: Timestamp,
+                   step: Timedelta = Timedelta(minutes=1)) -> pd.DatetimeIndex:
+        """
+        回测中从start开始按照step推进时间，返回规则在[start, end]内的全部触发时间，跟逐个时间点调用is_match的结果相同:
+        只有anchor和anchor + offset都在start之后的才会触发，触发的时刻是目标时间之后的第一个推进时刻
+        """
+        anchors = self.anchors(calendar)
+        if anchors is None:
+            res = []
+            p = start
+            while p <= end:
+                if self.is_match(calendar, p):
+                    res.append(p)
+                p += step
+            return pd.DatetimeIndex(res, tz=start.tz)
+        targets = anchors + self.offset()
+        mask = (anchors > start) & (targets > start)
+        diff = targets[mask].asi8 - start.value
+        fire = start.value + (-(-diff // step.value)) * step.value
+        fire = np.unique(fire[fire <= end.value])
+        return pd.DatetimeIndex(fire, tz='UTC').tz_convert(start.tz)
+
     def __init__(self, minute_offset, second_offset):
         self._next_time = None
         self.minute_offset = minute_offset
@@ -46,6 +80,12 @@ class MarketOpen(Rule):
                  + Timedelta(seconds=self.second_offset)
         return dt
 
+    def anchors(self, calendar: TradingCalendar) -> Optional[pd.DatetimeIndex]:
+        return pd.DatetimeIndex(calendar.opens.values, tz='UTC')
+
+    def offset(self) -> Timedelta:
+        return super().offset() - Timedelta(minutes=1)
+
     def __init__(self, minute_offset=0, second_offset=0):
         super().__init__(minute_offset, second_offset)
 
@@ -59,6 +99,9 @@ class MarketClose(Rule):
                  Timedelta(seconds=self.second_offset)
         return dt
 
+    def anchors(self, calendar: TradingCalendar) -> Optional[pd.DatetimeIndex]:
+        return pd.DatetimeIndex(calendar.closes.values, tz='UTC')
+
     def __init__(self, minute_offset=0, second_offset=0):
         super().__init__(minute_offset, second_offset)
 
@@ -162,39 +205,108 @@ class EventProducer(TimeSeriesSubscriber):
         self.subscriber.on_event(Event(event_definition=ed, visible_time=data.visible_time, data=data))
 
     def history_events(self, scope: Scope, start: Timestamp, end: Timestamp) -> List[Event]:
+        event_line = EventLine()
+        event_line.add_sources(self.history_event_sources(scope, start, end))
         total_events = []
+        event = event_line.pop_event()
+        while event is not None:
+            total_events.append(event)
+            event = event_line.pop_event()
+        return total_events
 
-        # 组装时间事件
-        if len(self.time_event_definitions) > 0:
-
-            delta = Timedelta(minutes=1)
-            p = start
-            while p <= end:
-                for ed in self.time_event_definitions:
-                    if ed.time_rule.second_offset != 0:
-                        raise RuntimeError("回测过程中的时间事件不允许秒级偏移")
-                    if ed.time_rule.is_match(scope.trading_calendar, p):
-                        total_events.append(Event(ed, p, {}))
-
-                p += delta
-
-        # 组装数据事件
-        if len(self.data_event_definitions) > 0:
+    def history_event_sources(self, scope: Scope, start: Timestamp, end: Timestamp) -> List[EventSource]:
+        """
+        每个事件定义生成一个事件源，只包含事件的时间，事件对象在分发的时候才创建
+        """
+        return self.time_event_sources(scope, start, end) + self.data_event_sources(scope, start, end)
+
+    def time_event_sources(self, scope: Scope, start: Timestamp, end: Timestamp) -> List[TimeEventSource]:
+        sources = []
+        for ed in self.time_event_definitions:
+            if ed.time_rule.second_offset != 0:
+                raise RuntimeError("回测过程中的时间事件不允许秒级偏移")
+            sources.append(TimeEventSource(ed, ed.time_rule.fire_times(scope.trading_calendar, start, end)))
+        return sources
+
+    def data_event_sources(self, scope: Scope, start: Timestamp, end: Timestamp) -> List[DataEventSource]:
+        sources = []
+        for ed in self.data_event_definitions:
+            ts = BeanContainer.getBean(TimeSeriesRepo).find_one(ed.ts_type_name)
+            command = HistoryDataQueryCommand(start, end, scope.codes)
+            command.with_calendar(scope.trading_calendar)
+            df = ts.history_data(command, from_local=True)
+            sources.append(DataEventSource(ed, df))
+        return sources
+
+    def session_chunks(self, calendar: TradingCalendar, start: Timestamp, end: Timestamp, chunk_sessions: int) \
+            -> List[Tuple[Timestamp, Timestamp]]:
+        """
+        在开盘时间将[start, end]切分成首尾相接的区间，每个区间包含chunk_sessions个交易时段。
+        除了最后一个区间，区间的结束时刻属于下一个区间
+        """
+        opens = pd.DatetimeIndex(calendar.opens.values, tz='UTC')
+        opens = opens[(opens > start) & (opens < end)][chunk_sessions - 1::chunk_sessions]
+        bounds = [start] + [session_open.tz_convert(start.tz) for session_open in opens] + [end]
+        return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
 
-            for ed in self.data_event_definitions:
-                ts = BeanContainer.getBean(TimeSeriesRepo).find_one(ed.ts_type_name)
+    def stream_history_events(self, scope: Scope, start: Timestamp, end: Timestamp, chunk_sessions: int = 1,
+                              on_chunk: Callable[[Timestamp, Timestamp], None] = None) -> Iterator[Event]:
+        """
+        按照交易时段分段加载数据事件并按照时间顺序依次返回事件，同一时刻内存中只有当前分段以及预加载的下一个分段。
+        各个分段的时间范围互不重叠，所以分段内排序之后依次返回的结果跟整体排序的结果相同。
+        时间事件的触发时间只跟交易日历有关，整体计算一次之后再按照分段切分。
+        预加载线程不调用共享的TimeSeries.history_data：需要缓存的时序类型先在当前线程下载整个区间缺失的数据，
+        预加载线程只从TSDataRepo读取，其他的时序类型以及分层读取的时候在分发线程中加载。
+        on_chunk在分发线程中每个分段的事件返回之前调用，参数为该分段的时间范围
+        """
+        time_sources = self.time_event_sources(scope, start, end)
+        chunks = self.session_chunks(scope.trading_calendar, start, end, chunk_sessions)
+        ts_data_repo: TSDataRepo = BeanContainer.getBean(TSDataRepo)
+        time_series_list: List[TimeSeries] = [BeanContainer.getBean(TimeSeriesRepo).find_one(ed.ts_type_name)
+                                              for ed in self.data_event_definitions]
+        prefetchable = [ts.tp.should_cache() and not BeanContainer.findBean(TieredDataAccess)
+                        for ts in time_series_list]
+        for ts, can_prefetch in zip(time_series_list, prefetchable):
+            if can_prefetch:
                 command = HistoryDataQueryCommand(start, end, scope.codes)
                 command.with_calendar(scope.trading_calendar)
-                df = ts.history_data(command, from_local=True)
-                for (visible_time, code), values in df.iterrows():
-                    data: Dict = values.to_dict()
-                    data['code'] = code
-                    if ed.is_bar:
-                        data = Bar(ed.ts_type_name, visible_time, code, values.to_dict())
-                    event = Event(ed, visible_time, data)
-                    total_events.append(event)
-
-        return total_events
+                increment_commands = ts.increment_commands(command)
+                if len(increment_commands) > 0:
+                    ts.download_data(command, increment_commands, collect=False)
+
+        def chunk_command(k: int) -> HistoryDataQueryCommand:
+            chunk_start, chunk_end = chunks[k]
+            if k < len(chunks) - 1:
+                chunk_end = chunk_end - Timedelta(nanoseconds=1)
+            command = HistoryDataQueryCommand(chunk_start, chunk_end, scope.codes)
+            command.with_calendar(scope.trading_calendar)
+            return command
+
+        def prefetch(k: int) -> Dict[int, DataFrame]:
+            command = chunk_command(k)
+            return {i: ts_data_repo.query_df(ts.name, command) for i, ts in enumerate(time_series_list)
+                    if prefetchable[i]}
+
+        # 后台线程预加载下一个分段，分发当前分段事件的同时读取数据
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='backtest_prefetch') as executor:
+            future = executor.submit(prefetch, 0)
+            for k in range(len(chunks)):
+                dfs = future.result()
+                if k + 1 < len(chunks):
+                    future = executor.submit(prefetch, k + 1)
+                command = chunk_command(k)
+                if on_chunk:
+                    on_chunk(command.start, command.end)
+                sources = [source.between(command.start, command.end) for source in time_sources]
+                for i, ed in enumerate(self.data_event_definitions):
+                    df = dfs[i] if i in dfs else time_series_list[i].history_data(command, from_local=True)
+                    sources.append(DataEventSource(ed, df))
+                event_line = EventLine()
+                event_line.add_sources(sources)
+                event = event_line.pop_event()
+                while event is not None:
+                    yield event
+                    event = event_line.pop_event()
 
     def subscribe(self, subscriber: EventSubscriber):
         self.subscriber = subscriber
@@ -351,18 +463,117 @@ class AbstractStrategy(OrderStatusCallback, metaclass=ABCMeta):
 
 
 
+class EventSource(metaclass=ABCMeta):
+    """
+    一个事件定义产生的全部历史事件，times为每个事件的可见时间(UTC纳秒)，按照行号创建事件对象
+    """
+
+    def __init__(self, event_definition: EventDefinition, times: np.ndarray):
+        self.event_definition = event_definition
+        self.times = times
+
+    @abstractmethod
+    def event_at(self, row: int) -> Event:
+        pass
+
+
+class TimeEventSource(EventSource):
+
+    def __init__(self, event_definition: EventDefinition, visible_time: pd.DatetimeIndex):
+        super().__init__(event_definition, visible_time.asi8)
+        self.visible_time = visible_time
+
+    def event_at(self, row: int) -> Event:
+        return Event(self.event_definition, self.visible_time[row], {})
+
+    def between(self, start: Timestamp, end: Timestamp) -> TimeEventSource:
+        lo = np.searchsorted(self.times, start.value, side='left')
+        hi = np.searchsorted(self.times, end.value, side='right')
+        return TimeEventSource(self.event_definition, self.visible_time[lo: hi])
+
+
+class DataEventSource(EventSource):
+    """
+    history_data返回的DataFrame按列保存，分发到某一行的时候才组装该行的数据
+    """
+
+    def __init__(self, event_definition: EventDefinition, df: DataFrame):
+        visible_time = pd.DatetimeIndex(df.index.get_level_values(0))
+        super().__init__(event_definition, visible_time.asi8)
+        self.visible_time = visible_time
+        self.codes = df.index.get_level_values(1).values
+        # 时间列使用DatetimeArray，取出来的是带时区的Timestamp；数值列转换成python的int和float
+        self.columns = []
+        for name in df.columns:
+            values = df[name].array if isinstance(df[name].dtype, pd.DatetimeTZDtype) else df[name].values
+            self.columns.append((name, values, isinstance(values, np.ndarray) and values.dtype.kind in 'biuf'))
+
+    def event_at(self, row: int) -> Event:
+        visible_time, code = self.visible_time[row], self.codes[row]
+        values = {name: arr[row].item() if is_number else arr[row] for name, arr, is_number in self.columns}
+        if self.event_definition.is_bar:
+            data = Bar(self.event_definition.ts_type_name, visible_time, code, values)
+        else:
+            data = dict(values)
+            data['code'] = code
+        return Event(self.event_definition, visible_time, data)
+
+
+class ListEventSource(EventSource):
+
+    def __init__(self, event_definition: EventDefinition, events: List[Event]):
+        super().__init__(event_definition, np.array([event.visible_time.value for event in events], dtype=np.int64))
+        self.events = events
+
+    def event_at(self, row: int) -> Event:
+        return self.events[row]
+
+
 class EventLine(object):
+    """
+    按列保存的事件时间线，每个事件只记录(时间, 事件源, 行号)，所有事件通过一次lexsort排序之后用游标依次取出。
+    同一时间的事件按照事件定义的order排序，order相同的时候跟原来Event.__lt__排序的结果保持一致，时间事件在数据事件之前，
+    再相同的时候按照事件源加入的顺序以及行号排序
+    """
 
     def __init__(self):
-        self.events = []
+        self.sources: List[EventSource] = []
+        self.times = np.empty(0, dtype=np.int64)
+        self.source_ids = np.empty(0, dtype=np.int64)
+        self.rows = np.empty(0, dtype=np.int64)
+        self.cursor = 0
+
+    @classmethod
+    def priority(cls, event_definition: EventDefinition) -> int:
+        return event_definition.order * 2 + (0 if event_definition.tp == EventDefinitionType.TIME else 1)
+
+    def add_sources(self, sources: List[EventSource]):
+        times, source_ids, rows = [self.times[self.cursor:]], [self.source_ids[self.cursor:]], \
+                                  [self.rows[self.cursor:]]
+        for source in sources:
+            times.append(source.times)
+            source_ids.append(np.full(len(source.times), len(self.sources), dtype=np.int64))
+            rows.append(np.arange(len(source.times), dtype=np.int64))
+            self.sources.append(source)
+        times, source_ids, rows = np.concatenate(times), np.concatenate(source_ids), np.concatenate(rows)
+        priorities = np.array([self.priority(source.event_definition) for source in self.sources],
+                              dtype=np.int64)[source_ids]
+        order = np.lexsort((rows, source_ids, priorities, times))
+        self.times, self.source_ids, self.rows = times[order], source_ids[order], rows[order]
+        self.cursor = 0
 
     def add_all(self, events: List[Event]):
-        self.events.extend(events)
-        self.events.sort()
+        events_by_ed: Dict[EventDefinition, List[Event]] = {}
+        for event in events:
+            events_by_ed.setdefault(event.event_definition, []).append(event)
+        self.add_sources([ListEventSource(ed, ed_events) for ed, ed_events in events_by_ed.items()])
 
     def pop_event(self) -> Event:
-        if len(self.events) > 0:
-            return self.events.pop(0)
+        if self.cursor < len(self.times):
+            source = self.sources[self.source_ids[self.cursor]]
+            row = self.rows[self.cursor]
+            self.cursor += 1
+            return source.event_at(row)
         else:
             return None
 
@@ -403,7 +614,11 @@ class Engine(EventSubscriber):
         self.account.calc_net_value(price_map, event.visible_time)
 
     def run_backtest(self, strategy: AbstractStrategy, start: Timestamp, end: Timestamp,
-                     ts_type_name_for_match: str):
+                     ts_type_name_for_match: str, chunk_sessions: int = 0):
+        """
+        chunk_sessions大于0的时候按照交易时段分段流式的加载数据，每段包含chunk_sessions个交易时段，内存占用只跟分段的大小有关；
+        为0的时候一次加载整个回测区间的数据
+        """
         strategy.initialize(self.data_portal, self.account, self)
         self.account.with_order_callback(strategy)
 
@@ -415,13 +630,20 @@ class Engine(EventSubscriber):
             EventDefinition(tp=EventDefinitionType.DATA, ts_type_name=ts_type_name_for_match, order=-10, is_bar=True),
             self.match)
 
-        event_line = EventLine()
+        # 撮合和计算净值的时候都需要获取价格，分段加载的时候每个分段开始之前预加载该分段的价格，否则预加载整个回测区间的价格
+        def preload_chunk(chunk_start: Timestamp, chunk_end: Timestamp):
+            self.data_portal.preload_current_price(strategy.scope.codes, chunk_start, chunk_end)
 
         ep = EventProducer(self.event_definitions)
-        event_line.add_all(ep.history_events(strategy.scope, start, end))
+        if chunk_sessions > 0:
+            events = ep.stream_history_events(strategy.scope, start, end, chunk_sessions, on_chunk=preload_chunk)
+        else:
+            self.data_portal.preload_current_price(strategy.scope.codes, start, end)
+            event_line = EventLine()
+            event_line.add_sources(ep.history_event_sources(strategy.scope, start, end))
+            events = iter(event_line.pop_event, None)
 
-        event: Event = event_line.pop_event()
-        while event is not None:
+        for event in events:
             callback = self.callback_for(event.event_definition)
             try:
                 callback(event)
@@ -429,7 +651,6 @@ class Engine(EventSubscriber):
                 import traceback
                 logging.error("{}".format(traceback.format_exc()))
 
-            event = event_line.pop_event()
         self.account.save()
         return self.account
 
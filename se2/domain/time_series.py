@@ -1,10 +1,16 @@
 # 该模块是为了解决时序数据定义、存储和查询问题
 from __future__ import annotations
+import bisect
+import hashlib
 import json
 import logging
+import threading
 from abc import ABCMeta, abstractmethod
-from typing import Dict, List, Type, Mapping
+from collections import OrderedDict
+from typing import Dict, List, Type, Mapping, Tuple, Iterator, Optional
 
+import numpy as np
+import pandas as pd
 import trading_calendars
 from pandas import Timestamp, DataFrame, Timedelta, Series
 from trading_calendars import TradingCalendar
@@ -116,41 +122,141 @@ class SingleCodeQueryCommand(HistoryDataQueryCommand):
     def minus(self, data_record: DataRecord) -> List:
         """
         要下载的数据减去已经存在的数据，就是增量的要下载的数据。
-        为了降低复杂度， 保证下载数据之后，数据库的数据要连续
+        本地缓存的数据可以是不连续的，所以只需要下载请求范围内没有被覆盖的空洞
         :param data_record:
         :return:
         """
-        small_start = self.start if self.start < data_record.start else data_record.start
-        big_end = self.end if self.end > data_record.end else data_record.end
-        increment_commands = []
-        if small_start < data_record.start:
-            increment_commands.append(SingleCodeQueryCommand(small_start, data_record.start, self.code))
-        if big_end > data_record.end:
-            increment_commands.append(SingleCodeQueryCommand(data_record.end, big_end, self.code))
-        return increment_commands
+        if self.start:
+            start = self.start
+        else:
+            # window模式没有start，只检查end之前最近的一段覆盖范围到end之间是否有空洞，更早的空洞跟最近的数据无关，不需要下载
+            i = bisect.bisect_right(data_record.coverage.starts, self.end) - 1
+            start = data_record.coverage.starts[i] if i >= 0 else self.end
+        return [SingleCodeQueryCommand(hole_start, hole_end, self.code)
+                for hole_start, hole_end in data_record.coverage.difference(start, self.end)]
 
-        pass
+
+class IntervalSet(object):
+    """
+    有序并且互不相交的闭区间的集合，用于记录本地已经缓存了的时间范围，各个操作都基于二分查找
+    """
+
+    def __init__(self, intervals: List[Tuple[Timestamp, Timestamp]] = None):
+        self.starts: List[Timestamp] = []
+        self.ends: List[Timestamp] = []
+        if intervals:
+            for start, end in intervals:
+                self.add(start, end)
+
+    def add(self, start: Timestamp, end: Timestamp):
+        """
+        并集，相交或者首尾相接的区间会合并成一个区间
+        """
+        if start > end:
+            raise RuntimeError("非法的区间")
+        # [lo, hi)是所有跟[start, end]相交或者相接的区间
+        lo = bisect.bisect_left(self.ends, start)
+        hi = bisect.bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+    def difference(self, start: Timestamp, end: Timestamp) -> List[Tuple[Timestamp, Timestamp]]:
+        """
+        [start, end]中没有被覆盖的部分
+        """
+        holes = []
+        p = start
+        i = bisect.bisect_left(self.ends, start)
+        while i < len(self.starts) and self.starts[i] <= end:
+            if self.starts[i] > p:
+                holes.append((p, self.starts[i]))
+            p = max(p, self.ends[i])
+            i += 1
+        if p < end:
+            holes.append((p, end))
+        return holes
+
+    def remove(self, start: Timestamp, end: Timestamp):
+        """
+        差集，去掉[start, end]之后剩下的部分仍然是闭区间，边界上的时刻保留在剩下的区间中，
+        这样按照首尾相接的区间依次去掉的时候，跟add一样可以保持连续
+        """
+        if start > end:
+            raise RuntimeError("非法的区间")
+        lo = bisect.bisect_left(self.ends, start)
+        hi = bisect.bisect_right(self.starts, end)
+        if lo >= hi:
+            return
+        starts, ends = [], []
+        if self.starts[lo] < start:
+            starts.append(self.starts[lo])
+            ends.append(start)
+        if self.ends[hi - 1] > end:
+            starts.append(end)
+            ends.append(self.ends[hi - 1])
+        self.starts[lo:hi] = starts
+        self.ends[lo:hi] = ends
+
+    def contains(self, start: Timestamp, end: Timestamp) -> bool:
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def __len__(self):
+        return len(self.starts)
 
 
 class DataRecord(object):
     """
-    本地缓存了的数据
+    本地缓存了的数据，coverage记录了某个code已经缓存了的所有时间范围
     """
 
-    def __init__(self, code: str, start: Timestamp, end: Timestamp):
+    def __init__(self, code: str, start: Timestamp, end: Timestamp,
+                 intervals: List[Tuple[Timestamp, Timestamp]] = None):
         self.code = code
-        self.start = start.tz_convert("Asia/Shanghai")
-        self.end = end.tz_convert("Asia/Shanghai")
+        if not intervals:
+            intervals = [(start, end)]
+        self.coverage = IntervalSet([(s.tz_convert("Asia/Shanghai"), e.tz_convert("Asia/Shanghai"))
+                                     for s, e in intervals])
+
+    @property
+    def start(self) -> Timestamp:
+        return self.coverage.starts[0]
+
+    @property
+    def end(self) -> Timestamp:
+        return self.coverage.ends[-1]
+
+    @property
+    def intervals(self) -> List[Tuple[Timestamp, Timestamp]]:
+        return list(self.coverage)
+
+    def version(self) -> str:
+        """
+        数据版本，缓存的范围变化之后版本也会变化
+        """
+        return hashlib.sha1(json.dumps([[s.value, e.value] for s, e in self.coverage]).encode()).hexdigest()[:16]
 
     def update(self, command: SingleCodeQueryCommand):
         if not isinstance(command, SingleCodeQueryCommand):
             raise RuntimeError("wrong type")
         if command.code != self.code:
             raise RuntimeError("wrong code")
-        if command.start < self.start:
-            self.start = command.start
-        if command.end > self.end:
-            self.end = command.end
+        self.coverage.add(command.start.tz_convert("Asia/Shanghai"), command.end.tz_convert("Asia/Shanghai"))
+
+    def remove(self, start: Timestamp, end: Timestamp):
+        """
+        [start, end]内的数据被删除之后，从缓存的范围中去掉，全部去掉之后调用方需要删除该DataRecord
+        """
+        self.coverage.remove(start.tz_convert("Asia/Shanghai"), end.tz_convert("Asia/Shanghai"))
+
+    def is_empty(self) -> bool:
+        return len(self.coverage) <= 0
 
 
 class Column(object):
@@ -198,6 +304,109 @@ class Column(object):
         raise RuntimeError("无法反序列化")
 
 
+class ValueCodec(object):
+    """
+    根据时序类型的columns构造的定长二进制编解码器，每行values被编码成固定长度的字节，时间列编码为UTC的纳秒数。
+    批量解码的时候把所有字节拼接起来，通过一次np.frombuffer解析成各个有类型的列
+    """
+    FORMATS = {float: '<f8', int: '<i8', Timestamp: '<i8'}
+
+    @classmethod
+    def supports(cls, columns: List[Column]) -> bool:
+        return len(columns) > 0 and all([column.tp in cls.FORMATS for column in columns])
+
+    def __init__(self, columns: List[Column]):
+        if not self.supports(columns):
+            raise RuntimeError("columns不支持定长编码")
+        self.columns = columns
+        self.dtype = np.dtype([(column.name, self.FORMATS[column.tp]) for column in columns])
+
+    def encode(self, values_list: List[Mapping]) -> bytes:
+        records = np.empty(len(values_list), dtype=self.dtype)
+        for column in self.columns:
+            col_values = [values[column.name] for values in values_list]
+            for value in col_values:
+                if type(value) != column.tp:
+                    raise RuntimeError("value类型不对")
+            if column.tp == Timestamp:
+                col_values = [value.value for value in col_values]
+            records[column.name] = col_values
+        return records.tobytes()
+
+    def decode(self, buffers: List[bytes]) -> Dict[str, object]:
+        """
+        批量解码，返回列名到列数据的映射，时间列会一次性的转换时区
+        """
+        buffer = b''.join(buffers)
+        if len(buffer) % self.dtype.itemsize != 0:
+            raise RuntimeError("数据编码与columns不一致")
+        records = np.frombuffer(buffer, dtype=self.dtype)
+        columns = {}
+        for column in self.columns:
+            if column.tp == Timestamp:
+                columns[column.name] = pd.to_datetime(records[column.name], utc=True).tz_convert('Asia/Shanghai')
+            else:
+                columns[column.name] = records[column.name]
+        return columns
+
+    def decode_values(self, buffers: List[bytes]) -> List[Dict[str, object]]:
+        columns = self.decode(buffers)
+        col_values = {name: list(arr) if isinstance(arr, pd.DatetimeIndex) else arr.tolist()
+                      for name, arr in columns.items()}
+        names = list(col_values.keys())
+        return [dict(zip(names, row)) for row in zip(*[col_values[name] for name in names])]
+
+
+def build_data_frame(visible_time: pd.DatetimeIndex, codes: object, columns: Mapping[str, object],
+                     column_names: List[str]) -> DataFrame:
+    """
+    使用列数据一次性的构建以[visible_time, code]为索引的DataFrame
+    :param visible_time: 已经转换好时区的时间
+    :param codes: 每一行数据对应的code
+    :param columns: 列名到列数据的映射，列数据是numpy数组或者DatetimeIndex
+    :param column_names: 列的顺序
+    :return:
+    """
+    index = pd.MultiIndex.from_arrays([visible_time, codes], names=['visible_time', 'code'])
+    # 不复制列数据，调用方需要保证传入的数组是新分配的，不能跟缓存共享内存
+    return DataFrame({name: columns[name] if hasattr(columns[name], 'dtype') else np.asarray(columns[name])
+                      for name in column_names}, index=index, columns=column_names, copy=False)
+
+
+def merge_code_streams(visible_time: pd.DatetimeIndex, codes: np.ndarray, columns: Dict[str, object]) \
+        -> Tuple[pd.DatetimeIndex, np.ndarray, Dict[str, object]]:
+    """
+    多个code的数据按照code的字母顺序首尾相接，每个code内部已经按照visible_time排好序，合并成按照[visible_time, code]排序的数据，
+    跟sort_index(level=0)的结果一致。稳定排序会识别出已经有序的段，相当于k路归并
+    """
+    order = np.argsort(visible_time.asi8, kind='stable')
+    return visible_time[order], codes[order], {name: arr[order] for name, arr in columns.items()}
+
+
+def dedupe_by_visible_time(data_list: List[TSData]) -> List[TSData]:
+    """
+    同一个code的数据中visible_time相同的只保留最后一条，并且按照visible_time排序
+    """
+    latest = {}
+    for ts_data in data_list:
+        latest[ts_data.visible_time] = ts_data
+    return [latest[visible_time] for visible_time in sorted(latest.keys())]
+
+
+def to_data_frame(ts_data_list: List[TSData], column_names: List[str]) -> DataFrame:
+    """
+    将TSData的列表转换成以[visible_time, code]为索引的DataFrame，仅用于数据供应商返回的数据
+    """
+    if len(ts_data_list) <= 0:
+        index = pd.MultiIndex.from_arrays([pd.DatetimeIndex([], tz='Asia/Shanghai'), []],
+                                          names=['visible_time', 'code'])
+        return DataFrame(index=index, columns=column_names)
+    df_data = []
+    for ts_data in ts_data_list:
+        df_data.append(ts_data.to_dict())
+    return DataFrame(data=df_data).set_index(['visible_time', 'code'])
+
+
 class TimeSeriesSubscriber(metaclass=ABCMeta):
     @abstractmethod
     def on_data(self, data: TSData):
@@ -306,10 +515,54 @@ class HistoryTimeSeriesType(TimeSeriesType, metaclass=ABCMeta):
     def should_cache(self):
         return True
 
+    def unique_visible_time(self):
+        """
+        同一个code的数据visible_time是否唯一。tick数据在同一秒内可能有多条，存储和读取的时候不能按照visible_time去重
+        """
+        return True
+
     @abstractmethod
     def load_history_data(self, command: HistoryDataQueryCommand) -> List[TSData]:
         pass
 
+    def load_history_df(self, command: HistoryDataQueryCommand) -> DataFrame:
+        """
+        直接返回以[visible_time, code]为索引的DataFrame，数据源本身就是列式数据的时候子类可以覆盖该方法，避免创建TSData
+        """
+        return to_data_frame(self.load_history_data(command), [column.name for column in self.columns()])
+
+    def ingestion_batch_span(self) -> Timedelta:
+        """
+        增量下载的时候每批数据覆盖的时间范围，每批数据下载完成之后会立即写入本地并推进DataRecord。
+        返回None表示整个区间一次下载
+        """
+        return None
+
+    def load_history_data_in_batches(self, command: SingleCodeQueryCommand) \
+            -> Iterator[Tuple[SingleCodeQueryCommand, List[TSData]]]:
+        """
+        分批下载一个code的历史数据，按照时间从前往后产生(该批覆盖的时间范围, 数据)。
+        默认按照ingestion_batch_span切分区间，子类可以覆盖该方法以数据源自身的分页方式产生批次
+        """
+        span = self.ingestion_batch_span()
+        if not span or not command.start:
+            yield command, self.load_history_data(command)
+            return
+        batch_start = command.start
+        while True:
+            batch_end = min(batch_start + span, command.end)
+            batch_command = SingleCodeQueryCommand(batch_start, batch_end, command.code, command.window)
+            batch_command.with_calendar(command.calendar)
+            data_list = self.load_history_data(batch_command)
+            if batch_end >= command.end:
+                yield batch_command, data_list
+                return
+            if not self.unique_visible_time():
+                # 相邻的批次首尾相接，visible_time不唯一的数据不能去重，边界上的数据留给下一批
+                data_list = [ts_data for ts_data in data_list if ts_data.visible_time < batch_end]
+            yield batch_command, data_list
+            batch_start = batch_end
+
     @abstractmethod
     def columns(self) -> List[Column]:
         pass
@@ -320,6 +573,8 @@ class HistoryTimeSeriesType(TimeSeriesType, metaclass=ABCMeta):
         for col in cols:
             col_map[col.name] = col
         self.column_map = col_map
+        # 所有列都是定长类型的时候，使用二进制编码代替json
+        self.codec: ValueCodec = ValueCodec(cols) if ValueCodec.supports(cols) else None
 
     def parse(self, provider_data: Mapping[str, object]):
         parsed_value = {}
@@ -361,56 +616,90 @@ class BarHistoryTimeSeriesType(HistoryTimeSeriesType, metaclass=ABCMeta):
 
     def current_price_in_history(self, codes, the_time: Timestamp, ts: TimeSeries) -> Mapping[str, CurrentPrice]:
         """
-        获取历史上某个时间点的价格，因为该时序类型是Bar类型，所以只能获取交易日开盘以及收盘的价格。 为了提高性能，该方法会使用内存缓存
+        获取历史上某个时间点的价格，因为该时序类型是Bar类型，所以只能获取交易日开盘以及收盘的价格。 为了提高性能，该方法会使用内存缓存，
+        每个code的价格保存在PriceIndex中，同一个时间点的查询结果也会缓存
         :param codes:
         :param the_time:
         :param ts:
         :return:
         """
+        if the_time != self.cp_memo_time:
+            self.cp_memo_time = the_time
+            self.cp_memo = {}
         ret = {}
         for code in codes:
-            if code not in self.cp_mem_cache:
-                self._rebuild_cp_cache(code, the_time, ts)
-            else:
-                price_df: DataFrame = self.cp_mem_cache[code]
-                if len(price_df.loc[the_time:]) < 1:
-                    self._rebuild_cp_cache(code, the_time, ts)
-
-            price_df: DataFrame = self.cp_mem_cache[code]
-            # build cache的时候会向前查询一段时间，如果以visible_time作为索引查询截止到某个时间的数据，返回为空的话，则这个时间为开盘时间
-            pre_df: DataFrame = price_df.loc[:the_time]
-            if len(pre_df) > 0 and (pre_df.iloc[-1].name[0] == the_time):
-                price = pre_df.iloc[-1]['close']
-                cp = CurrentPrice(self.name(), the_time, code,
-                                  {'price': price, 'ask_price': None, 'ask_size': None, 'bid_price': None,
-                                   'bid_size': None})
-            else:
-                ser: Series = price_df.loc[the_time:].iloc[0]
-                if ser['start_time'] == the_time:
-                    price = ser['open']
-                    cp = CurrentPrice(self.name(), the_time, code,
-                                      {'price': price, 'ask_price': None, 'ask_size': None, 'bid_price': None,
-                                       'bid_size': None})
-                else:
-                    raise RuntimeError("无法获取当前价格，时间:{}, code:{}".format(str(the_time), code))
-
-            ret[code] = cp
+            if code not in self.cp_memo:
+                self.cp_memo[code] = self._current_price(code, the_time, ts)
+            ret[code] = self.cp_memo[code]
         return ret
 
+    def _current_price(self, code: str, the_time: Timestamp, ts: TimeSeries) -> CurrentPrice:
+        t = the_time.value
+        if code not in self.cp_mem_cache or not self.cp_mem_cache[code].covers(t):
+            self._rebuild_cp_cache(code, the_time, ts)
+        price_index: PriceIndex = self.cp_mem_cache[code]
+        # 如果有visible_time等于该时间的bar，则这个时间为收盘时间，否则需要下一个bar的开始时间等于该时间，即开盘时间
+        i = price_index.visible_time.searchsorted(t, side='right')
+        if i > 0 and price_index.visible_time[i - 1] == t:
+            price = price_index.close[i - 1]
+        elif i < len(price_index.visible_time) and price_index.start_time[i] == t:
+            price = price_index.open[i]
+        else:
+            raise RuntimeError("无法获取当前价格，时间:{}, code:{}".format(str(the_time), code))
+        return CurrentPrice(self.name(), the_time, code,
+                            {'price': float(price), 'ask_price': None, 'ask_size': None, 'bid_price': None,
+                             'bid_size': None})
+
     def _rebuild_cp_cache(self, code: str, the_time: Timestamp, ts: TimeSeries):
-        start = the_time - self.current_price_change_start_offset
-        end = the_time + self.current_price_change_end_offset
-        command = HistoryDataQueryCommand(start, end, [code])
+        self.preload_current_price([code], the_time - self.current_price_change_start_offset,
+                                   the_time + self.current_price_change_end_offset, ts)
+
+    def preload_current_price(self, codes: List[str], start: Timestamp, end: Timestamp, ts: TimeSeries):
+        """
+        一次性加载[start, end]内的价格，回测开始的时候按照整个回测区间预加载，之后的查询只需要在数组中二分查找
+        """
+        command = HistoryDataQueryCommand(start, end, codes)
         df: DataFrame = ts.history_data(command, from_local=True)
-        self.cp_mem_cache[code] = df
+        df_codes = df.index.get_level_values(1).values
+        for code in codes:
+            self.cp_mem_cache[code] = PriceIndex.from_data_frame(df[df_codes == code], start, end)
 
     def __init__(self, current_price_change_start_offset: Timedelta, current_price_change_end_offset: Timedelta):
         super().__init__()
-        self.cp_mem_cache: Dict[str, DataFrame] = {}
+        self.cp_mem_cache: Dict[str, PriceIndex] = {}
+        self.cp_memo_time: Timestamp = None
+        self.cp_memo: Dict[str, CurrentPrice] = {}
         self.current_price_change_start_offset = current_price_change_start_offset
         self.current_price_change_end_offset = current_price_change_end_offset
 
 
+class PriceIndex(object):
+    """
+    一个code在[start, end]内的bar的开盘和收盘价格，按照visible_time排序，时间都是UTC纳秒
+    """
+
+    def __init__(self, start: int, end: int, visible_time: np.ndarray, start_time: np.ndarray, open: np.ndarray,
+                 close: np.ndarray):
+        self.start = start
+        self.end = end
+        self.visible_time = visible_time
+        self.start_time = start_time
+        self.open = open
+        self.close = close
+
+    @classmethod
+    def from_data_frame(cls, df: DataFrame, start: Timestamp, end: Timestamp) -> PriceIndex:
+        return PriceIndex(start.value, end.value, pd.DatetimeIndex(df.index.get_level_values(0)).asi8,
+                          pd.DatetimeIndex(df['start_time']).asi8, df['open'].values.astype(np.float64),
+                          df['close'].values.astype(np.float64))
+
+    def covers(self, t: int) -> bool:
+        """
+        t在加载的范围内并且之后还有bar，否则需要以t为基准重新加载
+        """
+        return self.start <= t and len(self.visible_time) > 0 and self.visible_time[-1] >= t
+
+
 class RTTimeSeriesType(TimeSeriesType, metaclass=ABCMeta):
     @abstractmethod
     def current_price(self, codes) -> Dict[str, CurrentPrice]:
@@ -508,32 +797,77 @@ class TimeSeries(object):
         if not self.tp.should_cache() and from_local:
             logging.warning("该时序类型不支持缓存，将从服务器获取")
             from_local = False
-        ts_data_list: List[TSData] = []
+        # 只缓存从本地获取的按照区间查询的结果，重复数据没有去除的结果不缓存
+        cacheable = from_local and command.start and (remove_duplicated or not self.tp.unique_visible_time())
+        cache: HistoryDataCache = BeanContainer.findBean(HistoryDataCache) if cacheable else None
+        shared_cache: SharedHistoryDataCache = BeanContainer.findBean(SharedHistoryDataCache) if cacheable else None
+        tiered_access: TieredDataAccess = BeanContainer.findBean(TieredDataAccess) if cacheable else None
+        presorted = False
         if not from_local:
-            ts_data_list = self.tp.load_history_data(command)
+            df = self.tp.load_history_df(command)
+        elif tiered_access:
+            df = tiered_access.history_data(self, command)
+            logging.debug("分层读取的命中情况:{}".format(tiered_access.stats()))
+            cache, shared_cache = None, None
         else:
-            if not self.is_local_cached(command):
-                logging.info("本地数据没有缓存，将会下载")
-                self.download_data(command)
+            if cache:
+                cached_df = cache.get_df(self.name, command, self.tp.columns())
+                if cached_df is not None:
+                    return cached_df
             ts_data_repo: TSDataRepo = BeanContainer.getBean(TSDataRepo)
-            ts_data_list = ts_data_repo.query(self.name, command)
-
-        # change to DataFrame, MultiIndex (visible_time, code)
-        df_data = []
-        for ts_data in ts_data_list:
-            df_data.append(ts_data.to_dict())
+            increment_commands = self.increment_commands(command)
+            if shared_cache and len(increment_commands) <= 0:
+                shared_df = self._shared_cache_get(shared_cache, command)
+                if shared_df is not None:
+                    if cache:
+                        cache.put_df(self.name, command, shared_df, self.tp.columns())
+                    return shared_df
+            if len(increment_commands) <= 0:
+                # 存储中的数据已经去重并且排好序
+                df = ts_data_repo.query_df(self.name, command)
+                presorted = True
+            else:
+                logging.info("本地数据没有缓存，将会下载")
+                # 先读取已经缓存的部分，新下载的数据在写入本地之后直接跟缓存的部分合并返回，不再从本地读取一遍。
+                # 跟本地存储一致，重复的数据以新下载的为准，所以新下载的数据放在前面
+                cached_df = ts_data_repo.query_df(self.name, command) \
+                    if self.has_cached_part(command, increment_commands) else None
+                df = self.download_data(command, increment_commands)
+                if cached_df is not None:
+                    df = pd.concat([df, cached_df])
 
-        df = DataFrame(data=df_data).set_index(['visible_time', 'code'])
         # 去重
-        if remove_duplicated:
+        unique = self.tp.unique_visible_time()
+        if remove_duplicated and unique and not presorted:
             df = df[~df.index.duplicated()]
         # 由于下载是批量下载，所以下载的数据可能比想要下载的数据要多
         if command.start and command.end:
-            return df.sort_index(level=0).loc[command.start: command.end]
+            if not presorted:
+                df = df.sort_index(level=0).loc[command.start: command.end]
+            if cache:
+                cache.put_df(self.name, command, df, self.tp.columns())
+            if shared_cache:
+                for code, (visible_time, data) in split_data_frame(df, command.codes, self.tp.columns()).items():
+                    shared_cache.put(self.name, code, command.start, command.end, self.data_record[code].version(),
+                                     visible_time, data)
+            return df
         else:
-            df = df.sort_index(level=0)
+            if not presorted:
+                df = df.sort_index(level=0)
+            if not unique:
+                return df.iloc[-command.window:]
             return df.loc[df.index.get_level_values(0)[-command.window:]]
 
+    def _shared_cache_get(self, shared_cache: SharedHistoryDataCache, command: HistoryDataQueryCommand) \
+            -> Optional[DataFrame]:
+        parts_by_code = {}
+        for code in command.codes:
+            part = shared_cache.get(self.name, code, command.start, command.end, self.data_record[code].version())
+            if part is None:
+                return None
+            parts_by_code[code] = [part]
+        return assemble_data_frame(parts_by_code, self.tp.columns())
+
     def subscribe(self, subscriber: TimeSeriesSubscriber, codes: List[str]):
         if not isinstance(self.tp, RTTimeSeriesType):
             raise RuntimeError("不支持订阅")
@@ -544,37 +878,57 @@ class TimeSeries(object):
             raise RuntimeError('不支持反订阅')
         self.tp.unsub_func(subscriber, codes)
 
-    def download_data(self, command: HistoryDataQueryCommand):
+    def download_data(self, command: HistoryDataQueryCommand,
+                      increment_commands: List[SingleCodeQueryCommand] = None, collect: bool = True) -> DataFrame:
+        """
+        下载本地没有缓存的数据并写入本地。每批数据到达之后立即写入本地，并且将DataRecord推进到该批的结束位置作为检查点，
+        下载中断之后再次下载只会下载检查点之后没有覆盖的部分
+        :param command:
+        :param increment_commands: 已经计算好的增量请求，为空的时候根据command计算
+        :param collect: 是否返回新下载的数据，只预先下载数据的时候不需要返回，内存占用只跟单批数据的大小有关
+        :return: 新下载的数据
+        """
         if not isinstance(self.tp, HistoryTimeSeriesType):
             raise RuntimeError("非法的tsType")
-        increment_commands = []
-        commands: List[SingleCodeQueryCommand] = command.to_single_code_command()
-        for command in commands:
-            if command.code in self.data_record:
-                increment_commands.extend(command.minus(self.data_record[command.code]))
-            else:
-                increment_commands.append(command)
+        if increment_commands is None:
+            increment_commands = self.increment_commands(command)
 
-        total_count = 0
+        column_names = [column.name for column in self.tp.columns()]
+        dfs: List[DataFrame] = []
+        total = 0
+        ts_data_repo: TSDataRepo = BeanContainer.getBean(TSDataRepo)
         for i_command in increment_commands:
-
-            data_list: List[TSData] = self.tp.load_history_data(i_command)
-            ts_data_repo: TSDataRepo = BeanContainer.getBean(TSDataRepo)
-            ts_data_repo.save(data_list)
-            if i_command.code in self.data_record:
-                self.data_record[i_command.code].update(i_command)
-            else:
-                self.data_record[i_command.code] = DataRecord(i_command.code, i_command.start, i_command.end)
-            self.save()
-            total_count += len(data_list)
-
-        logging.info("下载完成， 共下载了{}个数据".format(total_count))
+            for batch_command, data_list in self.tp.load_history_data_in_batches(i_command):
+                ts_data_repo.save(data_list)
+                if i_command.code in self.data_record:
+                    self.data_record[i_command.code].update(batch_command)
+                else:
+                    self.data_record[i_command.code] = DataRecord(i_command.code, batch_command.start,
+                                                                  batch_command.end)
+                # 只保存这个code的DataRecord，不会覆盖其他任务(保留策略、批量导入)同时对其他code的修改
+                self.save_record(i_command.code)
+                total += len(data_list)
+                if collect:
+                    dfs.append(to_data_frame(data_list, column_names))
+                logging.info("{}的数据已经下载到{}".format(i_command.code, batch_command.end))
+
+        logging.info("下载完成， 共下载了{}个数据".format(total))
+        if len(dfs) <= 0:
+            return to_data_frame([], column_names)
+        return pd.concat(dfs)
 
     def save(self):
         time_series_repo: TimeSeriesRepo = BeanContainer.getBean(TimeSeriesRepo)
         time_series_repo.save(self)
 
-    def is_local_cached(self, command: HistoryDataQueryCommand):
+    def save_record(self, code: str):
+        time_series_repo: TimeSeriesRepo = BeanContainer.getBean(TimeSeriesRepo)
+        time_series_repo.save_record(self, code)
+
+    def increment_commands(self, command: HistoryDataQueryCommand) -> List[SingleCodeQueryCommand]:
+        """
+        本地没有缓存的部分
+        """
         increment_commands = []
         commands: List[SingleCodeQueryCommand] = command.to_single_code_command()
         for command in commands:
@@ -582,7 +936,23 @@ class TimeSeries(object):
                 increment_commands.extend(command.minus(self.data_record[command.code]))
             else:
                 increment_commands.append(command)
-        return len(increment_commands) <= 0
+        return increment_commands
+
+    def has_cached_part(self, command: HistoryDataQueryCommand,
+                        increment_commands: List[SingleCodeQueryCommand]) -> bool:
+        """
+        command的范围内是否有本地已经缓存的数据，如果增量请求覆盖了所有code的整个范围，说明本地什么都没有
+        """
+        if not command.start:
+            return True
+        missing = {(c.code, c.start, c.end) for c in increment_commands}
+        for code in command.codes:
+            if (code, command.start, command.end) not in missing:
+                return True
+        return False
+
+    def is_local_cached(self, command: HistoryDataQueryCommand):
+        return len(self.increment_commands(command)) <= 0
 
 
 class TSTypeRegistry(object):
@@ -611,6 +981,63 @@ class TimeSeriesRepo(metaclass=ABCMeta):
     def save(self, ts: TimeSeries):
         pass
 
+    def save_record(self, ts: TimeSeries, code: str):
+        """
+        只保存一个code的DataRecord，ts中已经没有这个code的时候删除它的DataRecord。并发的修改同一个TimeSeries的不同code时，
+        不会用手上旧的TimeSeries覆盖其他code的修改。默认保存整个TimeSeries，子类应该只写入这一个code
+        """
+        self.save(ts)
+
+
+class CachedTimeSeriesRepo(TimeSeriesRepo):
+    """
+    在TimeSeriesRepo前面增加进程内的缓存，避免每次获取TimeSeries都需要访问数据库。save的时候会同时更新缓存，
+    多进程部署的时候，其他进程对TimeSeries的修改无法感知，可以通过ttl来让缓存定期过期
+    """
+
+    def __init__(self, delegate: TimeSeriesRepo, ttl: Timedelta = None):
+        self.delegate = delegate
+        self.ttl = ttl
+        self.cache: Dict[str, Tuple[TimeSeries, Timestamp]] = {}
+        self.lock = threading.Lock()
+
+    def find_one(self, name):
+        with self.lock:
+            if name in self.cache:
+                ts, load_time = self.cache[name]
+                if not self.ttl or Timestamp.now(tz='Asia/Shanghai') - load_time < self.ttl:
+                    return ts
+        ts = self.delegate.find_one(name)
+        with self.lock:
+            self.cache[name] = (ts, Timestamp.now(tz='Asia/Shanghai'))
+        return ts
+
+    def save(self, ts: TimeSeries):
+        self.delegate.save(ts)
+        with self.lock:
+            self.cache[ts.name] = (ts, Timestamp.now(tz='Asia/Shanghai'))
+
+    def save_record(self, ts: TimeSeries, code: str):
+        self.delegate.save_record(ts, code)
+        with self.lock:
+            if ts.name in self.cache:
+                cached, load_time = self.cache[ts.name]
+                # 缓存过期之后重新加载过，缓存中是另外一个对象，只同步这一个code
+                if code in ts.data_record:
+                    cached.data_record[code] = ts.data_record[code]
+                else:
+                    cached.data_record.pop(code, None)
+
+    def invalidate(self, name: str = None):
+        """
+        name为空的时候清空所有的缓存
+        """
+        with self.lock:
+            if name:
+                self.cache.pop(name, None)
+            else:
+                self.cache.clear()
+
 
 class TSDataRepo(metaclass=ABCMeta):
     @abstractmethod
@@ -621,6 +1048,628 @@ class TSDataRepo(metaclass=ABCMeta):
     def query(self, ts_name, command):
         pass
 
+    def query_df(self, ts_name, command) -> DataFrame:
+        """
+        直接返回以[visible_time, code]为索引的DataFrame，子类应该尽量从列数据直接构建，避免为每一行数据创建TSData。
+        写入的时候已经保证了每个code的visible_time唯一(visible_time不唯一的时序类型除外)并且有序，
+        子类返回的数据需要按照[visible_time, code]排好序，history_data不再去重和排序
+        """
+        func = TSTypeRegistry.find_function(ts_name)
+        data_list = sorted(self.query(ts_name, command), key=lambda ts_data: (ts_data.visible_time, ts_data.code))
+        return to_data_frame(data_list, [column.name for column in func.columns()])
+
+    def delete(self, ts_name: str, code: str, start: Timestamp, end: Timestamp):
+        """
+        删除一个code在[start, end]内的数据
+        """
+        raise RuntimeError("不支持删除数据")
+
+    def save_df(self, ts_name, df: DataFrame):
+        """
+        保存以[visible_time, code]为索引的DataFrame，默认转换成TSData之后保存，子类可以直接保存列数据
+        """
+        func = TSTypeRegistry.find_function(ts_name)
+        self.save(from_data_frame(ts_name, df, func.columns()))
+
+
+def from_data_frame(ts_name: str, df: DataFrame, columns: List[Column]) -> List[TSData]:
+    """
+    to_data_frame的逆操作
+    """
+    values_by_name = {}
+    for column in columns:
+        values = df[column.name]
+        values_by_name[column.name] = list(pd.DatetimeIndex(values)) if column.tp == Timestamp else values.tolist()
+    names = list(values_by_name.keys())
+    return [TSData(ts_name, visible_time, code, dict(zip(names, row)))
+            for (visible_time, code), row in zip(df.index, zip(*[values_by_name[name] for name in names]))]
+
+
+class TailRows(object):
+    """
+    一个code最近的数据，按照visible_time排好序。保证存储中visible_time不早于第一条数据的数据都在这里，
+    complete为True的时候表示存储中的全部数据都在这里
+    """
+
+    def __init__(self, rows: List[TSData], complete: bool):
+        self.times: List[Timestamp] = [row.visible_time for row in rows]
+        self.rows: List[TSData] = rows
+        self.complete = complete
+
+    def upsert(self, data: TSData, max_size: int):
+        if len(self.times) > 0 and data.visible_time < self.times[0] and not self.complete:
+            # 比缓存的范围更早的数据不影响最近的数据
+            return
+        idx = bisect.bisect_left(self.times, data.visible_time)
+        if idx < len(self.times) and self.times[idx] == data.visible_time:
+            self.rows[idx] = data
+            return
+        self.times.insert(idx, data.visible_time)
+        self.rows.insert(idx, data)
+        if len(self.rows) > max_size:
+            del self.times[0], self.rows[0]
+            self.complete = False
+
+    def last(self, end: Timestamp, window: int) -> Optional[List[TSData]]:
+        """
+        end之前(包括end)最近的window条数据，缓存的数据不够的时候返回None
+        """
+        hi = bisect.bisect_right(self.times, end)
+        if hi < window and not self.complete:
+            return None
+        return self.rows[max(hi - window, 0): hi]
+
+
+class TailCache(object):
+    """
+    每个(时序类型, code)最近max_size条数据的缓存，用来直接响应window模式的查询。
+    某个code第一次查询的时候从存储中加载，之后每次保存数据以及收到实时数据的时候增量更新。
+    只缓存visible_time唯一的时序类型，tick这类按照范围覆盖写入的数据不缓存
+    """
+
+    def __init__(self, max_size: int = 500):
+        self.max_size = max_size
+        self.tails: Dict[Tuple[str, str], TailRows] = {}
+        self.lock = threading.Lock()
+
+    def accept(self, ts_name: str) -> bool:
+        func = TSTypeRegistry.find_function(ts_name)
+        return isinstance(func, HistoryTimeSeriesType) and func.unique_visible_time()
+
+    def get(self, ts_name: str, code: str, end: Timestamp, window: int) -> Optional[List[TSData]]:
+        if window > self.max_size:
+            return None
+        with self.lock:
+            tail = self.tails.get((ts_name, code))
+            return tail.last(end, window) if tail else None
+
+    def load(self, ts_name: str, code: str, rows: List[TSData]):
+        """
+        rows是存储中最近的max_size条数据
+        """
+        with self.lock:
+            self.tails[(ts_name, code)] = TailRows(sorted(rows, key=lambda row: row.visible_time),
+                                                   len(rows) < self.max_size)
+
+    def update(self, ts_data_list: List[TSData]):
+        """
+        只更新已经加载过的code，没有加载过的code在第一次查询的时候会从存储中加载
+        """
+        with self.lock:
+            for ts_data in ts_data_list:
+                tail = self.tails.get((ts_data.ts_type_name, ts_data.code))
+                if tail:
+                    tail.upsert(ts_data, self.max_size)
+
+    def invalidate(self, ts_name: str, codes: List[str] = None):
+        with self.lock:
+            for key in list(self.tails.keys()):
+                if key[0] == ts_name and (codes is None or key[1] in codes):
+                    self.tails.pop(key)
+
+
+class TailCachedTSDataRepo(TSDataRepo):
+    """
+    在TSDataRepo前面增加最近数据的缓存，window模式的查询直接从内存读取
+    """
+
+    def __init__(self, delegate: TSDataRepo, tail_cache: TailCache):
+        self.delegate = delegate
+        self.tail_cache = tail_cache
+
+    def save(self, ts_data_list: List[TSData]):
+        self.delegate.save(ts_data_list)
+        self.tail_cache.update(ts_data_list)
+
+    def save_df(self, ts_name, df: DataFrame):
+        self.delegate.save_df(ts_name, df)
+        self.tail_cache.invalidate(ts_name, list(df.index.get_level_values(1).unique()))
+
+    def delete(self, ts_name: str, code: str, start: Timestamp, end: Timestamp):
+        self.delegate.delete(ts_name, code, start, end)
+        self.tail_cache.invalidate(ts_name, [code])
+
+    def query(self, ts_name, command):
+        return self.delegate.query(ts_name, command)
+
+    def query_df(self, ts_name, command) -> DataFrame:
+        if command.start or not self.tail_cache.accept(ts_name):
+            return self.delegate.query_df(ts_name, command)
+        func = TSTypeRegistry.find_function(ts_name)
+        rows = []
+        missing_codes = []
+        for code in command.codes:
+            tail = self.tail_cache.get(ts_name, code, command.end, command.window)
+            if tail is None:
+                missing_codes.append(code)
+            else:
+                rows.extend(tail)
+        if len(missing_codes) > 0:
+            if command.window > self.tail_cache.max_size:
+                return self.delegate.query_df(ts_name, command)
+            # 加载存储中最近的数据，而不只是end之前的数据，这样缓存才能响应之后end更晚的查询
+            load_end = max(command.end, Timestamp.now(tz='Asia/Shanghai'))
+            load_command = HistoryDataQueryCommand(None, load_end, missing_codes, self.tail_cache.max_size)
+            df = self.delegate.query_df(ts_name, load_command)
+            loaded = from_data_frame(ts_name, df, func.columns())
+            uncovered_codes = []
+            for code in missing_codes:
+                self.tail_cache.load(ts_name, code, [row for row in loaded if row.code == code])
+                tail = self.tail_cache.get(ts_name, code, command.end, command.window)
+                if tail is None:
+                    uncovered_codes.append(code)
+                else:
+                    rows.extend(tail)
+            if len(uncovered_codes) > 0:
+                # end比缓存的数据早太多
+                uncovered_command = HistoryDataQueryCommand(None, command.end, uncovered_codes, command.window)
+                rows.extend(self.delegate.query(ts_name, uncovered_command))
+        rows.sort(key=lambda row: (row.visible_time, row.code))
+        return to_data_frame(rows, [column.name for column in func.columns()])
+
+
+def split_data_frame(df: DataFrame, codes: List[str], columns: List[Column]) \
+        -> Dict[str, Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+    """
+    将以[visible_time, code]为索引的DataFrame按照code拆分成列数据，visible_time和时间列转换成UTC纳秒
+    """
+    level_codes = df.index.get_level_values(1)
+    level_times = df.index.get_level_values(0)
+    res = {}
+    for code in codes:
+        mask = np.asarray(level_codes == code)
+        visible_time = np.asarray(level_times[mask].asi8)
+        data = {}
+        for column in columns:
+            values = df[column.name].values[mask]
+            data[column.name] = pd.to_datetime(values, utc=True).asi8 if column.tp == Timestamp else values
+        res[code] = (visible_time, data)
+    return res
+
+
+def assemble_data_frame(parts_by_code: Mapping[str, List[Tuple[np.ndarray, Dict[str, np.ndarray]]]],
+                        columns: List[Column]) -> DataFrame:
+    """
+    split_data_frame的逆操作，每个code的数据需要按照visible_time排好序，
+    返回的DataFrame跟sort_index(level=0)的顺序保持一致，先按照时间，再按照code
+    """
+    visible_times, codes, ranks, column_parts = [], [], [], {column.name: [] for column in columns}
+    code_rank = {code: rank for rank, code in enumerate(sorted(parts_by_code.keys()))}
+    for code, parts in parts_by_code.items():
+        for visible_time, part_columns in parts:
+            visible_times.append(visible_time)
+            codes.append(np.full(len(visible_time), code, dtype=object))
+            ranks.append(np.full(len(visible_time), code_rank[code], dtype=np.int64))
+            for column in columns:
+                column_parts[column.name].append(part_columns[column.name])
+    if len(visible_times) <= 0:
+        return to_data_frame([], [column.name for column in columns])
+    if len(visible_times) == 1:
+        # 只有一段数据的时候已经是有序的，不需要排序。数组来自缓存(可能是只读的内存映射)，需要复制一份，
+        # 修改返回的DataFrame不能影响缓存
+        visible_time, code_arr = np.array(visible_times[0]), codes[0]
+        order = slice(None)
+    else:
+        visible_time, code_arr = np.concatenate(visible_times), np.concatenate(codes)
+        order = np.lexsort((np.concatenate(ranks), visible_time))
+    data = {}
+    for column in columns:
+        parts = column_parts[column.name]
+        arr = np.array(parts[0]) if len(parts) == 1 else np.concatenate(parts)[order]
+        data[column.name] = pd.to_datetime(arr, utc=True).tz_convert('Asia/Shanghai') \
+            if column.tp == Timestamp else arr
+    return build_data_frame(pd.to_datetime(visible_time[order], utc=True).tz_convert('Asia/Shanghai'),
+                            code_arr[order], data, [column.name for column in columns])
+
+
+class CachedSegment(object):
+    """
+    缓存的一个code在一段连续时间范围[start, end]内的全部数据，visible_time和时间列都是UTC纳秒，按照visible_time排好序
+    """
+
+    def __init__(self, start: int, end: int, visible_time: np.ndarray, columns: Dict[str, np.ndarray]):
+        self.start = start
+        self.end = end
+        self.visible_time = visible_time
+        self.columns = columns
+        self.nbytes = visible_time.nbytes + sum([arr.nbytes for arr in columns.values()])
+
+    def slice(self, start: int, end: int) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        lo = np.searchsorted(self.visible_time, start, side='left')
+        hi = np.searchsorted(self.visible_time, end, side='right')
+        return self.visible_time[lo: hi], {name: arr[lo: hi] for name, arr in self.columns.items()}
+
+    def merge(self, other: CachedSegment) -> CachedSegment:
+        """
+        两个相交或者相接的缓存段合并成一个，other的范围内以other的数据为准
+        """
+        before = np.searchsorted(self.visible_time, other.start, side='left')
+        after = np.searchsorted(self.visible_time, other.end, side='right')
+        visible_time = np.concatenate([self.visible_time[:before], other.visible_time, self.visible_time[after:]])
+        columns = {name: np.concatenate([self.columns[name][:before], arr, self.columns[name][after:]])
+                   for name, arr in other.columns.items()}
+        return CachedSegment(min(self.start, other.start), max(self.end, other.end), visible_time, columns)
+
+
+class HistoryDataCache(object):
+    """
+    TimeSeries.history_data结果的进程内缓存，按照(时序类型, code)缓存若干段互不相交的时间范围内的有类型的列数据。
+    查询范围被缓存完全覆盖的时候，通过二分查找切片直接返回；新缓存的范围跟已有的范围相交或者相接的时候会合并成一段。
+    以缓存段为单位按照LRU淘汰，总的内存占用不超过max_bytes
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.segments: Dict[Tuple[str, str], List[CachedSegment]] = {}
+        # 每个(时序类型, code)的缓存段的起始时间，跟segments一一对应，用于lookup的时候二分查找
+        self.starts: Dict[Tuple[str, str], List[int]] = {}
+        self.lru: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, ts_name: str, code: str, start: Timestamp, end: Timestamp) \
+            -> Tuple[List[Tuple[np.ndarray, Dict[str, np.ndarray]]], List[Tuple[Timestamp, Timestamp]]]:
+        """
+        返回[start, end]内已经缓存的数据切片，以及没有缓存的时间范围
+        """
+        start_ns, end_ns = start.value, end.value
+        parts = []
+        holes = []
+        with self.lock:
+            segments = self.segments.get((ts_name, code), [])
+            cursor = start_ns
+            idx = max(bisect.bisect_right(self.starts.get((ts_name, code), []), start_ns) - 1, 0)
+            for segment in segments[idx:]:
+                if segment.start > end_ns:
+                    break
+                if segment.end < cursor:
+                    continue
+                if segment.start > cursor:
+                    holes.append((cursor, segment.start))
+                parts.append(segment.slice(cursor, end_ns))
+                self.lru.move_to_end((ts_name, code, segment.start))
+                cursor = segment.end
+            if cursor < end_ns or len(parts) <= 0:
+                holes.append((cursor, end_ns))
+        return parts, [(Timestamp(hole_start, tz='UTC').tz_convert('Asia/Shanghai'),
+                        Timestamp(hole_end, tz='UTC').tz_convert('Asia/Shanghai')) for hole_start, hole_end in holes]
+
+    def put(self, ts_name: str, code: str, start: Timestamp, end: Timestamp, visible_time: np.ndarray,
+            columns: Dict[str, np.ndarray]):
+        """
+        缓存一个code在[start, end]内的全部数据，visible_time需要排好序
+        """
+        new_segment = CachedSegment(start.value, end.value, visible_time, columns)
+        if new_segment.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            segments = self.segments.get((ts_name, code), [])
+            kept = []
+            for segment in segments:
+                if segment.end < new_segment.start or segment.start > new_segment.end:
+                    kept.append(segment)
+                else:
+                    new_segment = segment.merge(new_segment)
+                    self._remove(ts_name, code, segment)
+            kept.append(new_segment)
+            kept.sort(key=lambda segment: segment.start)
+            self._set_segments((ts_name, code), kept)
+            self.lru[(ts_name, code, new_segment.start)] = new_segment
+            self.nbytes += new_segment.nbytes
+            while self.nbytes > self.max_bytes and len(self.lru) > 1:
+                (evict_ts_name, evict_code, _), segment = next(iter(self.lru.items()))
+                self._remove(evict_ts_name, evict_code, segment)
+                self._set_segments((evict_ts_name, evict_code),
+                                   [kept_segment for kept_segment in self.segments[(evict_ts_name, evict_code)]
+                                    if kept_segment is not segment])
+
+    def _set_segments(self, key: Tuple[str, str], segments: List[CachedSegment]):
+        self.segments[key] = segments
+        self.starts[key] = [segment.start for segment in segments]
+
+    def _remove(self, ts_name: str, code: str, segment: CachedSegment):
+        self.lru.pop((ts_name, code, segment.start), None)
+        self.nbytes -= segment.nbytes
+
+    def invalidate(self, ts_name: str, code: str = None, start: Timestamp = None, end: Timestamp = None):
+        """
+        清除跟[start, end]相交的缓存段，没有指定范围的时候清除全部
+        """
+        start_ns = start.value if start is not None else None
+        end_ns = end.value if end is not None else None
+        with self.lock:
+            for key in [key for key in self.segments.keys() if key[0] == ts_name and (not code or key[1] == code)]:
+                kept = []
+                for segment in self.segments[key]:
+                    before = start_ns is not None and segment.end < start_ns
+                    after = end_ns is not None and segment.start > end_ns
+                    if before or after:
+                        kept.append(segment)
+                    else:
+                        self._remove(key[0], key[1], segment)
+                self._set_segments(key, kept)
+
+    def get_df(self, ts_name: str, command: HistoryDataQueryCommand, columns: List[Column]) -> Optional[DataFrame]:
+        """
+        command的所有code都被缓存完全覆盖的时候，返回按照[visible_time, code]排好序的DataFrame，否则返回None
+        """
+        parts_by_code = {}
+        for code in command.codes:
+            parts, holes = self.lookup(ts_name, code, command.start, command.end)
+            if len(holes) > 0:
+                return None
+            parts_by_code[code] = parts
+        return assemble_data_frame(parts_by_code, columns)
+
+    def put_df(self, ts_name: str, command: HistoryDataQueryCommand, df: DataFrame, columns: List[Column]):
+        """
+        缓存history_data的结果，df需要是command范围内的全部数据并且按照visible_time排好序
+        """
+        for code, (visible_time, data) in split_data_frame(df, command.codes, columns).items():
+            self.put(ts_name, code, command.start, command.end, visible_time, data)
+
+
+class SharedHistoryDataCache(metaclass=ABCMeta):
+    """
+    跨进程共享的history_data结果缓存，缓存的是一个code在某个时间范围内某个数据版本的全部数据，
+    数据版本变化之后旧的缓存不会再被命中
+    """
+
+    @abstractmethod
+    def get(self, ts_name: str, code: str, start: Timestamp, end: Timestamp, version: str) \
+            -> Optional[Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+        pass
+
+    @abstractmethod
+    def put(self, ts_name: str, code: str, start: Timestamp, end: Timestamp, version: str,
+            visible_time: np.ndarray, columns: Dict[str, np.ndarray]):
+        pass
+
+    @abstractmethod
+    def invalidate(self, ts_name: str, code: str, start: Timestamp, end: Timestamp):
+        """
+        删除一个code跟[start, end]相交的所有版本的数据
+        """
+        pass
+
+
+class DataTier(metaclass=ABCMeta):
+    """
+    分层数据访问中的一层。每一层只返回自己已有的数据以及缺失的时间范围，缺失的部分由下一层提供，并且回填到本层
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    def lookup(self, ts: TimeSeries, command: SingleCodeQueryCommand) \
+            -> Tuple[Optional[DataFrame], List[SingleCodeQueryCommand]]:
+        """
+        返回本层已有的数据，以及没有覆盖的时间范围
+        """
+        pass
+
+    @abstractmethod
+    def fill(self, ts: TimeSeries, command: SingleCodeQueryCommand, df: DataFrame):
+        """
+        将下一层返回的command范围内的全部数据回填到本层
+        """
+        pass
+
+
+class MemoryTier(DataTier):
+    def __init__(self, cache: HistoryDataCache):
+        super().__init__('memory')
+        self.cache = cache
+
+    def lookup(self, ts, command):
+        parts, holes = self.cache.lookup(ts.name, command.code, command.start, command.end)
+        df = assemble_data_frame({command.code: parts}, ts.tp.columns()) if len(parts) > 0 else None
+        return df, [SingleCodeQueryCommand(start, end, command.code) for start, end in holes]
+
+    def fill(self, ts, command, df):
+        self.cache.put_df(ts.name, command, df.sort_index(level=0), ts.tp.columns())
+
+
+class StorageTier(DataTier):
+    """
+    持久化存储的一层，本层覆盖的范围由本层自己的TimeSeriesRepo记录
+    """
+
+    def __init__(self, name: str, time_series_repo: TimeSeriesRepo, ts_data_repo: TSDataRepo):
+        super().__init__(name)
+        self.time_series_repo = time_series_repo
+        self.ts_data_repo = ts_data_repo
+
+    def lookup(self, ts, command):
+        record: TimeSeries = self.time_series_repo.find_one(ts.name)
+        if command.code not in record.data_record:
+            return None, [command]
+        holes = command.minus(record.data_record[command.code])
+        if len(holes) == 1 and holes[0].start == command.start and holes[0].end == command.end:
+            return None, holes
+        return self.ts_data_repo.query_df(ts.name, command), holes
+
+    def fill(self, ts, command, df):
+        if len(df) > 0:
+            self.ts_data_repo.save_df(ts.name, df)
+        record: TimeSeries = self.time_series_repo.find_one(ts.name)
+        if command.code in record.data_record:
+            record.data_record[command.code].update(command)
+        else:
+            record.data_record[command.code] = DataRecord(command.code, command.start, command.end)
+        self.time_series_repo.save(record)
+
+
+class ProviderTier(DataTier):
+    """
+    最下面的一层，直接从数据供应商下载，按照load_history_data_in_batches的批次返回，上一层每收到一批就会回填一批
+    """
+
+    def __init__(self):
+        super().__init__('provider')
+
+    def lookup(self, ts, command):
+        return None, [command]
+
+    def fill(self, ts, command, df):
+        raise RuntimeError("provider层不能回填")
+
+    def load_batches(self, ts: TimeSeries, command: SingleCodeQueryCommand) \
+            -> Iterator[Tuple[SingleCodeQueryCommand, DataFrame]]:
+        column_names = [column.name for column in ts.tp.columns()]
+        for batch_command, data_list in ts.tp.load_history_data_in_batches(command):
+            yield batch_command, to_data_frame(data_list, column_names)
+
+
+class TieredDataAccess(object):
+    """
+    history_data的分层读取，比如 内存 -> 本地磁盘 -> Cassandra -> 数据供应商。
+    每一层缺失的范围交给下一层，下一层返回的数据逐批回填到上面的每一层，并且记录每一层的命中次数
+    """
+
+    def __init__(self, tiers: List[DataTier]):
+        if len(tiers) <= 0 or not isinstance(tiers[-1], ProviderTier):
+            raise RuntimeError("最后一层必须是provider")
+        self.tiers = tiers
+
+    def history_data(self, ts: TimeSeries, command: HistoryDataQueryCommand) -> DataFrame:
+        if not command.start:
+            raise RuntimeError("分层读取只支持按照区间查询")
+        dfs = []
+        for single_command in command.to_single_code_command():
+            single_command.with_calendar(command.calendar)
+            dfs.extend([df for _, df in self._fetch(ts, 0, single_command)])
+        dfs = [df for df in dfs if len(df) > 0]
+        if len(dfs) <= 0:
+            return to_data_frame([], [column.name for column in ts.tp.columns()])
+        return pd.concat(dfs)
+
+    def _fetch(self, ts: TimeSeries, level: int, command: SingleCodeQueryCommand) \
+            -> Iterator[Tuple[SingleCodeQueryCommand, DataFrame]]:
+        """
+        产生(覆盖的范围, 数据)，调用方每收到一批就可以回填
+        """
+        tier = self.tiers[level]
+        if isinstance(tier, ProviderTier):
+            tier.hits += 1
+            yield from tier.load_batches(ts, command)
+            return
+        df, holes = tier.lookup(ts, command)
+        if len(holes) <= 0:
+            tier.hits += 1
+            yield command, df
+            return
+        tier.misses += 1
+        if df is not None and len(df) > 0:
+            # 本层已有的部分，按照覆盖的范围切分之后交给上一层回填，跟缺失范围相接的边界上的数据由下一层返回
+            times = df.index.get_level_values(0)
+            cursor, after_hole = command.start, False
+            for hole in holes + [None]:
+                covered_end = hole.start if hole else command.end
+                if covered_end > cursor:
+                    mask = (times > cursor if after_hole else times >= cursor) & \
+                           (times < covered_end if hole else times <= covered_end)
+                    yield SingleCodeQueryCommand(cursor, covered_end, command.code), df[mask]
+                if hole:
+                    cursor, after_hole = hole.end, True
+        for hole in holes:
+            hole.with_calendar(command.calendar)
+            for batch_command, batch_df in self._fetch(ts, level + 1, hole):
+                tier.fill(ts, batch_command, batch_df)
+                yield batch_command, batch_df
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {tier.name: {'hits': tier.hits, 'misses': tier.misses} for tier in self.tiers}
+
+    def invalidate(self, ts_name: str, code: str, start: Timestamp, end: Timestamp):
+        """
+        存储中的数据变化之后，清除内存层中跟该范围相交的数据，持久化的层由各自的DataRecord记录覆盖范围
+        """
+        for tier in self.tiers:
+            if isinstance(tier, MemoryTier):
+                tier.cache.invalidate(ts_name, code, start, end)
+
+
+def invalidate_history_data(ts_name: str, code: str, start: Timestamp, end: Timestamp, shared: bool = False):
+    """
+    存储中一个code在[start, end]内的数据被写入或者删除之后，清除进程内缓存的history_data结果中跟该范围相交的部分。
+    SharedHistoryDataCache按照DataRecord的版本缓存，覆盖范围变化之后旧的数据不会再被命中，
+    shared为True的时候同时删除共享缓存中的旧数据，比如删除了原始数据之后尽早的释放内存
+    """
+    cache: HistoryDataCache = BeanContainer.findBean(HistoryDataCache)
+    if cache:
+        cache.invalidate(ts_name, code, start, end)
+    tiered_access: TieredDataAccess = BeanContainer.findBean(TieredDataAccess)
+    if tiered_access:
+        tiered_access.invalidate(ts_name, code, start, end)
+    shared_cache: SharedHistoryDataCache = BeanContainer.findBean(SharedHistoryDataCache)
+    if shared and shared_cache:
+        shared_cache.invalidate(ts_name, code, start, end)
+
+
+class CacheInvalidatingTSDataRepo(TSDataRepo):
+    """
+    在TSDataRepo前面增加缓存失效的逻辑，所有经过该repo的写入和删除都会清除缓存中跟变化的范围相交的history_data结果
+    """
+
+    def __init__(self, delegate: TSDataRepo):
+        self.delegate = delegate
+
+    def save(self, ts_data_list: List[TSData]):
+        self.delegate.save(ts_data_list)
+        ranges: Dict[Tuple[str, str], Tuple[Timestamp, Timestamp]] = {}
+        for ts_data in ts_data_list:
+            key = (ts_data.ts_type_name, ts_data.code)
+            if key in ranges:
+                start, end = ranges[key]
+                ranges[key] = (min(start, ts_data.visible_time), max(end, ts_data.visible_time))
+            else:
+                ranges[key] = (ts_data.visible_time, ts_data.visible_time)
+        for (ts_name, code), (start, end) in ranges.items():
+            invalidate_history_data(ts_name, code, start, end)
+
+    def save_df(self, ts_name, df: DataFrame):
+        self.delegate.save_df(ts_name, df)
+        if len(df) <= 0:
+            return
+        visible_time, codes = df.index.get_level_values(0), df.index.get_level_values(1)
+        for code in codes.unique():
+            times = visible_time[codes == code]
+            invalidate_history_data(ts_name, code, times.min(), times.max())
+
+    def delete(self, ts_name: str, code: str, start: Timestamp, end: Timestamp):
+        self.delegate.delete(ts_name, code, start, end)
+        invalidate_history_data(ts_name, code, start, end)
+
+    def query(self, ts_name, command):
+        return self.delegate.query(ts_name, command)
+
+    def query_df(self, ts_name, command) -> DataFrame:
+        return self.delegate.query_df(ts_name, command)
+
 
 class DataPortal(object):
     """
@@ -643,6 +1692,13 @@ class DataPortal(object):
                 raise RuntimeError("need subscribe codes")
             self.current_price_ts.subscribe(None, subscribe_codes)
 
+    def preload_current_price(self, codes: List[str], start: Timestamp, end: Timestamp):
+        """
+        回测开始之前预加载整个回测区间的价格，只有Bar类型的时序类型支持
+        """
+        if self.is_backtest and isinstance(self.current_price_ts.tp, BarHistoryTimeSeriesType):
+            self.current_price_ts.tp.preload_current_price(codes, start, end, self.current_price_ts)
+
     def current_price(self, codes: List[str], current_time: Timestamp = None) -> Mapping[str, CurrentPrice]:
         """
         若在实盘环境下，current_time参数会被丢弃
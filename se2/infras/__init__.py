@@ -5,16 +5,14 @@ import yaml
 from cassandra.cqlengine import connection
 
 from se2.domain import common
+from se2.infras.files import *
 from se2.infras.ib2 import *
+from se2.infras.local_repos import *
 from se2.infras.repos import *
+from se2.infras.retention import *
+from se2.infras.shared_cache import *
 from se2.infras.td import *
 
-# 注册repo的实现类
-BeanContainer.register(TimeSeriesRepo, TimeSeriesRepoImpl())
-BeanContainer.register(AccountRepo, AccountRepoImpl())
-BeanContainer.register(OrderRepo, OrderRepoImpl())
-BeanContainer.register(TSDataRepo, TSDataRepoImpl())
-
 # 读取配置文件， 默认从运行目录读取config.ini, 用户可以通过config.dir环境变量来覆盖
 if not os.getenv("config.dir"):
     config_file = 'config.ini'
@@ -36,6 +34,87 @@ else:
     logging.basicConfig(level=logging.INFO)
     logging.info("没有log的配置文件,将使用默认配置")
 
+# 注册repo的实现类, 时序数据默认存储在Cassandra, 可以通过ts_repo配置为本地列式存储
+BeanContainer.register(AccountRepo, AccountRepoImpl())
+BeanContainer.register(OrderRepo, OrderRepoImpl())
+# TimeSeries会缓存在进程内，多进程部署的时候可以通过ts_repo.cache_ttl(秒)设置缓存的过期时间
+cache_ttl = config.getint('ts_repo', 'cache_ttl', fallback=0)
+cache_ttl = Timedelta(seconds=cache_ttl) if cache_ttl > 0 else None
+ts_repo_type = config.get('ts_repo', 'type', fallback='cassandra')
+if ts_repo_type == 'local':
+    ts_root_dir = config.get('ts_repo', 'root_dir')
+    BeanContainer.register(TimeSeriesRepo, CachedTimeSeriesRepo(LocalTimeSeriesRepoImpl(ts_root_dir), cache_ttl))
+    BeanContainer.register(TSDataRepo, LocalTSDataRepoImpl(ts_root_dir))
+    logging.info("时序数据将使用本地列式存储, 目录:{}".format(ts_root_dir))
+else:
+    BeanContainer.register(TimeSeriesRepo, CachedTimeSeriesRepo(TimeSeriesRepoImpl(), cache_ttl))
+    ts_data_repo_kwargs = dict(read_concurrency=config.getint('cassandra', 'read_concurrency', fallback=16),
+                               fetch_size=config.getint('cassandra', 'fetch_size', fallback=5000),
+                               write_concurrency=config.getint('cassandra', 'write_concurrency', fallback=32),
+                               write_batch_size=config.getint('cassandra', 'write_batch_size', fallback=100))
+    # cassandra.layout=session时使用按照交易时段分区的time_series_data3，旧表的数据通过se2.infras.migration迁移
+    if config.get('cassandra', 'layout', fallback='code') == 'session':
+        session_calendar = trading_calendars.get_calendar(config.get('cassandra', 'session_calendar', fallback='NYSE'))
+        BeanContainer.register(TSDataRepo, SessionTSDataRepoImpl(session_calendar, **ts_data_repo_kwargs))
+    else:
+        BeanContainer.register(TSDataRepo, TSDataRepoImpl(**ts_data_repo_kwargs))
+
+# window模式查询的最近数据缓存，ts_cache.tail_size为每个code缓存的条数，为0的时候不启用
+tail_size = config.getint('ts_cache', 'tail_size', fallback=0)
+if tail_size > 0:
+    tail_cache = TailCache(tail_size)
+    BeanContainer.register(TailCache, tail_cache)
+    BeanContainer.register(TSDataRepo, TailCachedTSDataRepo(BeanContainer.getBean(TSDataRepo), tail_cache))
+
+# history_data结果的进程内缓存，ts_cache.memory_bytes为0的时候不启用
+cache_bytes = config.getint('ts_cache', 'memory_bytes', fallback=0)
+if cache_bytes > 0:
+    BeanContainer.register(HistoryDataCache, HistoryDataCache(cache_bytes))
+# 跨进程共享的history_data结果缓存，配置了ts_cache.shared_dir的时候启用，建议放在/dev/shm下
+if config.get('ts_cache', 'shared_dir', fallback=None):
+    BeanContainer.register(SharedHistoryDataCache, MmapHistoryDataCache(
+        config.get('ts_cache', 'shared_dir'),
+        Timedelta(seconds=config.getint('ts_cache', 'shared_max_idle', fallback=3600))))
+# 有进程内的history_data缓存的时候，经过TSDataRepo的写入和删除都会清除缓存中跟变化的范围相交的数据
+if cache_bytes > 0 or config.get('ts_tiers', 'tiers', fallback=None):
+    BeanContainer.register(TSDataRepo, CacheInvalidatingTSDataRepo(BeanContainer.getBean(TSDataRepo)))
+# 分层读取history_data，配置了ts_tiers.tiers的时候启用，比如 memory,local,cassandra,provider，最后一层必须是provider
+if config.get('ts_tiers', 'tiers', fallback=None):
+    data_tiers = []
+    for tier_name in config.get('ts_tiers', 'tiers').split(","):
+        tier_name = tier_name.strip()
+        if tier_name == 'memory':
+            data_tiers.append(MemoryTier(HistoryDataCache(config.getint('ts_tiers', 'memory_bytes',
+                                                                        fallback=1 << 30))))
+        elif tier_name == 'local':
+            tier_dir = config.get('ts_tiers', 'local_dir', fallback=None)
+            if ts_repo_type == 'local' and (not tier_dir or os.path.abspath(tier_dir) == os.path.abspath(ts_root_dir)):
+                # 跟主存储是同一个目录，直接使用注册的repo，共享TimeSeries的缓存以及写入之后的缓存清除
+                data_tiers.append(StorageTier('local', BeanContainer.getBean(TimeSeriesRepo),
+                                              BeanContainer.getBean(TSDataRepo)))
+            else:
+                data_tiers.append(StorageTier('local', CachedTimeSeriesRepo(LocalTimeSeriesRepoImpl(tier_dir),
+                                                                            cache_ttl), LocalTSDataRepoImpl(tier_dir)))
+        elif tier_name == 'cassandra':
+            if ts_repo_type != 'local':
+                # 主存储就是cassandra，直接使用注册的repo
+                data_tiers.append(StorageTier('cassandra', BeanContainer.getBean(TimeSeriesRepo),
+                                              BeanContainer.getBean(TSDataRepo)))
+            else:
+                if config.get('cassandra', 'layout', fallback='code') == 'session':
+                    tier_data_repo = SessionTSDataRepoImpl(
+                        trading_calendars.get_calendar(config.get('cassandra', 'session_calendar', fallback='NYSE')))
+                else:
+                    tier_data_repo = TSDataRepoImpl()
+                data_tiers.append(StorageTier('cassandra', CachedTimeSeriesRepo(TimeSeriesRepoImpl(), cache_ttl),
+                                              tier_data_repo))
+        elif tier_name == 'provider':
+            data_tiers.append(ProviderTier())
+        else:
+            raise RuntimeError("不支持的数据层:{}".format(tier_name))
+    BeanContainer.register(TieredDataAccess, TieredDataAccess(data_tiers))
+    logging.info("history_data将分层读取:{}".format([tier.name for tier in data_tiers]))
+
 # 初始化告警配置
 if 'alarm' in config.sections():
     common.initialize_email_alarm(
@@ -44,19 +123,38 @@ if 'alarm' in config.sections():
                          config.get('alarm', 'password'), config.get('alarm', 'sender_email'),
                          config.get('alarm', 'receiver')))
 
-# 初始化DB连接
-connection.setup(config.get("cassandra", "contact_points").split(","),
-                 config.get("cassandra", "session_keyspace"), protocol_version=3,
-                 port=config.getint("cassandra", "port"))
+# 初始化DB连接。时序数据使用本地列式存储并且没有配置cassandra的时候不需要数据库，比如只在notebook中读取数据以及回测。
+# 连接在第一次访问数据库的时候才建立，导入se2不需要可用的集群
+ts_tiers = [tier_name.strip() for tier_name in config.get('ts_tiers', 'tiers', fallback='').split(",")]
+if ts_repo_type != 'local' or 'cassandra' in ts_tiers or 'cassandra' in config.sections():
+    connection.setup(config.get("cassandra", "contact_points").split(","),
+                     config.get("cassandra", "session_keyspace"), protocol_version=3,
+                     port=config.getint("cassandra", "port"), lazy_connect=True)
 
 # ib初始化
 if 'ib' in config.sections():
     ib2.initialize(config.get("ib", "host"), config.getint("ib", 'port'),
-                  config.getint('ib', 'client_id'))
+                  config.getint('ib', 'client_id'),
+                  history_concurrency=config.getint('ib', 'history_concurrency', fallback=4))
 
 # td初始化
 if 'td' in config.sections():
     td.initialize(config.get('td', 'client_id'), config.get('td', 'redirect_uri'), config.get('td', 'credentials_path'))
 
+# 基于本地CSV或者Parquet文件的时序类型，每个[file_ts:时序类型名称]配置一个
+for section in config.sections():
+    if section.startswith('file_ts:'):
+        TSTypeRegistry.register(FileHistoryTimeSeriesType(
+            section[len('file_ts:'):], config.get(section, 'root_dir'), parse_columns(config.get(section, 'columns')),
+            file_format=config.get(section, 'format', fallback='csv'),
+            time_column=config.get(section, 'time_column', fallback='visible_time'),
+            tz=config.get(section, 'tz', fallback='UTC'), time_unit=config.get(section, 'time_unit', fallback=None),
+            unique_visible_time=config.getboolean(section, 'unique_visible_time', fallback=True),
+            should_cache=config.getboolean(section, 'should_cache', fallback=False)))
+
+# 老化的原始数据汇总而来的派生时序类型，由se2.infras.run_retention产生，例如 rollups = ibTrade:min_bar,ibBidAsk:session_summary
+if config.get('retention', 'rollups', fallback=None):
+    for rollup in parse_rollups(config.get('retention', 'rollups')):
+        TSTypeRegistry.register(rollup)
 
 logging.info("应用初始化成功")
@@ -0,0 +1,179 @@
+# 在数据库和本地列式文件之间批量的导出和导入时序数据，用于在不同的环境之间迁移数据，比如给回测节点准备多年的历史数据，
+# 而不需要重新从数据供应商下载。文件的格式跟LocalTSDataRepoImpl相同，DataRecord保存在各个时序类型的time_series.json中，
+# 导出目录下的manifest.json记录了导出的时序类型、code以及数据量。
+# 数据按照DataRecord中覆盖的范围切分成若干段，每段写入之后立即推进目标的DataRecord，中断之后重新执行会跳过已经完成的段。
+# 用法: python -m se2.infras.bulk_transfer export --dir /data/ts_export --types ibMinBar,ibTrade --codes SPCE_STK_USD_SMART
+#      python -m se2.infras.bulk_transfer import --dir /data/ts_export
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Tuple
+
+from pandas import Timestamp, Timedelta
+
+from se2.domain.common import BeanContainer
+from se2.domain.time_series import *
+from se2.infras.local_repos import LocalTSDataRepoImpl, LocalTimeSeriesRepoImpl, atomic_write
+
+MANIFEST_FILE = 'manifest.json'
+
+
+class BulkTransfer(object):
+    """
+    每个(时序类型, code)是一个任务，多个任务并发的执行
+    """
+
+    def __init__(self, source_ts_repo: TimeSeriesRepo, source_data_repo: TSDataRepo,
+                 target_ts_repo: TimeSeriesRepo, target_data_repo: TSDataRepo,
+                 concurrency: int = 8, chunk_span: Timedelta = Timedelta(days=30)):
+        self.source_ts_repo = source_ts_repo
+        self.source_data_repo = source_data_repo
+        self.target_ts_repo = target_ts_repo
+        self.target_data_repo = target_data_repo
+        self.concurrency = concurrency
+        self.chunk_span = chunk_span
+        self.lock = threading.Lock()
+        # 同一个时序类型的所有任务共享同一个TimeSeries，保存的时候不会互相覆盖
+        self.target_series: Dict[str, TimeSeries] = {}
+        # 每个任务迁移的数据量，每段完成之后就会累加，任务失败的时候也会保留已经完成的段的记录
+        self.rows: Dict[str, Dict[str, int]] = {}
+
+    def chunks(self, record: DataRecord) -> List[Tuple[Timestamp, Timestamp]]:
+        """
+        将覆盖的范围切分成不超过chunk_span的首尾相接的段
+        """
+        res = []
+        for start, end in record.coverage:
+            p = start
+            while True:
+                chunk_end = min(p + self.chunk_span, end)
+                res.append((p, chunk_end))
+                if chunk_end >= end:
+                    break
+                p = chunk_end
+        return res
+
+    def transfer_code(self, ts_name: str, code: str) -> int:
+        source_ts: TimeSeries = self.source_ts_repo.find_one(ts_name)
+        target_ts: TimeSeries = self.target_series[ts_name]
+        count = 0
+        for start, end in self.chunks(source_ts.data_record[code]):
+            with self.lock:
+                if code in target_ts.data_record and target_ts.data_record[code].coverage.contains(start, end):
+                    continue
+            df = self.source_data_repo.query_df(ts_name, SingleCodeQueryCommand(start, end, code))
+            if len(df) > 0:
+                self.target_data_repo.save_df(ts_name, df)
+            with self.lock:
+                if code in target_ts.data_record:
+                    target_ts.data_record[code].update(SingleCodeQueryCommand(start, end, code))
+                else:
+                    target_ts.data_record[code] = DataRecord(code, start, end)
+                type_rows = self.rows.setdefault(ts_name, {})
+                type_rows[code] = type_rows.get(code, 0) + len(df)
+            # 每个code只由一个任务处理，只保存这个code的DataRecord，不需要在锁内序列化整个TimeSeries
+            self.target_ts_repo.save_record(target_ts, code)
+            count += len(df)
+        return count
+
+    def run(self, ts_names: List[str], codes: List[str] = None) -> Dict[str, Dict[str, int]]:
+        tasks = []
+        for ts_name in ts_names:
+            source_ts: TimeSeries = self.source_ts_repo.find_one(ts_name)
+            self.target_series[ts_name] = self.target_ts_repo.find_one(ts_name)
+            tasks.extend([(ts_name, code) for code in source_ts.data_record.keys() if not codes or code in codes])
+        logging.info("需要迁移的任务数:{}".format(len(tasks)))
+        start_time = time.time()
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ts_bulk_transfer') as executor:
+            futures = {executor.submit(self.transfer_code, ts_name, code): (ts_name, code) for ts_name, code in tasks}
+            for k, future in enumerate(as_completed(futures)):
+                ts_name, code = futures[future]
+                try:
+                    count = future.result()
+                    logging.info("[{}/{}] {}:{} 完成, 数据量:{}".format(k + 1, len(tasks), ts_name, code, count))
+                except Exception:
+                    import traceback
+                    logging.error("{}:{} 失败:{}".format(ts_name, code, traceback.format_exc()))
+                    failed.append((ts_name, code))
+        total = sum([sum(counts.values()) for counts in self.rows.values()])
+        logging.info("结束, 共迁移{}条数据, 耗时:{:.0f}s, 失败的任务:{}".format(total, time.time() - start_time, failed))
+        if len(failed) > 0:
+            raise RuntimeError("有{}个任务失败，重新执行即可继续".format(len(failed)))
+        return self.rows
+
+
+def write_manifest(root_dir: str, rows: Dict[str, Dict[str, int]]):
+    """
+    多次导出到同一个目录的时候累加之前的记录，已经导出的段不会重复导出，所以不会重复计数
+    """
+    path = os.path.join(root_dir, MANIFEST_FILE)
+    manifest = read_manifest(root_dir)
+    for ts_name, counts in rows.items():
+        type_counts = manifest['types'].setdefault(ts_name, {})
+        for code, count in counts.items():
+            type_counts[code] = type_counts.get(code, 0) + count
+    manifest['exported_time'] = str(Timestamp.now(tz='Asia/Shanghai'))
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    atomic_write(path, write)
+
+
+def read_manifest(root_dir: str) -> Dict:
+    path = os.path.join(root_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {'types': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def export_data(root_dir: str, ts_names: List[str], codes: List[str] = None, concurrency: int = 8):
+    """
+    将当前配置的存储中的数据导出到root_dir
+    """
+    os.makedirs(root_dir, exist_ok=True)
+    transfer = BulkTransfer(BeanContainer.getBean(TimeSeriesRepo), BeanContainer.getBean(TSDataRepo),
+                            LocalTimeSeriesRepoImpl(root_dir), LocalTSDataRepoImpl(root_dir), concurrency)
+    try:
+        transfer.run(ts_names, codes)
+    finally:
+        write_manifest(root_dir, transfer.rows)
+
+
+def import_data(root_dir: str, ts_names: List[str] = None, codes: List[str] = None, concurrency: int = 8):
+    """
+    将root_dir中的数据导入到当前配置的存储，没有指定时序类型的时候导入manifest中的全部类型
+    """
+    if not ts_names:
+        ts_names = list(read_manifest(root_dir)['types'].keys())
+    transfer = BulkTransfer(LocalTimeSeriesRepoImpl(root_dir), LocalTSDataRepoImpl(root_dir),
+                            BeanContainer.getBean(TimeSeriesRepo), BeanContainer.getBean(TSDataRepo), concurrency)
+    transfer.run(ts_names, codes)
+
+
+if __name__ == '__main__':
+    # 初始化配置以及repo
+    import se2.infras
+
+    parser = argparse.ArgumentParser(description="在数据库和本地列式文件之间批量的导出和导入时序数据")
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('--dir', required=True, help="导出或者导入的目录")
+    parser.add_argument('--types', help="时序类型，逗号分隔，导入的时候默认导入manifest中的全部类型")
+    parser.add_argument('--codes', help="code，逗号分隔，默认全部")
+    parser.add_argument('--concurrency', type=int, default=8, help="同时迁移的(时序类型, code)的数量")
+    args = parser.parse_args()
+    types = args.types.split(",") if args.types else None
+    code_list = args.codes.split(",") if args.codes else None
+    if args.action == 'export':
+        if not types:
+            raise RuntimeError("导出的时候必须指定时序类型")
+        export_data(args.dir, types, code_list, args.concurrency)
+    else:
+        import_data(args.dir, types, code_list, args.concurrency)
@@ -0,0 +1,249 @@
+# 从本地的CSV或者Parquet文件中读取历史数据的时序类型，用于使用数据供应商提供的大批量数据进行回测，以及在没有网络的环境下做性能测试。
+# 文件按照code和日期组织: root_dir/code/20200102.csv，一个code的数据较少的时候也可以是单个文件: root_dir/code.csv。
+# 文件中需要包含visible_time列以及columns中定义的所有列，文件名中的日期是visible_time在tz时区下的日期
+import os
+import re
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+from pandas import Timestamp, DataFrame
+
+from se2.domain.time_series import *
+
+FILE_FORMATS = {'csv': '.csv', 'parquet': '.parquet'}
+COLUMN_TYPES = {'float': float, 'int': int, 'str': str, 'timestamp': Timestamp}
+DATE_FILE_PATTERN = re.compile(r'^(\d{8})(\.\w+)$')
+# tick文件中可以用于获取当前价格的列，成交tick有price，报价tick有bid_price和ask_price
+TICK_PRICE_COLUMNS = ['price', 'ask_price', 'ask_size', 'bid_price', 'bid_size']
+
+
+def parse_columns(spec: str) -> List[Column]:
+    """
+    解析形如 start_time:timestamp,open:float,volume:int 的列定义
+    """
+    columns = []
+    for item in spec.split(","):
+        name, tp = item.strip().split(":")
+        if tp not in COLUMN_TYPES:
+            raise RuntimeError("不支持的列类型:{}".format(tp))
+        columns.append(Column(name, COLUMN_TYPES[tp], None, None, None))
+    return columns
+
+
+class TickPriceIndex(object):
+    """
+    一个code在[start, end]内的tick的价格列，按照visible_time排序，时间都是UTC纳秒
+    """
+
+    def __init__(self, start: int, end: int, visible_time: np.ndarray, values: Dict[str, np.ndarray]):
+        self.start = start
+        self.end = end
+        self.visible_time = visible_time
+        self.values = values
+
+    def covers(self, t: int) -> bool:
+        return self.start <= t <= self.end
+
+    def last(self, t: int) -> Optional[Dict[str, float]]:
+        """
+        t之前(包含t)的最后一条tick的价格，加载的范围内没有的时候返回None
+        """
+        i = self.visible_time.searchsorted(t, side='right') - 1
+        if i < 0:
+            return None
+        return {name: float(arr[i]) for name, arr in self.values.items()}
+
+
+class FileHistoryTimeSeriesType(BarHistoryTimeSeriesType):
+    """
+    整个文件一次解析成有类型的列，然后直接构建DataFrame，不会为每一行数据创建TSData。
+    should_cache为False的时候每次都从文件读取，为True的时候跟其他数据源一样下载到TSDataRepo中。
+    包含start_time, open, close列的文件按照bar获取当前价格，包含price或者bid_price, ask_price列的文件按照tick获取，
+    当前价格为该时间之前最后一条tick的价格
+    """
+
+    # tick布局每次加载当前价格的时间跨度，bar布局使用current_price_change_start_offset和end_offset
+    tick_price_span = Timedelta(days=1)
+
+    def __init__(self, name: str, root_dir: str, columns: List[Column], file_format: str = 'csv',
+                 time_column: str = 'visible_time', tz: str = 'UTC', time_unit: str = None,
+                 unique_visible_time: bool = True, should_cache: bool = False):
+        if file_format not in FILE_FORMATS:
+            raise RuntimeError("不支持的文件格式:{}".format(file_format))
+        self._name = name
+        self._columns = columns
+        self.root_dir = root_dir
+        self.file_format = file_format
+        self.time_column = time_column
+        self.tz = tz
+        self.time_unit = time_unit
+        self._unique_visible_time = unique_visible_time
+        self._should_cache = should_cache
+        super().__init__(current_price_change_start_offset=Timedelta(minutes=5),
+                         current_price_change_end_offset=Timedelta(minutes=1440 * 10))
+        self.tick_cache: Dict[str, TickPriceIndex] = {}
+
+    def name(self) -> str:
+        return self._name
+
+    def columns(self) -> List[Column]:
+        return self._columns
+
+    def should_cache(self):
+        return self._should_cache
+
+    def unique_visible_time(self):
+        return self._unique_visible_time
+
+    def load_assets(self) -> List[Asset]:
+        return []
+
+    def _is_bar_layout(self) -> bool:
+        return {'start_time', 'open', 'close'}.issubset(self.column_map.keys())
+
+    def _tick_price_columns(self) -> List[str]:
+        names = [name for name in TICK_PRICE_COLUMNS if name in self.column_map]
+        if 'price' not in names and not {'bid_price', 'ask_price'}.issubset(names):
+            return []
+        return names
+
+    def _current_price(self, code: str, the_time: Timestamp, ts: TimeSeries) -> CurrentPrice:
+        if self._is_bar_layout():
+            return super()._current_price(code, the_time, ts)
+        names = self._tick_price_columns()
+        if len(names) <= 0:
+            raise NotImplementedError
+        t = the_time.value
+        if code not in self.tick_cache or not self.tick_cache[code].covers(t):
+            self.preload_current_price([code], the_time - self.current_price_change_start_offset,
+                                       the_time + self.tick_price_span, ts)
+        values = self.tick_cache[code].last(t)
+        if values is None:
+            # 加载的范围内该时间之前没有tick，直接从文件中往前查找最后一条
+            df = self.load_history_df(HistoryDataQueryCommand(None, the_time, [code], window=1))
+            if len(df) <= 0:
+                raise RuntimeError("无法获取当前价格，时间:{}, code:{}".format(str(the_time), code))
+            values = {name: float(df[name].values[-1]) for name in names}
+        price_values = {name: values.get(name) for name in TICK_PRICE_COLUMNS}
+        if price_values['price'] is None:
+            price_values['price'] = (price_values['bid_price'] + price_values['ask_price']) / 2
+        return CurrentPrice(self.name(), the_time, code, price_values)
+
+    def preload_current_price(self, codes: List[str], start: Timestamp, end: Timestamp, ts: TimeSeries):
+        if self._is_bar_layout():
+            return super().preload_current_price(codes, start, end, ts)
+        names = self._tick_price_columns()
+        if len(names) <= 0:
+            return
+        df: DataFrame = ts.history_data(HistoryDataQueryCommand(start, end, codes), from_local=self.should_cache())
+        df_codes = df.index.get_level_values(1).values
+        for code in codes:
+            code_df = df[df_codes == code]
+            self.tick_cache[code] = TickPriceIndex(start.value, end.value,
+                                                   pd.DatetimeIndex(code_df.index.get_level_values(0)).asi8,
+                                                   {name: code_df[name].values.astype(np.float64) for name in names})
+
+    def ingestion_batch_span(self) -> Timedelta:
+        return Timedelta(days=30)
+
+    def _files(self, code: str) -> List[Tuple[Optional[int], str]]:
+        """
+        返回(日期, 路径)，单个文件的时候日期为None
+        """
+        suffix = FILE_FORMATS[self.file_format]
+        code_dir = os.path.join(self.root_dir, code)
+        if os.path.isdir(code_dir):
+            # 忽略不是按照日期命名的文件，例如.DS_Store以及_SUCCESS
+            matches = [(DATE_FILE_PATTERN.match(f), f) for f in os.listdir(code_dir)]
+            return sorted([(int(m.group(1)), os.path.join(code_dir, f)) for m, f in matches
+                           if m and m.group(2) == suffix])
+        path = code_dir + suffix
+        return [(None, path)] if os.path.exists(path) else []
+
+    def _date(self, t: Timestamp) -> int:
+        return int(t.tz_convert(self.tz).strftime("%Y%m%d"))
+
+    def _parse_time(self, values: Series) -> pd.DatetimeIndex:
+        if self.time_unit:
+            times = pd.to_datetime(values.values, unit=self.time_unit, utc=True)
+        else:
+            times = pd.DatetimeIndex(pd.to_datetime(values.values))
+            times = times.tz_localize(self.tz) if times.tz is None else times
+        return times.tz_convert('Asia/Shanghai')
+
+    def _read(self, path: str) -> Tuple[pd.DatetimeIndex, Dict[str, object]]:
+        names = [self.time_column] + [column.name for column in self._columns]
+        if self.file_format == 'parquet':
+            raw = pd.read_parquet(path, columns=names)
+        else:
+            dtypes = {column.name: {float: np.float64, int: np.int64, str: str}[column.tp]
+                      for column in self._columns if column.tp != Timestamp}
+            raw = pd.read_csv(path, usecols=names, dtype=dtypes)
+        visible_time = self._parse_time(raw[self.time_column])
+        columns = {}
+        for column in self._columns:
+            values = raw[column.name]
+            if column.tp == Timestamp:
+                columns[column.name] = self._parse_time(values)
+            elif column.tp == float:
+                columns[column.name] = values.values.astype(np.float64)
+            elif column.tp == int:
+                columns[column.name] = values.values.astype(np.int64)
+            else:
+                columns[column.name] = values.values.astype(object)
+        # 文件中的数据不保证有序，稳定排序之后同一时间的数据保持文件中的顺序
+        order = np.argsort(visible_time.asi8, kind='stable')
+        return visible_time[order], {name: arr[order] for name, arr in columns.items()}
+
+    def _load_code(self, code: str, command: HistoryDataQueryCommand) \
+            -> List[Tuple[pd.DatetimeIndex, Dict[str, object]]]:
+        files = self._files(code)
+        end_date = self._date(command.end)
+        if command.start:
+            start_date = self._date(command.start)
+            parts = []
+            for date, path in files:
+                if date is not None and (date < start_date or date > end_date):
+                    continue
+                visible_time, columns = self._read(path)
+                mask = (visible_time >= command.start) & (visible_time <= command.end)
+                parts.append((visible_time[mask], {name: arr[mask] for name, arr in columns.items()}))
+            return parts
+        # window模式，从后往前读取文件，直到数据量满足window
+        parts = []
+        count = 0
+        for date, path in reversed(files):
+            if date is not None and date > end_date:
+                continue
+            visible_time, columns = self._read(path)
+            hi = visible_time.searchsorted(command.end, side='right')
+            lo = max(hi - (command.window - count), 0)
+            parts.insert(0, (visible_time[lo: hi], {name: arr[lo: hi] for name, arr in columns.items()}))
+            count += hi - lo
+            if count >= command.window:
+                break
+        return parts
+
+    def load_history_df(self, command: HistoryDataQueryCommand) -> DataFrame:
+        column_names = [column.name for column in self._columns]
+        times, codes, column_parts = [], [], {name: [] for name in column_names}
+        for code in sorted(command.codes):
+            for visible_time, columns in self._load_code(code, command):
+                times.append(visible_time)
+                codes.append(np.full(len(visible_time), code, dtype=object))
+                for name in column_names:
+                    column_parts[name].append(columns[name])
+        if len(times) <= 0 or sum([len(t) for t in times]) <= 0:
+            return to_data_frame([], column_names)
+        visible_time = times[0].append(times[1:]) if len(times) > 1 else times[0]
+        columns = {}
+        for column in self._columns:
+            parts = column_parts[column.name]
+            columns[column.name] = parts[0].append(parts[1:]) if column.tp == Timestamp and len(parts) > 1 \
+                else parts[0] if len(parts) == 1 else np.concatenate(parts)
+        visible_time, code_arr, columns = merge_code_streams(visible_time, np.concatenate(codes), columns)
+        return build_data_frame(visible_time, code_arr, columns, column_names)
+
+    def load_history_data(self, command: HistoryDataQueryCommand) -> List[TSData]:
+        return from_data_frame(self.name(), self.load_history_df(command), self._columns)
@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import functools
 import math
 import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from threading import Condition
 
 from ibapi.client import EClient
@@ -16,20 +19,25 @@ from se2.domain.time_series import HistoryDataQueryCommand, TSData, Column, Asse
     BarHistoryTimeSeriesType, TSTypeRegistry, HistoryTimeSeriesType
 
 client: IBClient = None
+history_pacer: HistoryRequestPacer = None
+history_scheduler: HistoryDownloadScheduler = None
 
 
-def initialize(host: str, port: int, client_id: int):
+def initialize(host: str, port: int, client_id: int, history_concurrency: int = 4):
     """
     初始化ib
     :param host:
     :param port:
     :param client_id:
+    :param history_concurrency: 下载历史数据时同时在途的请求数量
     :return:
     """
-    global client
+    global client, history_pacer, history_scheduler
     if client:
         raise RuntimeError("client已经被初始化了")
     client = IBClient(host, port, client_id)
+    history_pacer = HistoryRequestPacer()
+    history_scheduler = HistoryDownloadScheduler(history_concurrency)
     # 注册时序类型
     TSTypeRegistry.register(IBCurrentPrice())
     TSTypeRegistry.register(IBAdjustedDailyBar())
@@ -61,8 +69,34 @@ class Request(object):
         self.id = self._random_id()
         self.code = code
         self.resp = None
+        self.done = False
+        self.error_code = None
+        self.error_string = None
         Request.id_to_request[self.id] = self
 
+    def finish(self, error_code: int = None, error_string: str = None):
+        """
+        标记请求已经结束并唤醒等待的线程
+        """
+        with self.condition:
+            self.done = True
+            self.error_code = error_code
+            self.error_string = error_string
+            self.condition.notify_all()
+
+    def wait(self, timeout) -> bool:
+        """
+        等待请求结束，返回是否在超时之前结束。通过done标记判断，即使响应在开始等待之前就已经到达也不会一直等到超时
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.done, timeout)
+
+    def is_pacing_violation(self):
+        return self.error_code == 162 and 'pacing violation' in (self.error_string or '').lower()
+
+    def is_no_data(self):
+        return self.error_code == 162 and 'no data' in (self.error_string or '').lower()
+
     def _random_id(self):
         while True:
             k = random.randint(0, 100000000)
@@ -78,6 +112,117 @@ class Request(object):
         return Request.id_to_request[req_id]
 
 
+class PacingViolationError(Exception):
+    """
+    IB返回了历史数据请求的限流错误(错误码162, pacing violation)，这种错误等待一段时间之后重试即可
+    """
+    pass
+
+
+class HistoryRequestPacer(object):
+    """
+    IB对历史数据请求的限流规则:
+    1. 15秒之内不能发起相同的请求
+    2. 2秒之内对同一个合约最多发起6个请求
+    3. 对于30秒及以下粒度的bar以及tick数据，任意10分钟之内最多发起60个请求
+    每次发起历史数据请求之前都需要先获取许可，不满足规则的时候会阻塞直到可以发送为止
+    """
+
+    def __init__(self, max_requests: int = 60, period: float = 600, identical_period: float = 15,
+                 max_contract_requests: int = 6, contract_period: float = 2):
+        self.max_requests = max_requests
+        self.period = period
+        self.identical_period = identical_period
+        self.max_contract_requests = max_contract_requests
+        self.contract_period = contract_period
+        self.condition = Condition()
+        # 已经发送的请求，元素是(发送时间, 合约, 请求标识, 是否受10分钟规则的限制)
+        self.sent = deque()
+
+    def acquire(self, contract_key: str, request_key: str, limited: bool):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                wait_seconds = self._wait_seconds(now, contract_key, request_key, limited)
+                if wait_seconds <= 0:
+                    self.sent.append((now, contract_key, request_key, limited))
+                    return
+                self.condition.wait(wait_seconds)
+
+    def _wait_seconds(self, now: float, contract_key: str, request_key: str, limited: bool) -> float:
+        while len(self.sent) > 0 and now - self.sent[0][0] >= self.period:
+            self.sent.popleft()
+        wait_seconds = 0
+        if limited:
+            limited_times = [t for t, _, _, lmt in self.sent if lmt]
+            if len(limited_times) >= self.max_requests:
+                wait_seconds = limited_times[-self.max_requests] + self.period - now
+        contract_times = [t for t, c, _, _ in self.sent if c == contract_key and now - t < self.contract_period]
+        if len(contract_times) >= self.max_contract_requests:
+            wait_seconds = max(wait_seconds,
+                               contract_times[-self.max_contract_requests] + self.contract_period - now)
+        for t, _, r, _ in self.sent:
+            if r == request_key and now - t < self.identical_period:
+                wait_seconds = max(wait_seconds, t + self.identical_period - now)
+        return wait_seconds
+
+
+def paced_request(code: str, request_key: str, limited: bool, func: Callable, retry_limit: int = 5,
+                  backoff: float = 10):
+    """
+    获取限流许可之后再发起请求，被IB限流的时候指数退避之后重试
+    :param code: 请求的合约
+    :param request_key: 请求的标识，相同标识的请求在15秒之内只能发起一次
+    :param limited: 是否受10分钟60个请求的限制
+    :param func: 发起请求并返回结果的方法
+    """
+    pacer = history_pacer if history_pacer else HistoryRequestPacer()
+    for k in range(retry_limit):
+        pacer.acquire(code, request_key, limited)
+        try:
+            return func()
+        except PacingViolationError:
+            interval = backoff * (2 ** k)
+            logging.warning("请求:{}被IB限流，{}秒之后第{}次重试".format(request_key, interval, k + 1))
+            time.sleep(interval)
+    raise RuntimeError("请求:{}重试{}次之后仍然被限流".format(request_key, retry_limit))
+
+
+class HistoryDownloadScheduler(object):
+    """
+    将一次历史数据下载拆分出来的(code, 时间片)任务放到线程池中并发的执行，任务中发起的每个请求都会经过限流器。
+    返回结果的顺序跟任务的顺序一致
+    """
+
+    def __init__(self, concurrency: int = 4):
+        if concurrency <= 0:
+            raise RuntimeError("并发数必须大于0")
+        self.concurrency = concurrency
+
+    def run(self, tasks: List[Callable]) -> List:
+        if len(tasks) <= 1 or self.concurrency == 1:
+            return [task() for task in tasks]
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(tasks)),
+                                thread_name_prefix='ib_history') as executor:
+            futures = [executor.submit(task) for task in tasks]
+            return [future.result() for future in futures]
+
+
+def take_history_response(req: Request, timeout) -> List:
+    """
+    等待历史数据请求结束并返回响应数据，没有数据的时候返回空列表
+    """
+    if not req.wait(timeout):
+        # 超时的请求不清理，避免之后到达的响应找不到对应的请求
+        raise RuntimeError("获取数据超时")
+    Request.clear(req.id)
+    if req.is_pacing_violation():
+        raise PacingViolationError(req.error_string)
+    if req.error_code and not req.is_no_data():
+        raise RuntimeError("获取数据失败, errorCode:{}, errorString:{}".format(req.error_code, req.error_string))
+    return req.resp if req.resp else []
+
+
 class IBClient(EWrapper, EClient):
     """
         封装了官方提供的client， 支持自动重连。
@@ -111,7 +256,7 @@ class IBClient(EWrapper, EClient):
     def error(self, reqId: TickerId, errorCode: int, errorString: str):
         super().error(reqId, errorCode, errorString)
         logging.error("ib client error, req_id:{}, errorCode:{}, errorString:{}".format(reqId, errorCode, errorString))
-        if reqId != -1:
+        if reqId != -1 and reqId in Request.id_to_request:
             req = Request.find(reqId)
             req.listener.error(reqId, errorCode, errorString)
 
@@ -369,62 +514,100 @@ class IBHistoryBar(EWrapper):
             req.resp.append(bar)
 
     def historicalDataEnd(self, reqId: int, start: str, end: str):
-        req = Request.find(reqId)
-        if req.condition.acquire():
-            req.condition.notifyAll()
-            req.condition.release()
+        Request.find(reqId).finish()
+
+    def error(self, reqId: TickerId, errorCode: int, errorString: str):
+        Request.find(reqId).finish(errorCode, errorString)
 
     def sync_load_data_in_batch(self, command: HistoryDataQueryCommand, bar_size_setting: str, what_to_show: str,
                                 use_rth: int, format_date: int, keey_up_to_date: bool, char_options: list,
                                 batch_size: int = 1440) -> Dict[str, List[BarData]]:
         """
-        分批下载数据，下载区间支持使用HistoryDataQueryCommand来进行指定
+        分批下载数据，下载区间支持使用HistoryDataQueryCommand来进行指定。
+        指定了start和end的时候，会先规划好所有(code, 时间片)的请求，然后交给调度器并发的下载；window模式下每个code
+        需要根据已经下载的数据来决定下一批的结束时间，所以只能逐批的下载
         :param command:
         :param batch_size: 每批下载的数据时间范围，单位是分钟
-        :return:
+        :return: 每个code按照时间排好序的bar
         """
-        code_to_bars = {}
-        for code in command.codes:
-            bars: List[BarData] = []
-            batch_end = command.end
-            while True:
-                batch_duration = "{} S".format(batch_size * 60)
-                # 下面请求的返回结果不会包含end_date_time所对应的bar， IB使用bar的开始时间作为标签
-                batch_bars = self.sync_load_history_bar(code, end_date_time=batch_end,
-                                                        duration_str=batch_duration, bar_size_setting=bar_size_setting,
-                                                        what_to_show=what_to_show, use_rth=use_rth,
-                                                        format_date=format_date,
-                                                        keep_up_to_date=keey_up_to_date, chart_options=char_options)
-                bars.extend(batch_bars[::-1])
-                if command.start and command.end:
-                    # 检查start时间
-                    if Timestamp(bars[-1].date, tz='Asia/Shanghai') <= command.start:
-                        break
-                else:
-                    # 检查window
-                    if len(bars) >= command.window:
-                        break
-                batch_end = Timestamp(bars[-1].date, tz='Asia/Shanghai')
-            code_to_bars[code] = bars
-        return code_to_bars
+        batch_duration = "{} S".format(batch_size * 60)
+
+        def load(code, batch_end):
+            # 下面请求的返回结果不会包含end_date_time所对应的bar， IB使用bar的开始时间作为标签
+            return self.sync_load_history_bar(code, end_date_time=batch_end,
+                                              duration_str=batch_duration, bar_size_setting=bar_size_setting,
+                                              what_to_show=what_to_show, use_rth=use_rth,
+                                              format_date=format_date,
+                                              keep_up_to_date=keey_up_to_date, chart_options=char_options)
+
+        if not (command.start and command.end):
+            return {code: self._load_window_bars(code, command, batch_size, load) for code in command.codes}
+
+        slices = self.plan_slices(command, batch_size)
+        scheduler = history_scheduler if history_scheduler else HistoryDownloadScheduler()
+        results = scheduler.run([functools.partial(load, code, batch_end) for code, batch_end in slices])
+        code_to_bars: Dict[str, Dict[str, BarData]] = {code: {} for code in command.codes}
+        for (code, _), batch_bars in zip(slices, results):
+            for bar in batch_bars:
+                code_to_bars[code][bar.date] = bar
+        return {code: sorted(bars.values(), key=lambda bar: bar.date) for code, bars in code_to_bars.items()}
+
+    @classmethod
+    def plan_slices(cls, command: HistoryDataQueryCommand, batch_size: int) -> List[Tuple[str, Timestamp]]:
+        """
+        从end往前按照batch_size切分时间片，直到覆盖start。返回(code, 时间片的结束时间)，
+        同一个时间片的不同code排在一起，避免并发的请求集中在同一个合约上而触发单个合约的限流
+        """
+        batch = Timedelta(minutes=batch_size)
+        batch_ends = []
+        batch_end = command.end
+        while batch_end > command.start:
+            batch_ends.append(batch_end)
+            batch_end = batch_end - batch
+        return [(code, batch_end) for batch_end in batch_ends for code in command.codes]
+
+    def _load_window_bars(self, code: str, command: HistoryDataQueryCommand, batch_size: int, load: Callable,
+                          max_empty_batches: int = 7) -> List[BarData]:
+        bars: List[BarData] = []
+        batch_end = command.end
+        empty_batches = 0
+        while len(bars) < command.window:
+            batch_bars = load(code, batch_end)
+            if len(batch_bars) <= 0:
+                # 休市的时间段没有数据，继续往前
+                empty_batches += 1
+                if empty_batches >= max_empty_batches:
+                    break
+                batch_end = batch_end - Timedelta(minutes=batch_size)
+                continue
+            empty_batches = 0
+            bars.extend(batch_bars[::-1])
+            batch_end = Timestamp(bars[-1].date, tz='Asia/Shanghai')
+        return bars[::-1]
 
     def sync_load_history_bar(self, code, end_date_time: Timestamp, duration_str: str, bar_size_setting: str,
                               what_to_show: str, use_rth: int, format_date: int, keep_up_to_date: bool,
                               chart_options: List, timeout: int = 20):
-        req = Request(self, code)
-        contract = self.client.code_to_contract(code)
-        self.client.reqHistoricalData(req.id, contract,
-                                      end_date_time.strftime("%Y%m%d %H:%M:%S") if end_date_time else "",
-                                      duration_str, bar_size_setting, what_to_show,
-                                      use_rth, format_date, keep_up_to_date, chart_options)
-        if req.condition.acquire():
-            req.condition.wait(timeout)
-        if not req.resp:
-            self.client.cancelHistoricalData(req.id)
-            raise RuntimeError("获取数据超时或者没有获取到数据")
-        resp = req.resp
-        # 清理数据
-        Request.clear(req.id)
+        end_date_time_str = end_date_time.strftime("%Y%m%d %H:%M:%S") if end_date_time else ""
+        request_key = "bar:{}:{}:{}:{}:{}".format(code, end_date_time_str, duration_str, bar_size_setting,
+                                                 what_to_show)
+        # IB的10分钟60个请求的限制只针对30秒及以下粒度的bar
+        limited = bar_size_setting.endswith('secs') or bar_size_setting.endswith('sec')
+
+        def request():
+            req = Request(self, code)
+            contract = self.client.code_to_contract(code)
+            self.client.reqHistoricalData(req.id, contract, end_date_time_str,
+                                          duration_str, bar_size_setting, what_to_show,
+                                          use_rth, format_date, keep_up_to_date, chart_options)
+            try:
+                return take_history_response(req, timeout)
+            except RuntimeError:
+                if not req.done:
+                    self.client.cancelHistoricalData(req.id)
+                raise
+
+        resp = paced_request(code, request_key, limited, request)
         # 返回排好序的数据
         return sorted(resp, key=lambda bar: bar.date)
 
@@ -494,6 +677,10 @@ class IBMinBar(BarHistoryTimeSeriesType, IBHistoryBar):
     def name(self) -> str:
         return "ibMinBar"
 
+    def ingestion_batch_span(self) -> Timedelta:
+        # 每批10天，批内按天切分的请求会并发的下载
+        return Timedelta(days=10)
+
     def load_history_data(self, command: HistoryDataQueryCommand) -> List[Bar]:
         code_to_bars: Dict[str, List[BarData]] = self.sync_load_data_in_batch(command, "1 min", "TRADES", 1,
                                                                               1, False, None)
@@ -564,56 +751,82 @@ class IB10SecondBar(BarHistoryTimeSeriesType, IBHistoryBar):
 class IBHistoryTick(EWrapper):
 
     def historicalTicksLast(self, reqId: int, ticks: ListOfHistoricalTickLast, done: bool):
-        req = Request.find(reqId)
-        if req.resp:
-            req.resp.extend(ticks)
-        else:
-            req.resp = ticks
-        if done:
-            if req.condition.acquire():
-                req.condition.notifyAll()
-                req.condition.release()
+        self._on_ticks(reqId, ticks, done)
 
     def historicalTicks(self, reqId: int, ticks: ListOfHistoricalTick, done: bool):
-        req = Request.find(reqId)
-        if req.resp:
-            req.resp.extend(ticks)
-        else:
-            req.resp = ticks
-        if done:
-            if req.condition.acquire():
-                req.condition.notifyAll()
-                req.condition.release()
+        self._on_ticks(reqId, ticks, done)
 
     def historicalTicksBidAsk(self, reqId: int, ticks: ListOfHistoricalTickBidAsk, done: bool):
+        self._on_ticks(reqId, ticks, done)
+
+    def _on_ticks(self, reqId: int, ticks: List, done: bool):
         req = Request.find(reqId)
         if req.resp:
             req.resp.extend(ticks)
         else:
-            req.resp = ticks
+            req.resp = list(ticks)
         if done:
-            if req.condition.acquire():
-                req.condition.notifyAll()
-                req.condition.release()
+            req.finish()
+
+    def error(self, reqId: TickerId, errorCode: int, errorString: str):
+        Request.find(reqId).finish(errorCode, errorString)
+
+    def sync_load_ticks(self, command: HistoryDataQueryCommand, what_to_show: str, use_rth: int,
+                        ignore_size: bool, misc_options: List) -> Dict[str, List]:
+        """
+        将command的区间按天切分成时间片，所有(code, 时间片)交给调度器并发的下载，每个时间片内部按页顺序的下载
+        :return: 每个code按照时间排好序的tick
+        """
+        if not command.start or not command.end:
+            raise RuntimeError("start和end必传")
+        slices = [(code, slice_start, slice_end) for slice_start, slice_end in
+                  self.plan_slices(command.start, command.end) for code in command.codes]
+        scheduler = history_scheduler if history_scheduler else HistoryDownloadScheduler()
+        results = scheduler.run([functools.partial(self.sync_load_history_tick_in_batch, code, slice_start,
+                                                   slice_end, what_to_show, use_rth, ignore_size, misc_options)
+                                 for code, slice_start, slice_end in slices])
+        code_to_ticks = {code: [] for code in command.codes}
+        for (code, _, _), ticks in sorted(zip(slices, results), key=lambda item: item[0][1]):
+            code_to_ticks[code].extend(ticks)
+        return code_to_ticks
+
+    @classmethod
+    def plan_slices(cls, start: Timestamp, end: Timestamp) -> List[Tuple[Timestamp, Timestamp]]:
+        """
+        按天切分[start, end]，tick的时间精度是秒，所以相邻的时间片之间相差一秒
+        """
+        one_second = Timedelta(seconds=1)
+        slices = []
+        slice_start = start
+        while slice_start <= end:
+            slice_end = min(slice_start.normalize() + Timedelta(days=1) - one_second, end)
+            slices.append((slice_start, slice_end))
+            slice_start = slice_end + one_second
+        return slices
 
     def sync_load_history_tick_in_batch(self, code, start_time: Timestamp, end_time: Timestamp,
                                         what_to_show: str, use_rth: int, ignore_size: bool, misc_options: List,
                                         timeout=20, batch_size=1000):
+        """
+        从start_time开始逐页的下载，直到超过end_time，只返回[start_time, end_time]之间的数据
+        """
         if not start_time or not end_time:
             raise RuntimeError("start_time和end_time必传")
         res = []
         while True:
             ticks = self.sync_load_history_tick(code, start_time, None, batch_size, what_to_show, use_rth, ignore_size,
                                                 misc_options, timeout)
+            if len(ticks) <= 0:
+                break
             res.extend(ticks)
-            batch_end_time = Timestamp(res[-1].time, unit='s', tz='Asia/Shanghai')
-            next_batch_start = batch_end_time + Timedelta(seconds=1)
+            batch_end_time = Timestamp(ticks[-1].time, unit='s', tz='Asia/Shanghai')
             if batch_end_time >= end_time:
                 break
             if len(ticks) < batch_size:
                 break
-            start_time = next_batch_start
-        return res
+            start_time = batch_end_time + Timedelta(seconds=1)
+        end_seconds = end_time.timestamp()
+        return [tick for tick in res if tick.time <= end_seconds]
 
     def sync_load_history_tick(self, code, start_time: Timestamp, end_time: Timestamp, number_of_ticks: int,
                                what_to_show: str, use_rth: int, ignore_size: bool, misc_options: List, timeout=20):
@@ -630,8 +843,6 @@ class IBHistoryTick(EWrapper):
         :param timeout:
         :return:
         """
-        req = Request(self, code)
-        contract = self.client.code_to_contract(code)
         if not start_time and not end_time:
             raise RuntimeError("必须指定start_time或者end_time")
         if start_time and end_time:
@@ -640,14 +851,16 @@ class IBHistoryTick(EWrapper):
             raise RuntimeError("number_of_ticks不能大于1000")
         start_time_str = start_time.strftime("%Y%m%d %H:%M:%S") if start_time is not None else ""
         end_time_str = end_time.strftime("%Y%m%d %H:%M:%S") if end_time is not None else ""
-        self.client.reqHistoricalTicks(req.id, contract, start_time_str, end_time_str, number_of_ticks, what_to_show,
-                                       use_rth, ignore_size, misc_options)
-        if req.condition.acquire():
-            req.condition.wait(timeout)
-        if not req.resp:
-            raise RuntimeError("获取数据超时或者没有获取到数据")
-        resp = req.resp
-        Request.clear(req.id)
+        request_key = "tick:{}:{}:{}:{}:{}".format(code, start_time_str, end_time_str, number_of_ticks, what_to_show)
+
+        def request():
+            req = Request(self, code)
+            contract = self.client.code_to_contract(code)
+            self.client.reqHistoricalTicks(req.id, contract, start_time_str, end_time_str, number_of_ticks,
+                                           what_to_show, use_rth, ignore_size, misc_options)
+            return take_history_response(req, timeout)
+
+        resp = paced_request(code, request_key, True, request)
         # 返回排好序的数据
         return sorted(resp, key=lambda tick: tick.time)
 
@@ -666,28 +879,31 @@ class IBBidAsk(HistoryTimeSeriesType, IBHistoryTick):
 
     def load_history_data(self, command: HistoryDataQueryCommand) -> List[TSData]:
         res = []
+        code_to_ticks = self.sync_load_ticks(command, "BID_ASK", 1, True, None)
         for code in command.codes:
-            bid_asks: List[HistoricalTickBidAsk] = \
-                self.sync_load_history_tick_in_batch(code, command.start, command.end, "BID_ASK", 1,
-                                                     True, None)
+            bid_asks: List[HistoricalTickBidAsk] = code_to_ticks[code]
             for bid_ask in bid_asks:
                 visible_time = Timestamp(bid_ask.time, unit='s', tz='Asia/Shanghai')
-                provider_data = {"bid_price": bid_ask.priceBid, "ask_price": bid_ask.priceAsk,
-                                 "bid_size": bid_ask.sizeBid, "ask_size": bid_ask.sizeAsk}
+                provider_data = {"bid_price": float(bid_ask.priceBid), "ask_price": float(bid_ask.priceAsk),
+                                 "bid_size": int(bid_ask.sizeBid), "ask_size": int(bid_ask.sizeAsk)}
                 ts_data = TSData(self.name(), visible_time, code, provider_data)
                 res.append(ts_data)
         return res
 
     def columns(self) -> List[Column]:
-        # 由于该时序类型不会缓存到本地，所以可以不用定义columns
-        return []
+        columns = [Column("bid_price", float, None, None, None), Column("ask_price", float, None, None, None),
+                   Column("bid_size", int, None, None, None), Column("ask_size", int, None, None, None)]
+        return columns
 
     def name(self) -> str:
         return 'ibBidAsk'
 
-    def should_cache(self):
+    def unique_visible_time(self):
         return False
 
+    def ingestion_batch_span(self) -> Timedelta:
+        return Timedelta(days=1)
+
     def __init__(self):
         HistoryTimeSeriesType.__init__(self)
         IBHistoryTick.__init__(self)
@@ -702,27 +918,29 @@ class IBTrade(HistoryTimeSeriesType, IBHistoryTick):
 
     def load_history_data(self, command: HistoryDataQueryCommand) -> List[TSData]:
         res = []
+        code_to_ticks = self.sync_load_ticks(command, "TRADES", 1, True, None)
         for code in command.codes:
-            trades: List[HistoricalTick] = \
-                self.sync_load_history_tick_in_batch(code, command.start, command.end, "TRADES", 1,
-                                                     True, None)
+            trades: List[HistoricalTick] = code_to_ticks[code]
             for trade in trades:
                 visible_time = Timestamp(trade.time, unit='s', tz='Asia/Shanghai')
-                provider_data = {"price": trade.price, "size": trade.size}
+                provider_data = {"price": float(trade.price), "size": int(trade.size)}
                 ts_data = TSData(self.name(), visible_time, code, provider_data)
                 res.append(ts_data)
         return res
 
     def columns(self) -> List[Column]:
-        # 由于该时序类型不会缓存到本地，所以可以不用定义columns
-        return []
+        columns = [Column("price", float, None, None, None), Column("size", int, None, None, None)]
+        return columns
 
     def name(self) -> str:
         return 'ibTrade'
 
-    def should_cache(self):
+    def unique_visible_time(self):
         return False
 
+    def ingestion_batch_span(self) -> Timedelta:
+        return Timedelta(days=1)
+
     def __init__(self):
         HistoryTimeSeriesType.__init__(self)
         IBHistoryTick.__init__(self)
@@ -0,0 +1,419 @@
+# 本地列式存储的仓库实现。每个(时序类型, code)的数据按月分区，每个分区是一个npz文件，文件中的每一列都是有类型的numpy数组，
+# 读取的时候整列加载，避免了Cassandra逐行读取以及逐行json反序列化的开销。
+# tick这类visible_time不唯一的时序类型数据量大，按天分区，并且使用差值编码之后压缩存储
+from __future__ import annotations
+
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from se2.domain.time_series import *
+
+LOCAL_TZ = 'Asia/Shanghai'
+VISIBLE_TIME = 'visible_time'
+PARTITION_SUFFIX = '.npz'
+TIME_SERIES_FILE = 'time_series.json'
+DELTA_PREFIX = 'delta:'
+FIXED_PREFIX = 'fixed'
+FIXED_POINT_SCALES = (2, 4, 6)
+
+
+def to_ns(t: Timestamp) -> int:
+    """
+    将时间转换成UTC的纳秒数，所有的时间列都以这种形式存储
+    """
+    return Timestamp(t).value
+
+
+def partition_key(ns: np.ndarray) -> np.ndarray:
+    """
+    根据visible_time(UTC纳秒)计算所属的月分区，分区名形如202001
+    """
+    months = ns.astype('datetime64[ns]').astype('datetime64[M]').astype(int)
+    return (months // 12 + 1970) * 100 + months % 12 + 1
+
+
+def day_partition_key(ns: np.ndarray) -> np.ndarray:
+    """
+    根据visible_time(UTC纳秒)计算所属的天分区，分区名形如20200102
+    """
+    days = ns.astype('datetime64[ns]').astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    month_ints = months.astype(int)
+    return (month_ints // 12 + 1970) * 10000 + (month_ints % 12 + 1) * 100 + (days - months).astype(int) + 1
+
+
+def encode_column(name: str, arr: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    整数列(包括时间列)存储相邻元素的差值；能够无损的表示成定点数的浮点列先转换成定点整数再存储差值。
+    有序的时间以及变化不大的价格的差值都很小，压缩率更高
+    """
+    if arr.dtype == np.int64:
+        return {DELTA_PREFIX + name: np.diff(arr, prepend=0)}
+    if arr.dtype == np.float64 and len(arr) > 0 and np.all(np.isfinite(arr)):
+        for scale in FIXED_POINT_SCALES:
+            fixed = np.round(arr * 10 ** scale)
+            if np.abs(fixed).max() < 2 ** 53 and np.array_equal(fixed / 10 ** scale, arr):
+                return {"{}{}:{}".format(FIXED_PREFIX, scale, name): np.diff(fixed.astype(np.int64), prepend=0)}
+    return {name: arr}
+
+
+def decode_column(key: str, arr: np.ndarray) -> Tuple[str, np.ndarray]:
+    if key.startswith(DELTA_PREFIX):
+        return key[len(DELTA_PREFIX):], np.cumsum(arr)
+    if key.startswith(FIXED_PREFIX) and ':' in key:
+        scale, name = key[len(FIXED_PREFIX):].split(':', 1)
+        return name, np.cumsum(arr) / 10 ** int(scale)
+    return key, arr
+
+
+def to_array(column: Column, values: List) -> np.ndarray:
+    if column.tp == float:
+        return np.array(values, dtype=np.float64)
+    if column.tp == int:
+        return np.array(values, dtype=np.int64)
+    if column.tp == Timestamp:
+        return np.array([to_ns(v) for v in values], dtype=np.int64)
+    if column.tp == str:
+        return np.array(values, dtype=str)
+    raise RuntimeError("不支持的列类型:{}".format(column.tp))
+
+
+def from_array(column: Column, arr: np.ndarray):
+    """
+    将存储的列还原成values中使用的类型，时间列会一次性的转换时区
+    """
+    if column.tp == Timestamp:
+        return pd.to_datetime(arr, utc=True).tz_convert(LOCAL_TZ)
+    return arr
+
+
+def atomic_write(path: str, write_func):
+    """
+    先写临时文件再替换，保证读者不会读到写了一半的分区
+    """
+    tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+    write_func(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class ColumnarPartition(object):
+    """
+    一个分区内的数据，按照visible_time排好序并且去重
+    """
+
+    def __init__(self, visible_time: np.ndarray, columns: Dict[str, np.ndarray]):
+        self.visible_time = visible_time
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.visible_time)
+
+    def merge(self, other: ColumnarPartition) -> ColumnarPartition:
+        """
+        合并两个分区，相同visible_time的数据以other为准
+        """
+        visible_time = np.concatenate([self.visible_time, other.visible_time])
+        columns = {}
+        for name in other.columns:
+            if name not in self.columns:
+                raise RuntimeError("分区的列不一致:{}".format(name))
+            columns[name] = np.concatenate([self.columns[name], other.columns[name]])
+        return ColumnarPartition(visible_time, columns).normalized()
+
+    def normalized(self) -> ColumnarPartition:
+        # 倒序之后取第一次出现的位置，即保留最后写入的数据
+        reversed_time = self.visible_time[::-1]
+        _, idx = np.unique(reversed_time, return_index=True)
+        idx = len(reversed_time) - 1 - idx
+        return self.take(idx)
+
+    def sorted(self) -> ColumnarPartition:
+        """
+        稳定排序，visible_time相同的数据保持写入时的顺序
+        """
+        return self.take(np.argsort(self.visible_time, kind='stable'))
+
+    def replace_range(self, other: ColumnarPartition) -> ColumnarPartition:
+        """
+        用other替换掉other的时间范围内已有的数据，用于visible_time不唯一的数据，同一个时间范围重复写入的时候不会重复
+        """
+        if len(other) <= 0:
+            return self
+        other = other.sorted()
+        keep = np.nonzero((self.visible_time < other.visible_time[0]) | (self.visible_time > other.visible_time[-1]))[0]
+        kept = self.take(keep)
+        columns = {name: np.concatenate([kept.columns[name], other.columns[name]]) for name in other.columns}
+        return ColumnarPartition(np.concatenate([kept.visible_time, other.visible_time]), columns).sorted()
+
+    def take(self, idx: np.ndarray) -> ColumnarPartition:
+        return ColumnarPartition(self.visible_time[idx], {name: arr[idx] for name, arr in self.columns.items()})
+
+    def between(self, start_ns: int, end_ns: int) -> ColumnarPartition:
+        lo = np.searchsorted(self.visible_time, start_ns, side='left') if start_ns is not None else 0
+        hi = np.searchsorted(self.visible_time, end_ns, side='right')
+        return self.take(np.arange(lo, hi))
+
+    def tail(self, n: int) -> ColumnarPartition:
+        return self.take(np.arange(max(len(self) - n, 0), len(self)))
+
+    @classmethod
+    def load(cls, path: str) -> ColumnarPartition:
+        with np.load(path, allow_pickle=False) as f:
+            columns = dict([decode_column(key, f[key]) for key in f.files])
+            visible_time = columns.pop(VISIBLE_TIME)
+            return ColumnarPartition(visible_time, columns)
+
+    def dump(self, path: str, compact: bool = False):
+        """
+        :param compact: 是否差值编码之后压缩存储
+        """
+        arrays = dict(self.columns)
+        arrays[VISIBLE_TIME] = self.visible_time
+        if compact:
+            encoded = {}
+            for name, arr in arrays.items():
+                encoded.update(encode_column(name, arr))
+            arrays = encoded
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                if compact:
+                    np.savez_compressed(f, **arrays)
+                else:
+                    np.savez(f, **arrays)
+
+        atomic_write(path, write)
+
+
+class LocalTSDataRepoImpl(TSDataRepo):
+    """
+    数据目录结构为 root_dir/时序类型/code/月份.npz，visible_time不唯一的时序类型为 root_dir/时序类型/code/日期.npz
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.lock = threading.Lock()
+
+    def _code_dir(self, ts_name: str, code: str):
+        return os.path.join(self.root_dir, ts_name, code)
+
+    def _partitions(self, ts_name: str, code: str) -> List[int]:
+        code_dir = self._code_dir(ts_name, code)
+        if not os.path.exists(code_dir):
+            return []
+        return sorted([int(f[:-len(PARTITION_SUFFIX)]) for f in os.listdir(code_dir) if f.endswith(PARTITION_SUFFIX)])
+
+    def _partition_path(self, ts_name: str, code: str, key: int):
+        return os.path.join(self._code_dir(ts_name, code), "{}{}".format(key, PARTITION_SUFFIX))
+
+    def _history_type(self, ts_name) -> HistoryTimeSeriesType:
+        func = TSTypeRegistry.find_function(ts_name)
+        if not isinstance(func, HistoryTimeSeriesType):
+            raise RuntimeError("非法的tsType")
+        return func
+
+    def _partition_key_func(self, ts_name):
+        return partition_key if self._history_type(ts_name).unique_visible_time() else day_partition_key
+
+    def save(self, ts_list: List[TSData]):
+        groups: Dict[Tuple[str, str], List[TSData]] = {}
+        for ts_data in ts_list:
+            groups.setdefault((ts_data.ts_type_name, ts_data.code), []).append(ts_data)
+
+        for (ts_name, code), data_list in groups.items():
+            func = self._history_type(ts_name)
+            visible_time = np.array([to_ns(ts_data.visible_time) for ts_data in data_list], dtype=np.int64)
+            columns = {column.name: to_array(column, [ts_data.values[column.name] for ts_data in data_list])
+                       for column in func.columns()}
+            self._save_columns(ts_name, code, visible_time, columns)
+
+    def save_df(self, ts_name, df: DataFrame):
+        func = self._history_type(ts_name)
+        level_codes = df.index.get_level_values(1)
+        level_times = df.index.get_level_values(0)
+        for code in level_codes.unique():
+            mask = np.asarray(level_codes == code)
+            visible_time = np.asarray(pd.DatetimeIndex(level_times[mask]).asi8)
+            columns = {}
+            for column in func.columns():
+                values = df[column.name].values[mask]
+                if column.tp == float:
+                    columns[column.name] = np.asarray(values, dtype=np.float64)
+                elif column.tp == int:
+                    columns[column.name] = np.asarray(values, dtype=np.int64)
+                elif column.tp == Timestamp:
+                    columns[column.name] = np.asarray(pd.DatetimeIndex(pd.to_datetime(values, utc=True)).asi8)
+                else:
+                    columns[column.name] = to_array(column, list(values))
+            self._save_columns(ts_name, code, visible_time, columns)
+
+    def _save_columns(self, ts_name: str, code: str, visible_time: np.ndarray, columns: Dict[str, np.ndarray]):
+        func = self._history_type(ts_name)
+        unique = func.unique_visible_time()
+        keys = self._partition_key_func(ts_name)(visible_time)
+        os.makedirs(self._code_dir(ts_name, code), exist_ok=True)
+        for key in np.unique(keys):
+            new_partition = ColumnarPartition(visible_time, columns).take(np.nonzero(keys == key)[0])
+            path = self._partition_path(ts_name, code, int(key))
+            with self.lock:
+                if not unique:
+                    partition = ColumnarPartition.load(path).replace_range(new_partition) \
+                        if os.path.exists(path) else new_partition.sorted()
+                elif os.path.exists(path):
+                    partition = ColumnarPartition.load(path).merge(new_partition)
+                else:
+                    partition = new_partition.normalized()
+                partition.dump(path, compact=not unique)
+
+    def delete(self, ts_name: str, code: str, start: Timestamp, end: Timestamp):
+        """
+        完全在范围内的分区直接删除文件，部分在范围内的分区重写剩下的数据
+        """
+        unique = self._history_type(ts_name).unique_visible_time()
+        key_func = self._partition_key_func(ts_name)
+        start_ns, end_ns = to_ns(start), to_ns(end)
+        start_key, end_key = key_func(np.array([start_ns, end_ns]))
+        for key in self._partitions(ts_name, code):
+            if key < start_key or key > end_key:
+                continue
+            path = self._partition_path(ts_name, code, key)
+            with self.lock:
+                partition = ColumnarPartition.load(path)
+                lo = np.searchsorted(partition.visible_time, start_ns, side='left')
+                hi = np.searchsorted(partition.visible_time, end_ns, side='right')
+                if lo >= hi:
+                    continue
+                if lo == 0 and hi == len(partition):
+                    os.remove(path)
+                else:
+                    partition.take(np.concatenate([np.arange(0, lo), np.arange(hi, len(partition))])) \
+                        .dump(path, compact=not unique)
+
+    def load_partitions(self, ts_name: str, code: str, command: HistoryDataQueryCommand) -> List[ColumnarPartition]:
+        """
+        读取command范围内的分区，并且裁剪到command的范围
+        """
+        key_func = self._partition_key_func(ts_name)
+        end_ns = to_ns(command.end)
+        end_key = key_func(np.array([end_ns]))[0]
+        keys = [key for key in self._partitions(ts_name, code) if key <= end_key]
+        res = []
+        if command.start:
+            start_ns = to_ns(command.start)
+            start_key = key_func(np.array([start_ns]))[0]
+            for key in keys:
+                if key >= start_key:
+                    res.append(ColumnarPartition.load(self._partition_path(ts_name, code, key))
+                               .between(start_ns, end_ns))
+        else:
+            # window模式，从后往前读取分区，直到数据量满足window
+            count = 0
+            for key in reversed(keys):
+                partition = ColumnarPartition.load(self._partition_path(ts_name, code, key)) \
+                    .between(None, end_ns).tail(command.window - count)
+                res.insert(0, partition)
+                count += len(partition)
+                if count >= command.window:
+                    break
+        return [p for p in res if len(p) > 0]
+
+    def query(self, ts_name, command):
+        func = self._history_type(ts_name)
+        data_list: List[TSData] = []
+        for code in command.codes:
+            for partition in self.load_partitions(ts_name, code, command):
+                visible_times = from_array(Column(VISIBLE_TIME, Timestamp, None, None, None), partition.visible_time)
+                columns = {}
+                for column in func.columns():
+                    arr = from_array(column, partition.columns[column.name])
+                    columns[column.name] = arr.tolist() if isinstance(arr, np.ndarray) else arr
+                for i in range(len(partition)):
+                    values = {name: columns[name][i] for name in columns}
+                    data_list.append(TSData(ts_name, visible_times[i], code, values))
+        return data_list
+
+    def query_df(self, ts_name, command) -> DataFrame:
+        func = self._history_type(ts_name)
+        column_names = [column.name for column in func.columns()]
+        partitions: List[ColumnarPartition] = []
+        codes = []
+        for code in sorted(command.codes):
+            for partition in self.load_partitions(ts_name, code, command):
+                partitions.append(partition)
+                codes.append(np.full(len(partition), code, dtype=object))
+        if len(partitions) <= 0:
+            return to_data_frame([], column_names)
+        visible_time = from_array(Column(VISIBLE_TIME, Timestamp, None, None, None),
+                                  np.concatenate([partition.visible_time for partition in partitions]))
+        columns = {column.name: from_array(column, np.concatenate([p.columns[column.name] for p in partitions]))
+                   for column in func.columns()}
+        visible_time, codes, columns = merge_code_streams(visible_time, np.concatenate(codes), columns)
+        return build_data_frame(visible_time, codes, columns, column_names)
+
+
+class LocalTimeSeriesRepoImpl(TimeSeriesRepo):
+    """
+    时间序列的DataRecord保存在 root_dir/时序类型/time_series.json
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.root_dir, name, TIME_SERIES_FILE)
+
+    @classmethod
+    def _to_json(cls, dr: DataRecord) -> Dict:
+        return {'code': dr.code, 'start': str(dr.start), 'end': str(dr.end),
+                'intervals': [[str(start), str(end)] for start, end in dr.intervals]}
+
+    def _write(self, name: str, data_record: Dict):
+        os.makedirs(os.path.join(self.root_dir, name), exist_ok=True)
+
+        def write(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump({'name': name, 'data_record': data_record}, f)
+
+        atomic_write(self._path(name), write)
+
+    def save(self, ts: TimeSeries):
+        with self.lock:
+            self._write(ts.name, {code: self._to_json(dr) for code, dr in ts.data_record.items()})
+
+    def save_record(self, ts: TimeSeries, code: str):
+        # 读取文件中最新的内容，只替换这一个code
+        with self.lock:
+            data_record = {}
+            if os.path.exists(self._path(ts.name)):
+                with open(self._path(ts.name)) as f:
+                    data_record = json.load(f)['data_record']
+            if code in ts.data_record:
+                data_record[code] = self._to_json(ts.data_record[code])
+            else:
+                data_record.pop(code, None)
+            self._write(ts.name, data_record)
+
+    def find_one(self, name):
+        ts = TimeSeries()
+        path = self._path(name)
+        if os.path.exists(path):
+            with open(path) as f:
+                dt = json.load(f)
+            # 多段覆盖范围之前写入的文件没有intervals，只有[start, end]一段
+            data_record = {code: DataRecord(v['code'], Timestamp(v['start']), Timestamp(v['end']),
+                                            [(Timestamp(start), Timestamp(end)) for start, end in v['intervals']]
+                                            if v.get('intervals') else None)
+                           for code, v in dt['data_record'].items()}
+            ts = TimeSeries(name=dt['name'], data_record=data_record)
+
+        # 查找该实例的方法
+        tp: TimeSeriesType = TSTypeRegistry.find_function(name)
+        if not tp:
+            raise RuntimeError("没有找到实例方法")
+        ts.with_type(tp)
+        return ts
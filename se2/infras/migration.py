@@ -0,0 +1,135 @@
+# 将time_series_data2中的时序数据迁移到按照交易时段分区的time_series_data3。
+# 迁移是在线进行的，迁移过程中SessionTSDataRepoImpl会同时读取旧表，新写入的数据直接写入新表；
+# 复制数据的时候沿用旧数据的写入时间戳，所以迁移期间新写入的数据不会被旧数据覆盖。
+# 用法: python -m se2.infras.migration --types ibMinBar,ibTrade --concurrency 8
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Tuple
+
+import numpy as np
+import trading_calendars
+from cassandra.concurrent import execute_concurrent
+from cassandra.cqlengine import connection
+from cassandra.cqlengine.management import sync_table
+from cassandra.query import BatchStatement, BatchType
+from pandas import Timestamp
+from trading_calendars import TradingCalendar
+
+from se2.infras.models import TimeSeriesDataModel, TimeSeriesSessionDataModel, TimeSeriesDataMigrationModel
+from se2.infras.repos import TradingSessionBucketer
+
+
+class TSDataMigration(object):
+    """
+    每个(type, code)是一个迁移任务，多个任务并发的执行。每个任务分页读取旧分区，按照交易时段分组之后批量写入新表，
+    完成之后记录到time_series_data_migration，再次执行的时候会跳过已经迁移完成的分区
+    """
+
+    def __init__(self, calendar: TradingCalendar, concurrency: int = 8, write_concurrency: int = 32,
+                 write_batch_size: int = 100, fetch_size: int = 5000):
+        self.bucketer = TradingSessionBucketer(calendar)
+        self.concurrency = concurrency
+        self.write_concurrency = write_concurrency
+        self.write_batch_size = write_batch_size
+        self.fetch_size = fetch_size
+
+    def partitions(self, ts_names: List[str] = None) -> List[Tuple[str, str]]:
+        """
+        旧表中还没有迁移的(type, code)
+        """
+        session = connection.get_session()
+        rows = session.execute("SELECT DISTINCT type, code FROM {}".format(TimeSeriesDataModel.column_family_name()))
+        migrated = {(row.type, row.code) for row in TimeSeriesDataMigrationModel.objects.all()}
+        return [(row[0], row[1]) for row in rows
+                if (not ts_names or row[0] in ts_names) and (row[0], row[1]) not in migrated]
+
+    def migrate_partition(self, ts_name: str, code: str) -> int:
+        session = connection.get_session()
+        select_stmt = session.prepare("SELECT visible_time, data, data_bin, WRITETIME(data), WRITETIME(data_bin) "
+                                      "FROM {} WHERE type=? AND code=?"
+                                      .format(TimeSeriesDataModel.column_family_name()))
+        select_stmt.fetch_size = self.fetch_size
+        insert_cql = "INSERT INTO {} (type, code, trading_session, visible_time, {}) VALUES (?, ?, ?, ?, ?) " \
+                     "USING TIMESTAMP ?"
+        table = TimeSeriesSessionDataModel.column_family_name()
+        bin_stmt = session.prepare(insert_cql.format(table, 'data_bin'))
+        json_stmt = session.prepare(insert_cql.format(table, 'data'))
+
+        count = 0
+        chunk = []
+        # 驱动会在迭代的时候自动翻页，内存中最多只保留一页数据
+        for row in session.execute(select_stmt, (ts_name, code)):
+            chunk.append(row)
+            if len(chunk) >= self.fetch_size:
+                self._copy(ts_name, code, chunk, bin_stmt, json_stmt)
+                count += len(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            self._copy(ts_name, code, chunk, bin_stmt, json_stmt)
+            count += len(chunk)
+
+        TimeSeriesDataMigrationModel.create(type=ts_name, code=code, rows=count,
+                                            migrated_time=Timestamp.now(tz='UTC')).save()
+        return count
+
+    def _copy(self, ts_name: str, code: str, rows: List[Tuple], bin_stmt, json_stmt):
+        session_ids = self.bucketer.session_ids(
+            np.array([Timestamp(row[0], tz='UTC').value for row in rows], dtype=np.int64))
+        groups = {}
+        for row, session_id in zip(rows, session_ids.tolist()):
+            visible_time, data, data_bin, data_write_time, bin_write_time = row
+            if data_bin:
+                param = (bin_stmt, (ts_name, code, session_id, visible_time, data_bin, bin_write_time))
+            else:
+                param = (json_stmt, (ts_name, code, session_id, visible_time, data, data_write_time))
+            groups.setdefault(session_id, []).append(param)
+
+        batches = []
+        for params in groups.values():
+            for i in range(0, len(params), self.write_batch_size):
+                batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                for stmt, param in params[i: i + self.write_batch_size]:
+                    batch.add(stmt, param)
+                batches.append((batch, None))
+        for success, result in execute_concurrent(connection.get_session(), batches,
+                                                  concurrency=self.write_concurrency, raise_on_first_error=False):
+            if not success:
+                raise result
+
+    def run(self, ts_names: List[str] = None):
+        partitions = self.partitions(ts_names)
+        logging.info("需要迁移的分区数:{}".format(len(partitions)))
+        start_time = time.time()
+        total = 0
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ts_data_migration') as executor:
+            futures = {executor.submit(self.migrate_partition, ts_name, code): (ts_name, code)
+                       for ts_name, code in partitions}
+            for k, future in enumerate(as_completed(futures)):
+                ts_name, code = futures[future]
+                try:
+                    count = future.result()
+                    total += count
+                    logging.info("[{}/{}] {}:{} 迁移完成, 数据量:{}".format(k + 1, len(partitions), ts_name, code, count))
+                except Exception:
+                    import traceback
+                    logging.error("{}:{} 迁移失败:{}".format(ts_name, code, traceback.format_exc()))
+                    failed.append((ts_name, code))
+        logging.info("迁移结束, 共迁移{}条数据, 耗时:{:.0f}s, 失败的分区:{}".format(total, time.time() - start_time, failed))
+        if len(failed) > 0:
+            raise RuntimeError("有{}个分区迁移失败，重新执行即可继续迁移".format(len(failed)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="将time_series_data2迁移到按照交易时段分区的time_series_data3")
+    parser.add_argument('--types', help="要迁移的时序类型，逗号分隔，默认迁移全部")
+    parser.add_argument('--calendar', default='NYSE', help="用于划分交易时段的交易日历")
+    parser.add_argument('--concurrency', type=int, default=8, help="同时迁移的分区数量")
+    args = parser.parse_args()
+    # 迁移之前确保新表以及迁移进度表已经创建
+    sync_table(TimeSeriesSessionDataModel)
+    sync_table(TimeSeriesDataMigrationModel)
+    TSDataMigration(trading_calendars.get_calendar(args.calendar), concurrency=args.concurrency) \
+        .run(args.types.split(",") if args.types else None)
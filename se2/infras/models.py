@@ -84,6 +84,8 @@ class DataRecordModel(UserType):
     code = columns.Text(required=True)
     start_time = columns.DateTime(required=True)
     end_time = columns.DateTime(required=True)
+    # 已经缓存了的所有时间范围，start_time和end_time是这些范围的最小值和最大值
+    intervals = columns.List(value_type=columns.Tuple(columns.DateTime, columns.DateTime), default=[])
 
 
 class TimeSeriesModel(Model):
@@ -97,4 +99,31 @@ class TimeSeriesDataModel(Model):
     type = columns.Text(required=True, primary_key=True)
     code = columns.Text(required=True, primary_key=True)
     visible_time = columns.DateTime(required=True, primary_key=True, clustering_order="ASC")
-    data = columns.Text(required=True)
+    # 历史数据是json格式的data，新写入的数据如果时序类型支持定长编码，则写入data_bin
+    data = columns.Text()
+    data_bin = columns.Blob()
+
+
+class TimeSeriesSessionDataModel(Model):
+    """
+    按照(type, code, trading_session)分区的时序数据，trading_session是交易时段的id(形如20200102)，
+    避免一个code的全部历史数据都落在同一个无限增长的分区中
+    """
+    __table_name__ = "time_series_data3"
+    type = columns.Text(required=True, partition_key=True)
+    code = columns.Text(required=True, partition_key=True)
+    trading_session = columns.Integer(required=True, partition_key=True)
+    visible_time = columns.DateTime(required=True, primary_key=True, clustering_order="ASC")
+    data = columns.Text()
+    data_bin = columns.Blob()
+
+
+class TimeSeriesDataMigrationModel(Model):
+    """
+    记录time_series_data2中已经迁移到time_series_data3的分区
+    """
+    __table_name__ = "time_series_data_migration"
+    type = columns.Text(required=True, primary_key=True)
+    code = columns.Text(required=True, primary_key=True)
+    rows = columns.BigInt()
+    migrated_time = columns.DateTime()
@@ -1,4 +1,11 @@
-from cassandra.cqlengine.query import ModelQuerySet, BatchQuery
+import threading
+import time
+from collections import Counter
+
+from cassandra.concurrent import execute_concurrent_with_args, execute_concurrent
+from cassandra.cqlengine import connection
+from cassandra.cqlengine.query import ModelQuerySet
+from cassandra.query import PreparedStatement, BatchStatement, BatchType
 
 from se2.domain.account import AccountRepo, AbstractAccount, OrderRepo, Order, LimitOrder, Execution, PriceChange, \
     OrderDirection, MKTOrder, StopOrder, OrderStatus, Bargainer
@@ -21,9 +28,18 @@ class TimeSeriesRepoImpl(TimeSeriesRepo):
         data_record_map = {}
         for code in ts.data_record.keys():
             dr: DataRecord = ts.data_record[code]
-            data_record_map[code] = DataRecordModel(code=dr.code, start_time=dr.start, end_time=dr.end)
+            data_record_map[code] = DataRecordModel(code=dr.code, start_time=dr.start, end_time=dr.end,
+                                                    intervals=dr.intervals)
         TimeSeriesModel.create(name=ts.name, data_record=data_record_map).save()
 
+    def save_record(self, ts: TimeSeries, code: str):
+        if code in ts.data_record:
+            dr: DataRecord = ts.data_record[code]
+            TimeSeriesModel.objects(name=ts.name).update(data_record__update={
+                code: DataRecordModel(code=dr.code, start_time=dr.start, end_time=dr.end, intervals=dr.intervals)})
+        else:
+            TimeSeriesModel.objects(name=ts.name).update(data_record__remove={code})
+
     def find_one(self, name):
         ts = TimeSeries()
         r: ModelQuerySet = TimeSeriesModel.objects(name=name)
@@ -32,8 +48,10 @@ class TimeSeriesRepoImpl(TimeSeriesRepo):
             data_record = {}
             for key in model.data_record.keys():
                 dr_model: DataRecordModel = model.data_record[key]
+                intervals = [(Timestamp(start, tz='UTC'), Timestamp(end, tz='UTC'))
+                             for start, end in dr_model.intervals] if dr_model.intervals else None
                 data_record[key] = DataRecord(dr_model.code, Timestamp(dr_model.start_time, tz='UTC'),
-                                              Timestamp(dr_model.end_time, tz='UTC'))
+                                              Timestamp(dr_model.end_time, tz='UTC'), intervals)
             ts = TimeSeries(name=model.name, data_record=data_record)
         elif r.count() > 1:
             raise RuntimeError("wrong data")
@@ -47,37 +65,408 @@ class TimeSeriesRepoImpl(TimeSeriesRepo):
 
 
 class TSDataRepoImpl(TSDataRepo):
+    """
+    每个(type, code)是Cassandra中的一个分区，查询的时候每个分区使用一个prepared statement并发的查询，
+    同时在途的请求数量由read_concurrency限制，每个分区的数据按照fetch_size分页获取。
+    写入同样是按照分区并发的执行
+    """
+
+    def __init__(self, read_concurrency: int = 16, fetch_size: int = 5000, write_concurrency: int = 32,
+                 write_batch_size: int = 100):
+        self.read_concurrency = read_concurrency
+        self.fetch_size = fetch_size
+        self.write_concurrency = write_concurrency
+        self.write_batch_size = write_batch_size
+        self.statements: Dict[str, PreparedStatement] = {}
+        self.lock = threading.Lock()
+
+    def _prepare(self, cql: str) -> PreparedStatement:
+        with self.lock:
+            if cql not in self.statements:
+                stmt = connection.get_session().prepare(cql)
+                stmt.fetch_size = self.fetch_size
+                self.statements[cql] = stmt
+            return self.statements[cql]
+
     def query(self, ts_name, command):
+        func = TSTypeRegistry.find_function(ts_name)
+        if not isinstance(func, HistoryTimeSeriesType):
+            raise RuntimeError("非法的tsType")
+        rows = self._select_rows(ts_name, command, func)
+        if not func.unique_visible_time():
+            rows = self._expand_rows(func, rows)
+        values_list = self._decode_values(func, rows)
         data_list: List[TSData] = []
-        if command.start and command.end:
-            r: ModelQuerySet = TimeSeriesDataModel.objects.filter(type=ts_name, code__in=command.codes,
-                                                                  visible_time__gte=command.start,
-                                                                  visible_time__lte=command.end).limit(None)
-        else:
-            r: ModelQuerySet = TimeSeriesDataModel.objects.filter(type=ts_name, code__in=command.codes,
-                                                                  visible_time__lte=command.end) \
-                .order_by("-visible_time").limit(command.window)
+        for row, values in zip(rows, values_list):
+            visible_time = Timestamp(row[1], tz='UTC').tz_convert("Asia/Shanghai")
+            data_list.append(TSData(ts_name, visible_time, row[0], values))
+        return data_list
 
+    def query_df(self, ts_name, command) -> DataFrame:
         func = TSTypeRegistry.find_function(ts_name)
         if not isinstance(func, HistoryTimeSeriesType):
             raise RuntimeError("非法的tsType")
-        for row in r.all():
-            values: Dict[str, object] = func.deserialized(row.data)
-            visible_time = Timestamp(row.visible_time, tz='UTC').tz_convert("Asia/Shanghai")
-            ts_data = TSData(row.type, visible_time, row.code, values)
-            data_list.append(ts_data)
-        return data_list
+        column_names = [column.name for column in func.columns()]
+        rows = self._select_rows(ts_name, command, func)
+        if len(rows) <= 0:
+            return to_data_frame([], column_names)
+        codes = np.array([row[0] for row in rows], dtype=object)
+        visible_time = pd.to_datetime([row[1] for row in rows], utc=True).tz_convert('Asia/Shanghai')
+        if not func.unique_visible_time():
+            # 一行中打包了同一秒内的多条数据
+            counts = [len(row[3]) // func.codec.dtype.itemsize for row in rows]
+            codes = np.repeat(codes, counts)
+            visible_time = visible_time.repeat(counts)
+        visible_time, codes, columns = merge_code_streams(visible_time, codes, self._decode_columns(func, rows))
+        return build_data_frame(visible_time, codes, columns, column_names)
+
+    def _select_rows(self, ts_name, command, func: HistoryTimeSeriesType) -> List[Tuple]:
+        """
+        绕过cqlengine的模型对象，直接返回(code, visible_time, data, data_bin)元组，结果按照code的字母顺序排列，
+        每个code内部按照visible_time排序
+        """
+        rows = []
+        rows_by_code = self._select_partitions(ts_name, command)
+        for code in sorted(command.codes):
+            if not command.start and not func.unique_visible_time():
+                rows.extend(self._trim_packed_rows(func, rows_by_code[code], command.window))
+            else:
+                rows.extend(rows_by_code[code])
+        return rows
+
+    def _select_partitions(self, ts_name, command) -> Dict[str, List[Tuple]]:
+        table = TimeSeriesDataModel.column_family_name()
+        if command.start and command.end:
+            stmt = self._prepare("SELECT code, visible_time, data, data_bin FROM {} WHERE type=? AND code=? "
+                                 "AND visible_time>=? AND visible_time<=?".format(table))
+            params = [(ts_name, code, command.start, command.end) for code in command.codes]
+        else:
+            stmt = self._prepare("SELECT code, visible_time, data, data_bin FROM {} WHERE type=? AND code=? "
+                                 "AND visible_time<=? ORDER BY visible_time DESC LIMIT ?".format(table))
+            params = [(ts_name, code, command.end, command.window) for code in command.codes]
+
+        results = execute_concurrent_with_args(connection.get_session(), stmt, params,
+                                               concurrency=self.read_concurrency)
+        rows_by_code = {}
+        for code, (success, result) in zip(command.codes, results):
+            if not success:
+                raise result
+            rows = list(result)
+            if not command.start:
+                rows.reverse()
+            rows_by_code[code] = rows
+        return rows_by_code
+
+    def _trim_packed_rows(self, func: HistoryTimeSeriesType, rows: List[Tuple], window: int) -> List[Tuple]:
+        """
+        window模式查询的LIMIT限制的是行数(秒数)，每行至少打包了一条数据，所以查询结果的数据条数不少于window，
+        这里只保留最后的window条数据，第一行可能只保留后面的一部分
+        """
+        size = func.codec.dtype.itemsize
+        count = 0
+        for i in range(len(rows) - 1, -1, -1):
+            row_count = len(rows[i][3]) // size
+            if count + row_count >= window:
+                keep = window - count
+                first = (rows[i][0], rows[i][1], rows[i][2], rows[i][3][(row_count - keep) * size:])
+                return ([first] if keep > 0 else []) + list(rows[i + 1:])
+            count += row_count
+        return rows
+
+    def _expand_rows(self, func: HistoryTimeSeriesType, rows: List[Tuple]) -> List[Tuple]:
+        """
+        将打包了多条数据的行拆分成每条数据一行
+        """
+        size = func.codec.dtype.itemsize
+        return [(row[0], row[1], None, row[3][i: i + size]) for row in rows for i in range(0, len(row[3]), size)]
+
+    def _insert_cql(self, column: str) -> str:
+        return "INSERT INTO {} (type, code, visible_time, {}) VALUES (?, ?, ?, ?)" \
+            .format(TimeSeriesDataModel.column_family_name(), column)
+
+    def _group_by_partition(self, params: List[Tuple]) -> List[List[Tuple]]:
+        """
+        将同一个(type, code)的写入参数按照Cassandra的分区分组，返回的参数跟insert语句的占位符一一对应
+        """
+        return [params]
+
+    def _decode_values(self, func: HistoryTimeSeriesType, rows: List[Tuple]) -> List[Dict[str, object]]:
+        bin_rows = [row for row in rows if row[3]]
+        if len(bin_rows) > 0 and not func.codec:
+            raise RuntimeError("该时序类型不支持二进制编码")
+        decoded_values = iter(func.codec.decode_values([row[3] for row in bin_rows])) if len(bin_rows) > 0 else None
+        return [next(decoded_values) if row[3] else func.deserialized(row[2]) for row in rows]
+
+    def _decode_columns(self, func: HistoryTimeSeriesType, rows: List[Tuple]) -> Dict[str, object]:
+        if func.codec and all([row[3] for row in rows]):
+            return func.codec.decode([row[3] for row in rows])
+        # 兼容json格式的历史数据，逐行解码之后再转换成列
+        values_list = self._decode_values(func, rows)
+        columns = {}
+        for column in func.columns():
+            col_values = [values[column.name] for values in values_list]
+            if column.tp == Timestamp:
+                columns[column.name] = pd.to_datetime(col_values, utc=True).tz_convert('Asia/Shanghai')
+            else:
+                columns[column.name] = np.array(col_values)
+        return columns
 
     def save(self, ts_list: List[TSData]):
-        b = BatchQuery()
+        """
+        按照分区对数据进行分组，每个分区的数据切分成若干个不超过write_batch_size的单分区unlogged batch，
+        然后异步的写入，同时在途的batch数量由write_concurrency限制。
+        visible_time不唯一的时序类型，同一秒内的多条数据打包成一行，写入已经存在的秒的时候跟已有的数据合并
+        """
+        if len(ts_list) <= 0:
+            return
+        start_time = time.time()
+        bin_stmt = self._prepare(self._insert_cql('data_bin'))
+        json_stmt = self._prepare(self._insert_cql('data'))
+
+        partitions: Dict[Tuple[str, str], List[TSData]] = {}
         for ts_data in ts_list:
-            func = TSTypeRegistry.find_function(ts_data.ts_type_name)
+            partitions.setdefault((ts_data.ts_type_name, ts_data.code), []).append(ts_data)
+
+        batches = []
+        for (ts_name, code), data_list in partitions.items():
+            func = TSTypeRegistry.find_function(ts_name)
             if not isinstance(func, HistoryTimeSeriesType):
                 raise RuntimeError("非法的tsType")
-            value_serialized: str = func.serialize(ts_data.values)
-            TimeSeriesDataModel.batch(b).create(type=ts_data.ts_type_name, code=ts_data.code,
-                                                visible_time=ts_data.visible_time, data=value_serialized)
-        b.execute()
+            if func.unique_visible_time():
+                # 同一批中重复的数据只写入最后一条。同一个batch中的写入时间戳相同，Cassandra不保证最后一条生效
+                data_list = dedupe_by_visible_time(data_list)
+            if not func.unique_visible_time():
+                if not func.codec:
+                    raise RuntimeError("visible_time不唯一的时序类型的列必须都是定长类型")
+                stmt = bin_stmt
+                data_list = sorted(data_list, key=lambda ts_data: ts_data.visible_time)
+                buffer = func.codec.encode([ts_data.values for ts_data in data_list])
+                size = func.codec.dtype.itemsize
+                # 每一组相同visible_time的数据的起始位置
+                bounds = [i for i in range(len(data_list))
+                          if i == 0 or data_list[i].visible_time != data_list[i - 1].visible_time]
+                bounds.append(len(data_list))
+                serialized = [buffer[bounds[k] * size: bounds[k + 1] * size] for k in range(len(bounds) - 1)]
+                data_list = [data_list[i] for i in bounds[:-1]]
+                # 写入是整行覆盖，需要先读出这些秒已经存在的数据合并进去
+                existing_rows = self._select_partitions(ts_name, HistoryDataQueryCommand(
+                    data_list[0].visible_time, data_list[-1].visible_time, [code], None))[code]
+                existing_bins = {Timestamp(row[1], tz='UTC').value: row[3] for row in existing_rows if row[3]}
+                serialized = [self._merge_packed(existing_bins.get(ts_data.visible_time.value), value, size)
+                              for ts_data, value in zip(data_list, serialized)]
+            elif func.codec:
+                stmt = bin_stmt
+                # 整个分区一次编码，然后按照定长切分成每一行的数据
+                buffer = func.codec.encode([ts_data.values for ts_data in data_list])
+                size = func.codec.dtype.itemsize
+                serialized = [buffer[i * size: (i + 1) * size] for i in range(len(data_list))]
+            else:
+                stmt = json_stmt
+                serialized = [func.serialize(ts_data.values) for ts_data in data_list]
+            params = [(ts_name, code, ts_data.visible_time, value) for ts_data, value in zip(data_list, serialized)]
+            for partition_params in self._group_by_partition(params):
+                for i in range(0, len(partition_params), self.write_batch_size):
+                    batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                    for param in partition_params[i: i + self.write_batch_size]:
+                        batch.add(stmt, param)
+                    batches.append((batch, None))
+
+        execute_concurrent(connection.get_session(), batches, concurrency=self.write_concurrency)
+        cost = time.time() - start_time
+        logging.info("写入{}条数据, 分区数:{}, 耗时:{:.2f}s, 速度:{:.0f} rows/s".
+                     format(len(ts_list), len(partitions), cost, len(ts_list) / cost if cost > 0 else 0))
+
+    @classmethod
+    def _merge_packed(cls, existing: bytes, value: bytes, size: int) -> bytes:
+        """
+        将新写入的数据追加到同一秒已有的数据后面，已有数据中包含的记录不会重复追加，所以重复下载同一段数据的结果不变
+        """
+        if not existing:
+            return value
+        counts = Counter(existing[i: i + size] for i in range(0, len(existing), size))
+        appended = []
+        for i in range(0, len(value), size):
+            record = value[i: i + size]
+            if counts[record] > 0:
+                counts[record] -= 1
+            else:
+                appended.append(record)
+        return existing + b''.join(appended)
+
+    def delete(self, ts_name: str, code: str, start: Timestamp, end: Timestamp):
+        """
+        按照visible_time的范围删除，Cassandra中只会写入一个范围墓碑
+        """
+        stmt = self._prepare("DELETE FROM {} WHERE type=? AND code=? AND visible_time>=? AND visible_time<=?"
+                             .format(TimeSeriesDataModel.column_family_name()))
+        connection.get_session().execute(stmt, (ts_name, code, start, end))
+
+
+class TradingSessionBucketer(object):
+    """
+    根据交易日历计算数据所属的交易时段id，形如20200102。上一个交易日收盘之后到本交易日收盘之间的数据都属于本交易时段，
+    日历范围之外的数据按照UTC日期分桶
+    """
+
+    def __init__(self, calendar: TradingCalendar):
+        self.closes: np.ndarray = calendar.closes.values.astype('datetime64[ns]').astype(np.int64)
+        self.first_open: int = int(calendar.opens.values[0].astype('datetime64[ns]').astype(np.int64))
+        self.labels: np.ndarray = self._day_ids(calendar.closes.index.tz_localize(None).values.astype(np.int64))
+
+    @classmethod
+    def _day_ids(cls, ns: np.ndarray) -> np.ndarray:
+        days = ns.astype('datetime64[ns]').astype('datetime64[D]')
+        months = days.astype('datetime64[M]')
+        month_ints = months.astype(int)
+        return (month_ints // 12 + 1970) * 10000 + (month_ints % 12 + 1) * 100 + (days - months).astype(int) + 1
+
+    def _in_calendar(self, ns: np.ndarray) -> np.ndarray:
+        return (ns >= self.first_open) & (ns <= self.closes[-1])
+
+    def session_ids(self, ns: np.ndarray) -> np.ndarray:
+        idx = np.minimum(np.searchsorted(self.closes, ns, side='left'), len(self.closes) - 1)
+        return np.where(self._in_calendar(ns), self.labels[idx], self._day_ids(ns))
+
+    def session_id(self, t: Timestamp) -> int:
+        return int(self.session_ids(np.array([t.value]))[0])
+
+    def sessions_between(self, start: Timestamp, end: Timestamp) -> List[int]:
+        """
+        [start, end]覆盖的所有交易时段id，按照时间排序
+        """
+        start_ns, end_ns = start.value, end.value
+        ids = []
+        if start_ns < self.first_open:
+            before_end = min(end_ns, self.first_open - 1)
+            days = np.arange(np.datetime64(start_ns, 'ns').astype('datetime64[D]'),
+                             np.datetime64(before_end, 'ns').astype('datetime64[D]') + 1)
+            ids.extend(self._day_ids(days.astype('datetime64[ns]').astype(np.int64)).tolist())
+        lo, hi = max(start_ns, self.first_open), min(end_ns, self.closes[-1])
+        if lo <= hi:
+            ids.extend(self.labels[np.searchsorted(self.closes, lo, side='left'):
+                                   np.searchsorted(self.closes, hi, side='left') + 1].tolist())
+        if end_ns > self.closes[-1]:
+            after_start = max(start_ns, self.closes[-1] + 1)
+            days = np.arange(np.datetime64(after_start, 'ns').astype('datetime64[D]'),
+                             np.datetime64(end_ns, 'ns').astype('datetime64[D]') + 1)
+            ids.extend(self._day_ids(days.astype('datetime64[ns]').astype(np.int64)).tolist())
+        return sorted(set(ids))
+
+
+class SessionTSDataRepoImpl(TSDataRepoImpl):
+    """
+    使用time_series_data3存储时序数据，分区为(type, code, trading_session)，查询的时候只读取跟command的范围相交的交易时段。
+    还没有从time_series_data2迁移完成的(type, code)，会同时读取旧表，两边都有的数据以新表为准
+    """
+
+    def __init__(self, calendar: TradingCalendar, window_session_batch: int = 20, max_window_sessions: int = 2520,
+                 migration_refresh_interval: int = 60, **kwargs):
+        super().__init__(**kwargs)
+        self.bucketer = TradingSessionBucketer(calendar)
+        self.window_session_batch = window_session_batch
+        self.max_window_sessions = max_window_sessions
+        self.migration_refresh_interval = migration_refresh_interval
+        self.migrated: set = set()
+        self.migrated_load_time = None
+
+    def _insert_cql(self, column: str) -> str:
+        return "INSERT INTO {} (type, code, trading_session, visible_time, {}) VALUES (?, ?, ?, ?, ?)" \
+            .format(TimeSeriesSessionDataModel.column_family_name(), column)
+
+    def _group_by_partition(self, params: List[Tuple]) -> List[List[Tuple]]:
+        session_ids = self.bucketer.session_ids(np.array([param[2].value for param in params], dtype=np.int64))
+        groups: Dict[int, List[Tuple]] = {}
+        for (ts_name, code, visible_time, value), session_id in zip(params, session_ids.tolist()):
+            groups.setdefault(session_id, []).append((ts_name, code, session_id, visible_time, value))
+        return list(groups.values())
+
+    def delete(self, ts_name: str, code: str, start: Timestamp, end: Timestamp):
+        stmt = self._prepare("DELETE FROM {} WHERE type=? AND code=? AND trading_session=? "
+                             "AND visible_time>=? AND visible_time<=?"
+                             .format(TimeSeriesSessionDataModel.column_family_name()))
+        params = [(ts_name, code, session_id, start, end)
+                  for session_id in self.bucketer.sessions_between(start, end)]
+        for success, result in execute_concurrent_with_args(connection.get_session(), stmt, params,
+                                                            concurrency=self.write_concurrency):
+            if not success:
+                raise result
+        if not self.is_migrated(ts_name, code):
+            super().delete(ts_name, code, start, end)
+
+    def is_migrated(self, ts_name: str, code: str) -> bool:
+        now = time.time()
+        with self.lock:
+            if self.migrated_load_time is None or now - self.migrated_load_time > self.migration_refresh_interval:
+                self.migrated = {(row.type, row.code) for row in TimeSeriesDataMigrationModel.objects.all()}
+                self.migrated_load_time = now
+            return (ts_name, code) in self.migrated
+
+    def _select_partitions(self, ts_name, command) -> Dict[str, List[Tuple]]:
+        if command.start and command.end:
+            rows_by_code = self._select_sessions_in_range(ts_name, command)
+        else:
+            rows_by_code = {code: self._select_sessions_in_window(ts_name, code, command) for code in command.codes}
+
+        legacy_codes = [code for code in command.codes if not self.is_migrated(ts_name, code)]
+        if len(legacy_codes) > 0:
+            legacy_command = HistoryDataQueryCommand(command.start, command.end, legacy_codes, command.window)
+            legacy_rows_by_code = super()._select_partitions(ts_name, legacy_command)
+            for code in legacy_codes:
+                rows_by_code[code] = self._merge_rows(legacy_rows_by_code[code], rows_by_code[code],
+                                                      None if command.start else command.window)
+        return rows_by_code
+
+    @classmethod
+    def _merge_rows(cls, legacy_rows: List[Tuple], rows: List[Tuple], window: int = None) -> List[Tuple]:
+        if len(legacy_rows) <= 0:
+            return rows
+        merged = {row[1]: row for row in legacy_rows}
+        merged.update({row[1]: row for row in rows})
+        merged_rows = [merged[visible_time] for visible_time in sorted(merged.keys())]
+        return merged_rows[-window:] if window else merged_rows
+
+    def _select_sessions_in_range(self, ts_name, command) -> Dict[str, List[Tuple]]:
+        stmt = self._prepare("SELECT code, visible_time, data, data_bin FROM {} WHERE type=? AND code=? "
+                             "AND trading_session=? AND visible_time>=? AND visible_time<=?"
+                             .format(TimeSeriesSessionDataModel.column_family_name()))
+        session_ids = self.bucketer.sessions_between(command.start, command.end)
+        params = [(ts_name, code, session_id, command.start, command.end)
+                  for code in command.codes for session_id in session_ids]
+        results = execute_concurrent_with_args(connection.get_session(), stmt, params,
+                                               concurrency=self.read_concurrency)
+        rows_by_code = {code: [] for code in command.codes}
+        for param, (success, result) in zip(params, results):
+            if not success:
+                raise result
+            rows_by_code[param[1]].extend(result)
+        return rows_by_code
+
+    def _select_sessions_in_window(self, ts_name, code, command) -> List[Tuple]:
+        """
+        从end所在的交易时段开始往前，每次并发的查询window_session_batch个交易时段，直到数据量满足window
+        """
+        stmt = self._prepare("SELECT code, visible_time, data, data_bin FROM {} WHERE type=? AND code=? "
+                             "AND trading_session=? AND visible_time<=? ORDER BY visible_time DESC LIMIT ?"
+                             .format(TimeSeriesSessionDataModel.column_family_name()))
+        end_idx = np.searchsorted(self.bucketer.closes, command.end.value, side='left')
+        session_ids = self.bucketer.labels[max(end_idx - self.max_window_sessions + 1, 0): end_idx + 1].tolist()
+        end_session = self.bucketer.session_id(command.end)
+        if len(session_ids) <= 0 or session_ids[-1] != end_session:
+            session_ids.append(end_session)
+        rows = []
+        while len(session_ids) > 0 and len(rows) < command.window:
+            batch_ids = session_ids[-self.window_session_batch:]
+            session_ids = session_ids[:-self.window_session_batch]
+            params = [(ts_name, code, session_id, command.end, command.window) for session_id in batch_ids]
+            results = execute_concurrent_with_args(connection.get_session(), stmt, params,
+                                                   concurrency=self.read_concurrency)
+            batch_rows = []
+            for success, result in results:
+                if not success:
+                    raise result
+                batch_rows.extend(reversed(list(result)))
+            rows = batch_rows + rows
+        return rows[-command.window:]
 
 
 class AccountRepoImpl(AccountRepo):
@@ -0,0 +1,275 @@
+# 老化的tick以及秒级数据的保留策略。超过保留天数的原始数据按照交易时段汇总成派生的分钟bar或者报价摘要，
+# 写入派生数据之后删除原始数据并更新DataRecord。每次执行只处理上次执行之后新老化的数据，中途失败的话重新执行即可。
+# 用法: python -m se2.infras.run_retention --types ibTrade,ibBidAsk
+# 保留天数在config.ini的retention中配置，例如 ibTrade = 90；派生的时序类型通过retention.rollups配置，
+# 例如 rollups = ibTrade:min_bar,ibBidAsk:session_summary，没有派生类型的原始数据只有指定了--drop才会直接删除
+import logging
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas import Timestamp, Timedelta, DataFrame
+from trading_calendars import TradingCalendar
+
+from se2.domain.common import BeanContainer
+from se2.domain.time_series import *
+
+
+class RolledUpTimeSeriesType(HistoryTimeSeriesType, metaclass=ABCMeta):
+    """
+    由其他时序类型的原始数据汇总而来的时序类型，数据只能由RetentionJob产生，不能从数据供应商下载
+    """
+
+    source_name: str = None
+
+    @abstractmethod
+    def aggregate(self, df: DataFrame, code: str, start: Timestamp, end: Timestamp) -> List[TSData]:
+        """
+        将一个code在[start, end]内的原始数据汇总成派生数据
+        """
+        pass
+
+    def load_history_data(self, command: HistoryDataQueryCommand) -> List[TSData]:
+        return []
+
+    def load_assets(self) -> List[Asset]:
+        return []
+
+
+class RolledUpMinBar(BarHistoryTimeSeriesType, RolledUpTimeSeriesType):
+    """
+    由成交tick(price, size)或者秒级bar汇总的分钟bar，visible_time为bar的结束时间
+    """
+
+    def __init__(self, source_name: str):
+        self.source_name = source_name
+        BarHistoryTimeSeriesType.__init__(self, current_price_change_start_offset=Timedelta(minutes=5),
+                                          current_price_change_end_offset=Timedelta(minutes=1440 * 10))
+
+    def name(self) -> str:
+        return "{}MinBar".format(self.source_name)
+
+    def columns(self) -> List[Column]:
+        return [Column("start_time", Timestamp, None, None, None), Column("open", float, None, None, None),
+                Column("high", float, None, None, None), Column("low", float, None, None, None),
+                Column("close", float, None, None, None), Column("volume", int, None, None, None)]
+
+    def aggregate(self, df, code, start, end):
+        if len(df) <= 0:
+            return []
+        times = df.index.get_level_values(0)
+        if 'price' in df.columns:
+            minutes = times.floor('min')
+            grouped = df.groupby(minutes.values, sort=True)
+            bars = DataFrame({'open': grouped['price'].first(), 'high': grouped['price'].max(),
+                              'low': grouped['price'].min(), 'close': grouped['price'].last(),
+                              'volume': grouped['size'].sum()})
+        else:
+            minutes = pd.DatetimeIndex(df['start_time']).floor('min')
+            grouped = df.groupby(minutes.values, sort=True)
+            bars = DataFrame({'open': grouped['open'].first(), 'high': grouped['high'].max(),
+                              'low': grouped['low'].min(), 'close': grouped['close'].last(),
+                              'volume': grouped['volume'].sum()})
+        starts = pd.to_datetime(bars.index, utc=True).tz_convert('Asia/Shanghai')
+        return [Bar(self.name(), bar_start + Timedelta(minutes=1), code,
+                    {'start_time': bar_start, 'open': float(row[0]), 'high': float(row[1]), 'low': float(row[2]),
+                     'close': float(row[3]), 'volume': int(row[4])})
+                for bar_start, row in zip(starts, bars[['open', 'high', 'low', 'close', 'volume']].values)]
+
+    def should_cache(self):
+        return True
+
+
+class SessionQuoteSummary(RolledUpTimeSeriesType):
+    """
+    由买卖报价tick汇总的每个交易时段的报价摘要，visible_time为该交易时段最后一条报价的时间
+    """
+
+    def __init__(self, source_name: str):
+        self.source_name = source_name
+        HistoryTimeSeriesType.__init__(self)
+
+    def name(self) -> str:
+        return "{}SessionSummary".format(self.source_name)
+
+    def columns(self) -> List[Column]:
+        return [Column("start_time", Timestamp, None, None, None), Column("open_bid", float, None, None, None),
+                Column("open_ask", float, None, None, None), Column("close_bid", float, None, None, None),
+                Column("close_ask", float, None, None, None), Column("low_bid", float, None, None, None),
+                Column("high_ask", float, None, None, None), Column("mean_spread", float, None, None, None),
+                Column("mean_bid_size", float, None, None, None), Column("mean_ask_size", float, None, None, None),
+                Column("count", int, None, None, None)]
+
+    def aggregate(self, df, code, start, end):
+        if len(df) <= 0:
+            return []
+        bid, ask = df['bid_price'].values.astype(np.float64), df['ask_price'].values.astype(np.float64)
+        values = {'start_time': df.index.get_level_values(0)[0], 'open_bid': float(bid[0]),
+                  'open_ask': float(ask[0]), 'close_bid': float(bid[-1]), 'close_ask': float(ask[-1]),
+                  'low_bid': float(bid.min()), 'high_ask': float(ask.max()), 'mean_spread': float((ask - bid).mean()),
+                  'mean_bid_size': float(df['bid_size'].mean()), 'mean_ask_size': float(df['ask_size'].mean()),
+                  'count': int(len(df))}
+        return [TSData(self.name(), df.index.get_level_values(0)[-1], code, values)]
+
+    def current_price_in_history(self, codes, the_time: Timestamp, ts: TimeSeries) -> Mapping[str, CurrentPrice]:
+        """
+        原始报价已经被删除，只能取the_time之前最近一个交易时段的收盘报价，价格为买卖报价的中间价，
+        报价的数量为该交易时段的平均值
+        """
+        df: DataFrame = ts.history_data(HistoryDataQueryCommand(None, the_time, codes, window=1), from_local=True)
+        df_codes = df.index.get_level_values(1).values
+        ret = {}
+        for code in codes:
+            rows = df[df_codes == code]
+            if len(rows) <= 0:
+                raise RuntimeError("无法获取当前价格，时间:{}, code:{}".format(str(the_time), code))
+            row = rows.iloc[-1]
+            bid_price, ask_price = float(row['close_bid']), float(row['close_ask'])
+            ret[code] = CurrentPrice(self.name(), the_time, code,
+                                     {'price': (bid_price + ask_price) / 2, 'ask_price': ask_price,
+                                      'ask_size': float(row['mean_ask_size']), 'bid_price': bid_price,
+                                      'bid_size': float(row['mean_bid_size'])})
+        return ret
+
+
+ROLLUP_TYPES = {'min_bar': RolledUpMinBar, 'session_summary': SessionQuoteSummary}
+
+
+def parse_rollups(spec: str) -> List[RolledUpTimeSeriesType]:
+    """
+    解析形如 ibTrade:min_bar,ibBidAsk:session_summary 的派生时序类型定义，冒号前面是原始时序类型
+    """
+    rollups = []
+    for item in spec.split(","):
+        source_name, tp = item.strip().split(":")
+        if tp not in ROLLUP_TYPES:
+            raise RuntimeError("不支持的汇总方式:{}".format(tp))
+        rollups.append(ROLLUP_TYPES[tp](source_name))
+    return rollups
+
+
+class RetentionJob(object):
+    """
+    每个(原始时序类型, code)是一个任务，多个任务并发的执行。每个任务按照交易时段从前往后处理，
+    每个交易时段先写入派生数据并推进派生数据的DataRecord，再删除原始数据并从原始数据的DataRecord中去掉该范围，
+    所以中途失败之后重新执行不会丢失数据。没有注册派生时序类型的原始数据，只有drop为True的时候才会直接删除
+    """
+
+    def __init__(self, retention_days: Dict[str, int], calendar: TradingCalendar, concurrency: int = 8,
+                 drop: bool = False):
+        self.retention_days = retention_days
+        self.calendar = calendar
+        self.concurrency = concurrency
+        self.drop = drop
+        self.opens: pd.DatetimeIndex = pd.DatetimeIndex(calendar.opens.values, tz='UTC')
+        self.lock = threading.Lock()
+
+    @classmethod
+    def rollups_of(cls, ts_name: str) -> List[RolledUpTimeSeriesType]:
+        return [func for func in TSTypeRegistry.types.values()
+                if isinstance(func, RolledUpTimeSeriesType) and func.source_name == ts_name]
+
+    def cutoff(self, ts_name: str, now: Timestamp) -> Timestamp:
+        """
+        只处理完整的交易时段，截止时间对齐到保留期限之前最后一个开盘时间
+        """
+        deadline = now - Timedelta(days=self.retention_days[ts_name])
+        idx = self.opens.searchsorted(deadline, side='right') - 1
+        return self.opens[idx].tz_convert('Asia/Shanghai') if idx >= 0 else deadline
+
+    def session_chunks(self, start: Timestamp, end: Timestamp) -> List[Tuple[Timestamp, Timestamp]]:
+        """
+        将[start, end]按照开盘时间切分成首尾相接的区间，每个区间是一个完整的交易时段以及之后的休市时间。
+        汇总的时候开盘时刻的数据属于后一个区间，这样收盘时刻可见的bar和开盘时刻的tick都不会被拆到两个区间
+        """
+        lo = self.opens.searchsorted(start, side='right')
+        hi = self.opens.searchsorted(end, side='left')
+        bounds = [session_open.tz_convert('Asia/Shanghai') for session_open in self.opens[lo: hi]] + [end]
+        chunks = []
+        p = start
+        for bound in bounds:
+            if bound > p:
+                chunks.append((p, bound))
+                p = bound
+        return chunks
+
+    def roll_up_code(self, ts_name: str, code: str, cutoff: Timestamp) -> int:
+        time_series_repo: TimeSeriesRepo = BeanContainer.getBean(TimeSeriesRepo)
+        ts_data_repo: TSDataRepo = BeanContainer.getBean(TSDataRepo)
+        ts: TimeSeries = time_series_repo.find_one(ts_name)
+        rollups = [(rollup, time_series_repo.find_one(rollup.name())) for rollup in self.rollups_of(ts_name)]
+        if len(rollups) <= 0 and not self.drop:
+            raise RuntimeError("{}没有注册派生的时序类型".format(ts_name))
+        with self.lock:
+            record: DataRecord = ts.data_record.get(code)
+            if not record or record.start > cutoff:
+                return 0
+            chunks = self.session_chunks(record.start, cutoff)
+
+        count = 0
+        for chunk_start, chunk_end in chunks:
+            with self.lock:
+                covered = [(max(s, chunk_start), min(e, chunk_end)) for s, e in record.coverage
+                           if s <= chunk_end and e >= chunk_start]
+            for start, end in covered:
+                # 区间的结束时刻是下一个交易时段的开盘时间，这一时刻的数据留给下一个区间
+                data_end = end - Timedelta(nanoseconds=1) if end == chunk_end else end
+                df = ts_data_repo.query_df(ts_name, SingleCodeQueryCommand(start, data_end, code))
+                for rollup, rollup_ts in rollups:
+                    ts_data_repo.save(rollup.aggregate(df, code, start, data_end))
+                    with self.lock:
+                        if code in rollup_ts.data_record:
+                            rollup_ts.data_record[code].update(SingleCodeQueryCommand(start, end, code))
+                        else:
+                            rollup_ts.data_record[code] = DataRecord(code, start, end)
+                        rollup_ts.save_record(code)
+                    invalidate_history_data(rollup.name(), code, start, end)
+                ts_data_repo.delete(ts_name, code, start, data_end)
+                with self.lock:
+                    record.remove(start, end)
+                    if record.is_empty():
+                        ts.data_record.pop(code)
+                    ts.save_record(code)
+                invalidate_history_data(ts_name, code, start, end, shared=True)
+                count += len(df)
+        return count
+
+    def run(self, ts_names: List[str] = None, now: Timestamp = None):
+        now = now if now else Timestamp.now(tz='Asia/Shanghai')
+        time_series_repo: TimeSeriesRepo = BeanContainer.getBean(TimeSeriesRepo)
+        tasks = []
+        for ts_name in (ts_names if ts_names else list(self.retention_days.keys())):
+            if ts_name not in self.retention_days:
+                raise RuntimeError("{}没有配置保留天数".format(ts_name))
+            if len(self.rollups_of(ts_name)) <= 0:
+                if not self.drop:
+                    raise RuntimeError("{}没有注册派生的时序类型，确认要直接删除老化的数据需要指定drop".format(ts_name))
+                logging.warning("{}没有注册派生的时序类型，老化的数据将直接删除".format(ts_name))
+            cutoff = self.cutoff(ts_name, now)
+            tasks.extend([(ts_name, code, cutoff) for code in time_series_repo.find_one(ts_name).data_record.keys()])
+        logging.info("需要处理的任务数:{}".format(len(tasks)))
+        start_time = time.time()
+        total = 0
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ts_retention') as executor:
+            futures = {executor.submit(self.roll_up_code, ts_name, code, cutoff): (ts_name, code)
+                       for ts_name, code, cutoff in tasks}
+            for k, future in enumerate(as_completed(futures)):
+                ts_name, code = futures[future]
+                try:
+                    count = future.result()
+                    total += count
+                    logging.info("[{}/{}] {}:{} 处理完成, 汇总并删除的数据量:{}".format(k + 1, len(tasks), ts_name, code,
+                                                                          count))
+                except Exception:
+                    import traceback
+                    logging.error("{}:{} 处理失败:{}".format(ts_name, code, traceback.format_exc()))
+                    failed.append((ts_name, code))
+        logging.info("处理结束, 共删除{}条原始数据, 耗时:{:.0f}s, 失败的任务:{}".format(total, time.time() - start_time, failed))
+        if len(failed) > 0:
+            raise RuntimeError("有{}个任务处理失败，重新执行即可继续处理".format(len(failed)))
+
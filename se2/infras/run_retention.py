@@ -0,0 +1,28 @@
+# 执行老化数据的保留策略，实现见se2.infras.retention。保留策略单独作为入口执行，
+# 这样RetentionJob以及派生时序类型都来自同一个已经导入的se2.infras.retention模块
+# 用法: python -m se2.infras.run_retention --types ibTrade,ibBidAsk [--drop]
+import argparse
+
+import trading_calendars
+
+from se2.domain.time_series import TSTypeRegistry
+from se2.infras import config
+from se2.infras.retention import RetentionJob
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="将超过保留天数的原始数据汇总成派生数据并删除原始数据")
+    parser.add_argument('--types', help="要处理的时序类型，逗号分隔，默认处理retention中配置的全部类型")
+    parser.add_argument('--drop', action='store_true', help="没有注册派生时序类型的原始数据也直接删除")
+    args = parser.parse_args()
+    # ConfigParser会把配置项的名字转换成小写
+    ts_names = {name.lower(): name for name in TSTypeRegistry.types.keys()}
+    days = {}
+    for name in config.options('retention'):
+        if name in ('calendar', 'concurrency', 'rollups'):
+            continue
+        if name not in ts_names:
+            raise RuntimeError("retention中配置的时序类型{}没有注册".format(name))
+        days[ts_names[name]] = config.getint('retention', name)
+    RetentionJob(days, trading_calendars.get_calendar(config.get('retention', 'calendar', fallback='NYSE')),
+                 concurrency=config.getint('retention', 'concurrency', fallback=8), drop=args.drop) \
+        .run(args.types.split(",") if args.types else None)
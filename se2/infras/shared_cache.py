@@ -0,0 +1,158 @@
+# 基于内存映射文件的跨进程history_data结果缓存。一份数据只物化一次，多个notebook内核以及并行回测的进程通过np.load(mmap_mode='r')
+# 共享同一份物理内存。目录建议放在/dev/shm这类内存文件系统上
+from __future__ import annotations
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from se2.domain.time_series import *
+
+META_FILE = 'meta.json'
+REFS_DIR = 'refs'
+VISIBLE_TIME_FILE = 'visible_time.npy'
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MmapHistoryDataCache(SharedHistoryDataCache):
+    """
+    每个(时序类型, code, 时间范围, 数据版本)对应root_dir下的一个目录，目录中每一列是一个npy文件。
+    写入的时候先写临时目录再重命名，读者只会看到完整的数据；读取的时候以只读的方式映射，不复制数据。
+    每个挂载了某份数据的进程会在refs目录下创建以pid命名的引用文件，cleanup会清理掉已经退出的进程的引用，
+    并删除没有引用并且超过max_idle没有被访问的数据
+    """
+
+    def __init__(self, root_dir: str, max_idle: Timedelta = Timedelta(hours=1)):
+        self.root_dir = root_dir
+        self.max_idle = max_idle
+        self.attached: set = set()
+        self.lock = threading.Lock()
+        os.makedirs(root_dir, exist_ok=True)
+        atexit.register(self.release_all)
+        # 启动的时候顺便清理掉已经退出的进程遗留的数据
+        self.cleanup()
+
+    def _key(self, ts_name: str, code: str, start: Timestamp, end: Timestamp, version: str) -> str:
+        raw = json.dumps([ts_name, code, start.value, end.value, version])
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _ref_path(self, key: str, pid: int = None) -> str:
+        return os.path.join(self.root_dir, key, REFS_DIR, str(pid if pid else os.getpid()))
+
+    def get(self, ts_name, code, start, end, version):
+        key = self._key(ts_name, code, start, end, version)
+        dataset_dir = os.path.join(self.root_dir, key)
+        if not os.path.exists(os.path.join(dataset_dir, META_FILE)):
+            return None
+        try:
+            with open(os.path.join(dataset_dir, META_FILE)) as f:
+                meta = json.load(f)
+            with self.lock:
+                if key not in self.attached:
+                    open(self._ref_path(key), 'w').close()
+                    self.attached.add(key)
+            os.utime(os.path.join(dataset_dir, META_FILE))
+            visible_time = np.load(os.path.join(dataset_dir, VISIBLE_TIME_FILE), mmap_mode='r')
+            columns = {name: np.load(os.path.join(dataset_dir, file_name), mmap_mode='r', allow_pickle=False)
+                       for name, file_name in meta['columns'].items()}
+            return visible_time, columns
+        except FileNotFoundError:
+            # 数据刚好被其他进程清理掉了
+            return None
+
+    def put(self, ts_name, code, start, end, version, visible_time, columns):
+        key = self._key(ts_name, code, start, end, version)
+        dataset_dir = os.path.join(self.root_dir, key)
+        if os.path.exists(dataset_dir):
+            return
+        if any([arr.dtype == object for arr in columns.values()]):
+            # 只有定长类型的列能够映射
+            return
+        tmp_dir = os.path.join(self.root_dir, "{}.{}.{}.tmp".format(key, os.getpid(), threading.get_ident()))
+        os.makedirs(os.path.join(tmp_dir, REFS_DIR))
+        np.save(os.path.join(tmp_dir, VISIBLE_TIME_FILE), np.ascontiguousarray(visible_time))
+        meta = {'ts_name': ts_name, 'code': code, 'start': str(start), 'end': str(end), 'version': version,
+                'columns': {}}
+        for k, (name, arr) in enumerate(columns.items()):
+            file_name = "c{}.npy".format(k)
+            np.save(os.path.join(tmp_dir, file_name), np.ascontiguousarray(arr))
+            meta['columns'][name] = file_name
+        with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_dir, dataset_dir)
+        except OSError:
+            # 其他进程已经物化了同一份数据
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def invalidate(self, ts_name, code, start, end):
+        # 已经映射了这些数据的进程仍然可以继续读取，文件在所有的映射都关闭之后才会被释放
+        for name in os.listdir(self.root_dir):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                with open(os.path.join(self.root_dir, name, META_FILE)) as f:
+                    meta = json.load(f)
+            except FileNotFoundError:
+                continue
+            if meta['ts_name'] == ts_name and meta['code'] == code and Timestamp(meta['start']) <= end \
+                    and Timestamp(meta['end']) >= start:
+                shutil.rmtree(os.path.join(self.root_dir, name), ignore_errors=True)
+                with self.lock:
+                    self.attached.discard(name)
+
+    def release(self, key: str):
+        with self.lock:
+            self.attached.discard(key)
+        try:
+            os.remove(self._ref_path(key))
+        except FileNotFoundError:
+            pass
+
+    def release_all(self):
+        for key in list(self.attached):
+            self.release(key)
+
+    def cleanup(self):
+        """
+        删除没有进程引用并且超过max_idle没有访问的数据，以及写了一半的临时目录
+        """
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.root_dir):
+            dataset_dir = os.path.join(self.root_dir, name)
+            meta_path = os.path.join(dataset_dir, META_FILE)
+            try:
+                if name.endswith('.tmp'):
+                    if now - os.path.getmtime(dataset_dir) > self.max_idle.total_seconds():
+                        shutil.rmtree(dataset_dir, ignore_errors=True)
+                    continue
+                refs_dir = os.path.join(dataset_dir, REFS_DIR)
+                alive = 0
+                for ref in os.listdir(refs_dir):
+                    if is_process_alive(int(ref)):
+                        alive += 1
+                    else:
+                        os.remove(os.path.join(refs_dir, ref))
+                if alive <= 0 and now - os.path.getmtime(meta_path) > self.max_idle.total_seconds():
+                    shutil.rmtree(dataset_dir, ignore_errors=True)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        logging.info("共享缓存清理完成，删除了{}份数据".format(removed))
@@ -0,0 +1,10 @@
+# 测试不依赖运行目录下的config.ini以及Cassandra，没有指定config.dir的时候使用本地列式存储的配置初始化se2，
+# 各个测试在自己的临时目录中注册需要的repo
+import os
+import tempfile
+
+if not os.getenv("config.dir"):
+    _config_dir = tempfile.mkdtemp(prefix='se2_test_')
+    with open(os.path.join(_config_dir, 'config.ini'), 'w') as f:
+        f.write("[ts_repo]\ntype = local\nroot_dir = {}\n".format(os.path.join(_config_dir, 'ts')))
+    os.environ["config.dir"] = _config_dir
@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+from pandas import Timestamp
+
+from se2.domain.account import OrderBook, LimitOrder, StopOrder, MKTOrder, OrderDirection
+from se2.domain.time_series import Bar
+
+
+class TestOrderBook(TestCase):
+    now = Timestamp('2020-01-02 22:31', tz='Asia/Shanghai')
+
+    def bar(self, code: str, low: float, high: float) -> Bar:
+        return Bar('ts', self.now, code, {'open': low, 'high': high, 'low': low, 'close': high, 'volume': 100,
+                                          'start_time': self.now})
+
+    def test_pop_triggered(self):
+        book = OrderBook()
+        buy_limit = LimitOrder('A', OrderDirection.BUY, 1, self.now, 'test', 10, 9.5)
+        sell_limit = LimitOrder('A', OrderDirection.SELL, 1, self.now, 'test', 10, 11)
+        buy_stop = StopOrder('A', OrderDirection.BUY, 1, self.now, 'test', 10, 10.5)
+        sell_stop = StopOrder('A', OrderDirection.SELL, 1, self.now, 'test', 10, 8)
+        market = MKTOrder('A', OrderDirection.BUY, 1, self.now, 'test', 10)
+        other = MKTOrder('B', OrderDirection.BUY, 1, self.now, 'test', 10)
+        for order in [buy_limit, sell_limit, buy_stop, sell_stop, market, other]:
+            book.add(order)
+
+        # 只有市价单和价格在[low, high]范围内的订单会被取出，按照下单顺序返回
+        triggered = book.pop_triggered(self.bar('A', 9.4, 10.6))
+        self.assertEqual([buy_limit, buy_stop, market], [order for _, order in triggered])
+        self.assertEqual([0, 2, 4], [seq for seq, _ in triggered])
+        self.assertEqual([], book.pop_triggered(self.bar('A', 9.4, 10.6)))
+
+        book.remove(sell_stop)
+        self.assertEqual([sell_limit], [order for _, order in book.pop_triggered(self.bar('A', 7, 12))])
+        self.assertEqual([other], [order for _, order in book.pop_all('B')])
+
+    def test_limit_order_priority(self):
+        book = OrderBook()
+        low = LimitOrder('A', OrderDirection.BUY, 1, self.now, 'test', 10, 9)
+        high = LimitOrder('A', OrderDirection.BUY, 1, self.now, 'test', 10, 9.8)
+        book.add(low)
+        book.add(high)
+        self.assertEqual([high], [order for _, order in book.pop_triggered(self.bar('A', 9.5, 10))])
+        self.assertEqual([low], [order for _, order in book.pop_all('A')])
@@ -0,0 +1,39 @@
+from unittest import TestCase
+
+import pandas as pd
+import trading_calendars
+from pandas import Timestamp, Timedelta
+
+from se2.domain.engine import MarketOpen, MarketClose
+
+
+class TestRuleFireTimes(TestCase):
+    calendar = trading_calendars.get_calendar('NYSE')
+
+    def walk(self, rule, start: Timestamp, end: Timestamp) -> pd.DatetimeIndex:
+        res = []
+        p = start
+        while p <= end:
+            if rule.is_match(self.calendar, p):
+                res.append(p)
+            p += Timedelta(minutes=1)
+        return pd.DatetimeIndex(res, tz=start.tz)
+
+    def check(self, make_rule, start: Timestamp, end: Timestamp):
+        expected = self.walk(make_rule(), start, end)
+        actual = make_rule().fire_times(self.calendar, start, end)
+        self.assertTrue(len(expected) > 0)
+        self.assertTrue(expected.equals(actual), "{} != {}".format(list(expected), list(actual)))
+
+    def test_fire_times_match_minute_walk(self):
+        # 跨越夏令时切换
+        start, end = Timestamp('2020-03-05 20:00', tz='Asia/Shanghai'), Timestamp('2020-03-11 06:00', tz='Asia/Shanghai')
+        for make_rule in [lambda: MarketOpen(), lambda: MarketOpen(minute_offset=-30), lambda: MarketOpen(5),
+                          lambda: MarketClose(), lambda: MarketClose(minute_offset=-1), lambda: MarketClose(30)]:
+            self.check(make_rule, start, end)
+
+    def test_unaligned_start(self):
+        start = Timestamp('2020-01-02 22:29:30', tz='Asia/Shanghai')
+        end = Timestamp('2020-01-07 06:00', tz='Asia/Shanghai')
+        self.check(lambda: MarketOpen(), start, end)
+        self.check(lambda: MarketClose(minute_offset=-1), start, end)
@@ -0,0 +1,171 @@
+from unittest import TestCase
+
+import numpy as np
+from pandas import Timestamp, Timedelta
+
+from se2.domain.time_series import IntervalSet, DataRecord, SingleCodeQueryCommand, Column, ValueCodec, \
+    HistoryDataCache, HistoryDataQueryCommand, assemble_data_frame, TailRows, TSData
+
+
+def t(s: str) -> Timestamp:
+    return Timestamp(s, tz='Asia/Shanghai')
+
+
+class TestIntervalSet(TestCase):
+
+    def test_add_merges_overlapping_and_adjacent(self):
+        s = IntervalSet([(t('2020-01-01'), t('2020-01-02')), (t('2020-01-05'), t('2020-01-06'))])
+        s.add(t('2020-01-02'), t('2020-01-03'))
+        self.assertEqual([(t('2020-01-01'), t('2020-01-03')), (t('2020-01-05'), t('2020-01-06'))], list(s))
+        s.add(t('2020-01-02 12:00'), t('2020-01-05 12:00'))
+        self.assertEqual([(t('2020-01-01'), t('2020-01-06'))], list(s))
+
+    def test_difference(self):
+        s = IntervalSet([(t('2020-01-02'), t('2020-01-03')), (t('2020-01-05'), t('2020-01-06'))])
+        self.assertEqual([(t('2020-01-01'), t('2020-01-02')), (t('2020-01-03'), t('2020-01-05')),
+                          (t('2020-01-06'), t('2020-01-07'))], s.difference(t('2020-01-01'), t('2020-01-07')))
+        self.assertEqual([], s.difference(t('2020-01-02 06:00'), t('2020-01-02 18:00')))
+
+    def test_remove_keeps_boundaries(self):
+        s = IntervalSet([(t('2020-01-01'), t('2020-01-10'))])
+        s.remove(t('2020-01-03'), t('2020-01-05'))
+        self.assertEqual([(t('2020-01-01'), t('2020-01-03')), (t('2020-01-05'), t('2020-01-10'))], list(s))
+        s.remove(t('2020-01-01'), t('2020-01-03'))
+        self.assertEqual([(t('2020-01-05'), t('2020-01-10'))], list(s))
+        self.assertTrue(s.contains(t('2020-01-06'), t('2020-01-07')))
+        self.assertFalse(s.contains(t('2020-01-04'), t('2020-01-07')))
+
+
+class TestDataRecord(TestCase):
+
+    def test_coverage_and_version(self):
+        record = DataRecord('A', t('2020-01-01'), t('2020-01-02'))
+        version = record.version()
+        record.update(SingleCodeQueryCommand(t('2020-01-05'), t('2020-01-06'), 'A'))
+        self.assertEqual((t('2020-01-01'), t('2020-01-06')), (record.start, record.end))
+        self.assertEqual(2, len(record.intervals))
+        self.assertNotEqual(version, record.version())
+        record.remove(t('2020-01-01'), t('2020-01-02'))
+        record.remove(t('2020-01-05'), t('2020-01-06'))
+        self.assertTrue(record.is_empty())
+
+    def test_legacy_record_without_intervals(self):
+        record = DataRecord('A', t('2020-01-01'), t('2020-01-02'), None)
+        self.assertEqual([(t('2020-01-01'), t('2020-01-02'))], record.intervals)
+
+    def test_minus_range_mode(self):
+        record = DataRecord('A', None, None, [(t('2020-01-02'), t('2020-01-03')), (t('2020-01-05'), t('2020-01-06'))])
+        holes = SingleCodeQueryCommand(t('2020-01-01'), t('2020-01-07'), 'A').minus(record)
+        self.assertEqual([(t('2020-01-01'), t('2020-01-02')), (t('2020-01-03'), t('2020-01-05')),
+                          (t('2020-01-06'), t('2020-01-07'))], [(h.start, h.end) for h in holes])
+
+    def test_minus_window_mode_only_checks_back_to_last_interval(self):
+        record = DataRecord('A', None, None, [(t('2020-01-02'), t('2020-01-03')), (t('2020-01-05'), t('2020-01-06'))])
+        # end在最后一段覆盖范围之后，只需要下载最后一段到end之间的部分，更早的空洞不需要下载
+        holes = SingleCodeQueryCommand(None, t('2020-01-08'), 'A', window=10).minus(record)
+        self.assertEqual([(t('2020-01-06'), t('2020-01-08'))], [(h.start, h.end) for h in holes])
+        holes = SingleCodeQueryCommand(None, t('2020-01-05 12:00'), 'A', window=10).minus(record)
+        self.assertEqual([], holes)
+        holes = SingleCodeQueryCommand(None, t('2020-01-04'), 'A', window=10).minus(record)
+        self.assertEqual([(t('2020-01-03'), t('2020-01-04'))], [(h.start, h.end) for h in holes])
+
+
+class TestValueCodec(TestCase):
+    columns = [Column('start_time', Timestamp, None, None, None), Column('close', float, None, None, None),
+               Column('volume', int, None, None, None)]
+
+    def test_round_trip(self):
+        codec = ValueCodec(self.columns)
+        values_list = [{'start_time': t('2020-01-02 22:30'), 'close': 1.5, 'volume': 100},
+                       {'start_time': t('2020-01-02 22:31'), 'close': -2.25, 'volume': 0}]
+        buffers = [codec.encode([values]) for values in values_list]
+        self.assertEqual(values_list, codec.decode_values(buffers))
+        columns = codec.decode([codec.encode(values_list)])
+        self.assertEqual([1.5, -2.25], columns['close'].tolist())
+        self.assertEqual('Asia/Shanghai', str(columns['start_time'].tz))
+
+    def test_unsupported(self):
+        self.assertFalse(ValueCodec.supports([Column('name', str, None, None, None)]))
+        with self.assertRaises(RuntimeError):
+            ValueCodec(self.columns).encode([{'start_time': t('2020-01-02'), 'close': 1, 'volume': 1}])
+        with self.assertRaises(RuntimeError):
+            ValueCodec(self.columns).decode([b'123'])
+
+
+class TestHistoryDataCache(TestCase):
+    columns = [Column('close', float, None, None, None)]
+
+    def setUp(self):
+        self.cache = HistoryDataCache(1 << 20)
+        self.start, self.end = t('2020-01-02'), t('2020-01-03')
+        visible_time = np.array([t('2020-01-02 10:00').value, t('2020-01-02 11:00').value], dtype=np.int64)
+        self.cache.put('ts', 'A', self.start, self.end, visible_time, {'close': np.array([1.0, 2.0])})
+
+    def test_hit_is_isolated_from_cache(self):
+        command = HistoryDataQueryCommand(self.start, self.end, ['A'])
+        df = self.cache.get_df('ts', command, self.columns)
+        df.iloc[0, 0] = 100.0
+        df['close'].values[1] = 200.0
+        self.assertEqual([1.0, 2.0], self.cache.get_df('ts', command, self.columns)['close'].tolist())
+
+    def test_read_only_buffers_are_copied(self):
+        visible_time = np.array([t('2020-01-02 10:00').value], dtype=np.int64)
+        close = np.array([1.0])
+        visible_time.flags.writeable = False
+        close.flags.writeable = False
+        df = assemble_data_frame({'A': [(visible_time, {'close': close})]}, self.columns)
+        df.iloc[0, 0] = 5.0
+        self.assertEqual(5.0, df.iloc[0, 0])
+        self.assertEqual(1.0, close[0])
+
+    def test_invalidate_range(self):
+        self.cache.put('ts', 'A', t('2020-01-05'), t('2020-01-06'), np.array([t('2020-01-05 10:00').value]),
+                       {'close': np.array([3.0])})
+        self.cache.invalidate('ts', 'A', t('2020-01-02 10:30'), t('2020-01-02 10:30'))
+        parts, holes = self.cache.lookup('ts', 'A', t('2020-01-02'), t('2020-01-06'))
+        self.assertEqual(1, len(parts))
+        self.assertEqual((t('2020-01-02'), t('2020-01-05')), holes[0])
+        self.assertEqual([t('2020-01-05').value], self.cache.starts[('ts', 'A')])
+
+    def test_lookup_after_eviction(self):
+        # 每段16字节，只能缓存两段
+        cache = HistoryDataCache(32)
+        for day in ['2020-01-02', '2020-01-04', '2020-01-06']:
+            cache.put('ts', 'A', t(day), t(day + ' 23:00'), np.array([t(day + ' 10:00').value]),
+                      {'close': np.array([1.0])})
+        self.assertEqual([t('2020-01-04').value, t('2020-01-06').value], cache.starts[('ts', 'A')])
+        parts, holes = cache.lookup('ts', 'A', t('2020-01-06'), t('2020-01-06 23:00'))
+        self.assertEqual(1, len(parts))
+        self.assertEqual(0, len(holes))
+        parts, holes = cache.lookup('ts', 'A', t('2020-01-02'), t('2020-01-02 23:00'))
+        self.assertEqual(0, len(parts))
+
+
+class TestTailRows(TestCase):
+
+    @classmethod
+    def row(cls, minute: int, close: float = 1.0) -> TSData:
+        return TSData('ts', t('2020-01-02 10:00') + Timedelta(minutes=minute), 'A', {'close': close})
+
+    def test_last(self):
+        tail = TailRows([self.row(i) for i in range(5)], complete=False)
+        self.assertEqual([self.row(3).visible_time, self.row(4).visible_time],
+                         [row.visible_time for row in tail.last(self.row(4).visible_time, 2)])
+        self.assertEqual(3, len(tail.last(self.row(2).visible_time, 3)))
+        # 缓存的数据不够并且不完整
+        self.assertIsNone(tail.last(self.row(2).visible_time, 4))
+        complete = TailRows([self.row(i) for i in range(2)], complete=True)
+        self.assertEqual(2, len(complete.last(self.row(10).visible_time, 5)))
+
+    def test_upsert(self):
+        tail = TailRows([self.row(i) for i in range(3)], complete=True)
+        tail.upsert(self.row(1, close=9.0), max_size=3)
+        self.assertEqual(9.0, tail.rows[1].values['close'])
+        tail.upsert(self.row(5), max_size=3)
+        self.assertEqual([1, 2, 5], [int((row.visible_time - self.row(0).visible_time).total_seconds() // 60)
+                                     for row in tail.rows])
+        self.assertFalse(tail.complete)
+        # 比缓存的范围更早的数据被忽略
+        tail.upsert(self.row(0), max_size=3)
+        self.assertEqual(3, len(tail.rows))
+        self.assertEqual(self.row(1).visible_time, tail.times[0])
@@ -0,0 +1,161 @@
+import shutil
+import tempfile
+from typing import List
+from unittest import TestCase
+
+import pandas as pd
+import trading_calendars
+from pandas import Timestamp, Timedelta
+
+from se2.domain.common import BeanContainer
+from se2.domain.time_series import HistoryTimeSeriesType, Column, TSData, TSTypeRegistry, TimeSeriesRepo, \
+    TSDataRepo, CachedTimeSeriesRepo, DataRecord, HistoryDataQueryCommand
+from se2.infras.local_repos import LocalTimeSeriesRepoImpl, LocalTSDataRepoImpl
+from se2.infras.retention import RetentionJob, RolledUpMinBar, SessionQuoteSummary
+
+
+class RetentionTestTrade(HistoryTimeSeriesType):
+    """
+    测试用的成交tick，数据由测试直接写入存储
+    """
+
+    def __init__(self, name: str):
+        super().__init__()
+        self._name = name
+
+    def name(self) -> str:
+        return self._name
+
+    def columns(self) -> List[Column]:
+        return [Column("price", float, None, None, None), Column("size", int, None, None, None)]
+
+    def unique_visible_time(self):
+        return False
+
+    def current_price_in_history(self, codes, the_time, ts):
+        raise NotImplementedError
+
+    def load_assets(self):
+        return []
+
+    def load_history_data(self, command):
+        return []
+
+
+def t(s: str) -> Timestamp:
+    return Timestamp(s, tz='Asia/Shanghai')
+
+
+class TestRetentionJob(TestCase):
+    raw_name = 'retentionTestTrade'
+    bare_name = 'retentionTestBareTrade'
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.beans = dict(BeanContainer.beans)
+        TSTypeRegistry.register(RetentionTestTrade(self.raw_name))
+        TSTypeRegistry.register(RetentionTestTrade(self.bare_name))
+        self.rollup = RolledUpMinBar(self.raw_name)
+        TSTypeRegistry.register(self.rollup)
+        BeanContainer.register(TimeSeriesRepo, CachedTimeSeriesRepo(LocalTimeSeriesRepoImpl(self.root_dir)))
+        BeanContainer.register(TSDataRepo, LocalTSDataRepoImpl(self.root_dir))
+        self.job = RetentionJob({self.raw_name: 1, self.bare_name: 1}, trading_calendars.get_calendar('NYSE'))
+        # 2020-01-02和2020-01-03两个交易时段开盘之后一个小时内每20秒两笔成交
+        self.session_start, self.session_end = t('2020-01-02 22:30'), t('2020-01-04 05:00')
+        self.cutoff = t('2020-01-03 22:31')
+        for name in [self.raw_name, self.bare_name]:
+            self.write_raw(name)
+
+    def tearDown(self):
+        for name in [self.raw_name, self.bare_name, self.rollup.name()]:
+            TSTypeRegistry.types.pop(name, None)
+        BeanContainer.beans.clear()
+        BeanContainer.beans.update(self.beans)
+        shutil.rmtree(self.root_dir, ignore_errors=True)
+
+    def write_raw(self, name: str):
+        data_list = []
+        for day_open in [t('2020-01-02 22:31'), t('2020-01-03 22:31')]:
+            for i, visible_time in enumerate(pd.date_range(day_open, day_open + Timedelta(minutes=59), freq='20s')):
+                for size in [1, 2]:
+                    data_list.append(TSData(name, visible_time, 'A', {'price': 100.0 + i % 7, 'size': size}))
+        BeanContainer.getBean(TSDataRepo).save(data_list)
+        ts = BeanContainer.getBean(TimeSeriesRepo).find_one(name)
+        ts.data_record['A'] = DataRecord('A', self.session_start, self.session_end)
+        ts.save()
+
+    def query(self, name: str):
+        return BeanContainer.getBean(TSDataRepo).query_df(
+            name, HistoryDataQueryCommand(self.session_start, self.session_end, ['A']))
+
+    def test_roll_up_code(self):
+        raw = self.query(self.raw_name)
+        aged = raw[raw.index.get_level_values(0) < self.cutoff]
+        count = self.job.roll_up_code(self.raw_name, 'A', self.cutoff)
+        self.assertEqual(len(aged), count)
+
+        bars = self.query(self.rollup.name())
+        self.assertEqual(60, len(bars))
+        self.assertEqual(aged['size'].sum(), bars['volume'].sum())
+        self.assertEqual(aged['price'].max(), bars['high'].max())
+        self.assertEqual(t('2020-01-02 22:32'), bars.index.get_level_values(0)[0])
+
+        # 原始数据只剩下截止时间之后的部分，DataRecord同步更新
+        left = self.query(self.raw_name)
+        self.assertEqual(len(raw) - len(aged), len(left))
+        self.assertTrue((left.index.get_level_values(0) >= self.cutoff).all())
+        time_series_repo = LocalTimeSeriesRepoImpl(self.root_dir)
+        self.assertEqual([(self.cutoff, self.session_end)],
+                         time_series_repo.find_one(self.raw_name).data_record['A'].intervals)
+        self.assertEqual([(self.session_start, self.cutoff)],
+                         time_series_repo.find_one(self.rollup.name()).data_record['A'].intervals)
+
+        # 再次执行没有需要处理的数据
+        self.assertEqual(0, self.job.roll_up_code(self.raw_name, 'A', self.cutoff))
+
+    def test_refuse_without_rollup(self):
+        with self.assertRaises(RuntimeError):
+            self.job.roll_up_code(self.bare_name, 'A', self.cutoff)
+        with self.assertRaises(RuntimeError):
+            self.job.run([self.bare_name], now=self.cutoff + Timedelta(days=2))
+        self.assertEqual(len(self.query(self.raw_name)), len(self.query(self.bare_name)))
+
+
+class TestSessionQuoteSummary(TestCase):
+    source_name = 'retentionTestBidAsk'
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.beans = dict(BeanContainer.beans)
+        self.summary = SessionQuoteSummary(self.source_name)
+        TSTypeRegistry.register(self.summary)
+        BeanContainer.register(TimeSeriesRepo, CachedTimeSeriesRepo(LocalTimeSeriesRepoImpl(self.root_dir)))
+        BeanContainer.register(TSDataRepo, LocalTSDataRepoImpl(self.root_dir))
+        quotes = pd.DataFrame({'bid_price': [10.0, 10.5, 11.0], 'ask_price': [10.2, 10.7, 11.4],
+                               'bid_size': [1, 2, 3], 'ask_size': [4, 5, 6]},
+                              index=pd.MultiIndex.from_arrays([[t('2020-01-02 22:31'), t('2020-01-03 01:00'),
+                                                                t('2020-01-03 05:00')], ['A'] * 3]))
+        BeanContainer.getBean(TSDataRepo).save(
+            self.summary.aggregate(quotes, 'A', t('2020-01-02 22:30'), t('2020-01-03 05:00')))
+        # 跟RetentionJob一样，派生数据的范围记录在DataRecord中
+        ts = BeanContainer.getBean(TimeSeriesRepo).find_one(self.summary.name())
+        ts.data_record['A'] = DataRecord('A', t('2020-01-02 22:30'), t('2020-01-03 22:30'))
+        ts.save()
+
+    def tearDown(self):
+        TSTypeRegistry.types.pop(self.summary.name(), None)
+        BeanContainer.beans.clear()
+        BeanContainer.beans.update(self.beans)
+        shutil.rmtree(self.root_dir, ignore_errors=True)
+
+    def test_current_price_in_history(self):
+        ts = BeanContainer.getBean(TimeSeriesRepo).find_one(self.summary.name())
+        cp = self.summary.current_price_in_history(['A'], t('2020-01-03 22:00'), ts)['A']
+        self.assertAlmostEqual(11.2, cp.values['price'])
+        self.assertEqual(11.0, cp.values['bid_price'])
+        self.assertEqual(11.4, cp.values['ask_price'])
+        self.assertEqual(2.0, cp.values['bid_size'])
+        self.assertEqual(5.0, cp.values['ask_size'])
+        # 第一个交易时段的摘要之前没有价格
+        with self.assertRaises(RuntimeError):
+            self.summary.current_price_in_history(['A'], t('2020-01-03 04:00'), ts)